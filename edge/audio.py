@@ -0,0 +1,461 @@
+import glob
+import os
+import struct
+import subprocess
+import threading
+import wave
+
+import numpy as np
+
+import filecache
+
+# Reading windows of samples out of WAV files for MusicMode.
+#
+# The sample data of a PCM WAV file is memory-mapped rather than read in, so
+# a window is a view into the page cache and memory stays the same however
+# long the track is. 24-bit files, which numpy has no type for, are read a
+# window at a time instead. Samples are scaled to the 16-bit range the modes
+# compare levels against, whatever the sample width of the file.
+#
+# When a track is downloaded, analyze() goes through it once and writes its
+# features next to it, FEATURE_FPS frames per second of the track: the RMS
+# envelope, the energy in BANDS log-spaced frequency bands MusicMode shows
+# and whether a note starts there, so playback only has to look up the frame
+# for the current time.
+#
+# prepare() gets a downloaded track ready for MusicMode off the render
+# thread: anything that is not a WAV file is transcoded to one by ffmpeg,
+# and the WAV is analysed, both kept in a cache keyed by the content hash of
+# the download so an identical upload is never processed twice. The results
+# are then swapped in next to the download atomically, so MusicMode only
+# ever opens a complete WAV file.
+#
+# Microphone captures from the first stereo input device into a ring buffer
+# from PortAudio's callback thread, so AudioMode reads the latest samples
+# without ever waiting on the device. It is opened once and kept running
+# across mode switches.
+#
+# SoundBank decodes a directory of sound effects into pygame once, so the
+# modes can play them from the render loop without touching the disk.
+
+# Microphone capture settings, as AudioMode always used them
+MIC_RATE = 44100
+MIC_CHANNELS = 2
+MIC_CHUNK = 1024
+
+# Seconds of microphone samples kept
+MIC_SECONDS = 1
+
+# Most prepared tracks kept in the cache directory
+CACHE_FILES = 8
+
+# Feature frames per second of audio
+FEATURE_FPS = 100
+
+# Samples per FFT, in frames
+FFT_SIZE = 1024
+
+# Frequency bands, log-spaced between these frequencies in Hz
+BANDS = 8
+BAND_RANGE = (40, 16000)
+
+# Feature frames analysed at a time, bounding memory for long tracks
+BLOCK_FRAMES = 1024
+
+# Seconds of spectral flux an onset has to stand out from
+ONSET_WINDOW = 0.5
+
+# Bumped whenever FEATURES changes, so features written before are analysed again
+FEATURES_VERSION = 2
+
+FEATURES = np.dtype([
+    ("rms", "<f4"), # 0 to 1 of full scale
+    ("bands", "<f4", (BANDS,)), # RMS amplitude per band, 0 to 1 of full scale
+    ("onset", "?"),
+])
+
+# Byte offset and size of the data chunk of a RIFF WAV file
+def data_chunk(f):
+    riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+
+    if riff != b"RIFF" or wave_id != b"WAVE":
+        raise wave.Error("not a RIFF WAV file")
+
+    while True:
+        header = f.read(8)
+
+        if len(header) < 8:
+            raise wave.Error("no data chunk")
+
+        chunk_id, size = struct.unpack("<4sI", header)
+
+        if chunk_id == b"data":
+            return f.tell(), size
+
+        f.seek(size + (size & 1), 1) # Chunks are padded to an even size
+
+# Sample data of a WAV file as (frames, channels) windows, scaled to 16 bits
+class WavSource:
+    DTYPES = {1: np.uint8, 2: np.dtype("<i2"), 4: np.dtype("<i4")}
+
+    def __init__(self, filename):
+        self._wf = wave.open(filename, "rb")
+
+        self.rate = self._wf.getframerate()
+        self.channels = self._wf.getnchannels()
+        self.sample_width = self._wf.getsampwidth()
+        self.frames = self._wf.getnframes()
+
+        self._samples = None
+        dtype = WavSource.DTYPES.get(self.sample_width)
+
+        if dtype is not None and self.frames:
+            with open(filename, "rb") as f:
+                offset, _ = data_chunk(f)
+
+            self._samples = np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=(self.frames, self.channels))
+
+    @property
+    def duration(self):
+        return self.frames / self.rate
+
+    # Up to frames frames starting at frame start, as int32 on the 16-bit scale
+    def window(self, start, frames):
+        start = max(0, start)
+        stop = min(start + frames, self.frames)
+
+        if start >= stop:
+            return np.zeros((0, self.channels), dtype=np.int32)
+
+        if self._samples is not None:
+            samples = self._samples[start:stop].astype(np.int32)
+
+            if self.sample_width == 1:
+                return (samples - 128) << 8
+
+            return samples >> 8 * (self.sample_width - 2)
+
+        # 24-bit, assemble little-endian triplets into the top of an int32
+        self._wf.setpos(start)
+        data = np.frombuffer(self._wf.readframes(stop - start), dtype=np.uint8).reshape(-1, 3)
+        samples = (data[:, 0].astype(np.int32) << 8) | (data[:, 1].astype(np.int32) << 16) | (data[:, 2].astype(np.int32) << 24)
+
+        return (samples >> 16).reshape(-1, self.channels)
+
+    def close(self):
+        self._samples = None
+        self._wf.close()
+
+def features_path(filename):
+    return "%s.features%d.npy" % (filename, FEATURES_VERSION)
+
+# Edges of the FFT bins in every band, for a track sampled at rate
+def band_edges(rate, fft_size=FFT_SIZE, bands=BANDS):
+    low, high = BAND_RANGE[0], min(BAND_RANGE[1], rate / 2)
+    frequencies = np.geomspace(low, high, bands + 1)
+    edges = np.round(frequencies * fft_size / rate).astype(int)
+
+    # At least one bin per band
+    for i in range(1, len(edges)):
+        edges[i] = max(edges[i], edges[i - 1] + 1)
+
+    return edges
+
+# Onsets where the spectral flux peaks clearly above its recent average
+def pick_onsets(flux, fps=FEATURE_FPS):
+    window = max(1, int(ONSET_WINDOW * fps))
+    average = np.convolve(flux, np.ones(window) / window, mode="full")[:len(flux)]
+    threshold = 1.5 * average + 0.1 * flux.mean()
+
+    peaks = np.zeros(len(flux), dtype=bool)
+    peaks[1:-1] = (flux[1:-1] >= flux[:-2]) & (flux[1:-1] > flux[2:])
+
+    return peaks & (flux > threshold)
+
+# Features of every FEATURE_FPS frame of a WAV file
+def compute_features(source):
+    hop = source.rate / FEATURE_FPS
+    count = int(source.frames / hop)
+    features = np.zeros(count, dtype=FEATURES)
+
+    edges = band_edges(source.rate)
+    fft_window = np.hanning(FFT_SIZE).astype(np.float32)
+    scale = 2 / fft_window.sum() / 32768
+    taps = np.arange(FFT_SIZE)
+    flux = np.zeros(count, dtype=np.float32)
+    previous = None
+
+    for block in range(0, count, BLOCK_FRAMES):
+        frames = min(BLOCK_FRAMES, count - block)
+        starts = (np.arange(block, block + frames) * hop).astype(int)
+
+        # Samples under every window of the block, zero past the end of the track
+        length = starts[-1] - starts[0] + FFT_SIZE
+        span = source.window(starts[0], length)
+        mono = np.zeros(length, dtype=np.float32)
+        mono[:len(span)] = span.mean(axis=1)
+
+        # Gathered by index, numpy 1.16 has no sliding_window_view
+        windows = mono[(starts - starts[0])[:, np.newaxis] + taps]
+
+        features["rms"][block:block + frames] = np.sqrt((windows ** 2).mean(axis=1)) / 32768
+
+        power = np.abs(np.fft.rfft(windows * fft_window, axis=1) * scale) ** 2
+        energy = np.add.reduceat(power, edges, axis=1)[:, :BANDS]
+        features["bands"][block:block + frames] = np.sqrt(energy)
+
+        spectrum = np.log1p(1000 * np.sqrt(power))
+        diff = np.diff(spectrum, axis=0, prepend=spectrum[:1] if previous is None else previous)
+        flux[block:block + frames] = np.maximum(diff, 0).mean(axis=1)
+        previous = spectrum[-1:]
+
+    features["onset"] = pick_onsets(flux)
+
+    return features
+
+# Analyse a WAV file and write its features next to it
+def analyze(filename):
+    source = WavSource(filename)
+
+    try:
+        features = compute_features(source)
+
+    finally:
+        source.close()
+
+    path = features_path(filename)
+    temp = "%s.%d.tmp" % (path, threading.get_ident())
+
+    try:
+        with open(temp, "wb") as f:
+            np.save(f, features)
+
+        os.replace(temp, path)
+
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+    return features
+
+# Features of a track, None if it has not been analysed since it was last written
+def load_features(filename):
+    path = features_path(filename)
+
+    try:
+        if os.path.getmtime(path) < os.path.getmtime(filename):
+            return None
+
+        features = np.load(path)
+
+    except (OSError, ValueError):
+        return None
+
+    return features if features.dtype == FEATURES else None
+
+# Feature frame for time seconds into a track, None past its end
+def feature_at(features, seconds):
+    i = int(seconds * FEATURE_FPS)
+
+    return features[i] if 0 <= i < len(features) else None
+
+# Where the WAV MusicMode plays for a downloaded track is put
+def ready_path(filename):
+    return filename + ".wav"
+
+def is_wav(filename):
+    try:
+        WavSource(filename).close()
+        return True
+
+    except (wave.Error, EOFError, struct.error):
+        return False
+
+# Convert any audio file ffmpeg can read to a 16-bit PCM WAV at path, streaming rather than loading it
+def transcode(filename, path):
+    from pydub.utils import get_encoder_name
+
+    temp = "%s.%d.tmp" % (path, threading.get_ident())
+
+    try:
+        subprocess.run([get_encoder_name(), "-nostdin", "-v", "error", "-y", "-i", filename,
+            "-vn", "-acodec", "pcm_s16le", "-f", "wav", temp], check=True, capture_output=True)
+
+        os.replace(temp, path)
+
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+# Locks of the downloads being prepared, by filename
+prepare_locks = {}
+prepare_locks_guard = threading.Lock()
+
+def prepare_lock(filename):
+    with prepare_locks_guard:
+        return prepare_locks.setdefault(filename, threading.Lock())
+
+# Transcode and analyse a downloaded track unless an identical one already was,
+# and swap the results in next to it. Returns the path of the ready WAV. If
+# that fails, the previous track's ready WAV is removed rather than left to
+# play in place of the new one. A download is prepared by one thread at a
+# time, the others wait for it and then find the results in the cache.
+def prepare(filename, cache_dir):
+    ready = ready_path(filename)
+
+    with prepare_lock(filename):
+        try:
+            wav = os.path.join(cache_dir, filecache.file_hash(filename) + ".wav")
+            os.makedirs(cache_dir, exist_ok=True)
+
+            if load_features(wav) is not None:
+                # Touch the features last, they are stale if older than the WAV
+                filecache.touch(wav)
+                filecache.touch(features_path(wav))
+
+            else:
+                if not os.path.exists(wav):
+                    if is_wav(filename):
+                        filecache.link(filename, wav)
+                    else:
+                        transcode(filename, wav)
+
+                analyze(wav)
+                filecache.prune(cache_dir, CACHE_FILES, ".wav")
+
+            # Features first, so the WAV never shows up without them
+            filecache.link(features_path(wav), features_path(ready))
+            filecache.link(wav, ready)
+
+        except Exception:
+            # The WAV first, for the same reason
+            for path in (ready, features_path(ready)):
+                try:
+                    os.remove(path)
+
+                except FileNotFoundError:
+                    pass
+
+            raise
+
+    return ready
+
+# Fixed-size buffer of the latest (frames, channels) samples, written from one thread and read from others
+class RingBuffer:
+    def __init__(self, frames, channels, dtype=np.int16):
+        self._buffer = np.zeros((frames, channels), dtype=dtype)
+        self._lock = threading.Lock()
+        self._written = 0 # Frames written since the start
+
+    @property
+    def written(self):
+        return self._written
+
+    def write(self, samples):
+        samples = samples[-len(self._buffer):]
+        size = len(self._buffer)
+
+        with self._lock:
+            start = self._written % size
+            first = min(len(samples), size - start)
+
+            self._buffer[start:start + first] = samples[:first]
+            self._buffer[:len(samples) - first] = samples[first:]
+            self._written += len(samples)
+
+    # Copy of the latest frames, fewer if not that many were written yet
+    def latest(self, frames):
+        size = len(self._buffer)
+
+        with self._lock:
+            frames = min(frames, size, self._written)
+            start = (self._written - frames) % size
+
+            if start + frames <= size:
+                return self._buffer[start:start + frames].copy()
+
+            return np.concatenate((self._buffer[start:], self._buffer[:start + frames - size]))
+
+# Microphone capture running on PortAudio's callback thread into a RingBuffer
+class Microphone:
+    def __init__(self, rate=MIC_RATE, channels=MIC_CHANNELS, chunk=MIC_CHUNK, seconds=MIC_SECONDS):
+        self.rate = rate
+        self.channels = channels
+        self.chunk = chunk
+
+        self.buffer = RingBuffer(int(rate * seconds), channels)
+        self.overflows = 0 # Callbacks PortAudio reported lost input for
+
+        self._pyaudio = None
+        self._stream = None
+        self._device = None
+
+    # Open the first input device with enough channels and start capturing, if not already
+    def start(self):
+        if self._stream is not None:
+            return
+
+        import pyaudio
+
+        if self._pyaudio is None:
+            self._pyaudio = pyaudio.PyAudio()
+
+        if self._device is None:
+            for i in range(self._pyaudio.get_device_count()):
+                device = self._pyaudio.get_device_info_by_index(i)
+
+                if device["maxInputChannels"] >= self.channels:
+                    print("Using the first compatible audio device detected:")
+                    print((i, device["name"], device["maxInputChannels"]))
+                    self._device = i
+                    break
+
+            else:
+                raise OSError("No audio input device with %d channels" % self.channels)
+
+        self._stream = self._pyaudio.open(format=pyaudio.paInt16, channels=self.channels, rate=self.rate,
+            input=True, input_device_index=self._device, frames_per_buffer=self.chunk,
+            stream_callback=self._callback)
+
+    def _callback(self, data, frames, time_info, status):
+        import pyaudio
+
+        if status & pyaudio.paInputOverflow:
+            self.overflows += 1
+
+        self.buffer.write(np.frombuffer(data, dtype=np.int16).reshape(-1, self.channels))
+
+        return None, pyaudio.paContinue
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+            print("Closed stream")
+
+        if self._pyaudio is not None:
+            self._pyaudio.terminate()
+            self._pyaudio = None
+            print("PyAudio Terminated")
+
+# Every WAV file in a directory, decoded into pygame.mixer.Sound objects by file name
+class SoundBank:
+    def __init__(self, directory):
+        import pygame
+
+        self.sounds = {}
+        self.durations = {} # Seconds
+
+        for path in sorted(glob.glob(os.path.join(directory, "*.wav"))):
+            name = os.path.basename(path)
+            sound = pygame.mixer.Sound(path)
+
+            self.sounds[name] = sound
+            self.durations[name] = sound.get_length()
+
+    def __getitem__(self, name):
+        return self.sounds[name]
+
+    def __len__(self):
+        return len(self.sounds)
@@ -0,0 +1,212 @@
+import sys
+import timeit
+from colorsys import hls_to_rgb
+
+import numpy as np
+
+import lighting
+from kernels import Compositor, Layer
+import kernels
+
+# Time per frame of every BasicMode pattern at several strip lengths:
+#
+#   legacy     the original per-pixel bytearray implementations, kept below for reference
+#   kernels    compositing every frame from the kernel layers
+#   cached     the patterns as BasicMode runs them, copying out of a cached cycle
+#   speedup    legacy / cached, below 1 where the rewrite is slower
+#
+# plus a rainbow with a breathe mask, as an example of stacking layers.
+#
+# The dot, rainbow and wave cycles are as long as the strip, so on long
+# strips their tables outgrow FRAME_CACHE_MB and they are composited every
+# frame instead (marked *). At 5000 pixels that leaves dot and wave at about
+# the legacy cost, 80 to 100 us per frame, rather than the 10 us of a table
+# copy, and dot can come out slightly slower than legacy. Any pattern slower
+# than legacy is listed under its table.
+#
+# Usage: python bench_patterns.py [frames] [num_pixels ...]
+
+PATTERNS = {
+    1: "solid",
+    2: "dot",
+    3: "blink",
+    4: "breathe",
+    5: "rainbow",
+    6: "wave",
+}
+
+COLORS = ["FF0000", "0000FF"]
+
+def legacy_solid(num_pixels):
+    color = lighting.Color(COLORS[0])
+
+    def render():
+        return bytearray([color.r] * num_pixels), bytearray([color.g] * num_pixels), bytearray([color.b] * num_pixels)
+
+    return render
+
+def legacy_dot(num_pixels):
+    state = {"i": 0, "dir": 1}
+
+    def render():
+        color = lighting.Color(COLORS[0])
+        c_r = bytearray([0] * num_pixels)
+        c_g = bytearray([0] * num_pixels)
+        c_b = bytearray([0] * num_pixels)
+        i = state["i"]
+        c_r[i], c_g[i], c_b[i] = color.r, color.g, color.b
+
+        if i >= num_pixels - 1:
+            state["dir"] = -1
+        if i <= 0:
+            state["dir"] = 1
+
+        state["i"] += state["dir"]
+
+        return c_r, c_g, c_b
+
+    return render
+
+def legacy_blink(num_pixels):
+    state = {"up": True, "count": 0}
+
+    def render():
+        color = lighting.Color(COLORS[0]) if state["up"] else lighting.Color()
+        state["count"] += 1
+
+        if state["count"] >= 3:
+            state["up"] = not state["up"]
+            state["count"] = 0
+
+        return bytearray([color.r] * num_pixels), bytearray([color.g] * num_pixels), bytearray([color.b] * num_pixels)
+
+    return render
+
+def legacy_breathe(num_pixels):
+    state = {"mult": 0, "fade_in": True}
+
+    def render():
+        color = lighting.Color(COLORS[0])
+        mult = state["mult"]
+        frame = (bytearray([round(color.r * mult)] * num_pixels),
+            bytearray([round(color.g * mult)] * num_pixels),
+            bytearray([round(color.b * mult)] * num_pixels))
+
+        state["mult"] += 0.1 if state["fade_in"] else -0.1
+
+        if state["mult"] >= 1.0 and state["fade_in"]:
+            state["mult"], state["fade_in"] = 1.0, False
+        if state["mult"] <= 0.0 and not state["fade_in"]:
+            state["mult"], state["fade_in"] = 0.0, True
+
+        return frame
+
+    return render
+
+def legacy_rainbow(num_pixels):
+    rainbow = [hls_to_rgb(i / (num_pixels - 1), 0.5, 1) for i in range(num_pixels)]
+    vals = [[int(c[channel] * 255) for c in rainbow] for channel in range(3)]
+
+    def render():
+        frame = tuple(bytearray(v) for v in vals)
+
+        for v in vals:
+            v.insert(0, v.pop())
+
+        return frame
+
+    return render
+
+def legacy_wave(num_pixels):
+    state = {"i": 0, "ascending": True}
+
+    def render():
+        color0, color1 = lighting.Color(COLORS[0]), lighting.Color(COLORS[-1])
+        i = state["i"]
+        c_r, c_g, c_b = bytearray([color0.r] * num_pixels), bytearray([color0.g] * num_pixels), bytearray([color0.b] * num_pixels)
+        c_r[0:i], c_g[0:i], c_b[0:i] = bytearray([color1.r] * i), bytearray([color1.g] * i), bytearray([color1.b] * i)
+
+        state["i"] += 1 if state["ascending"] else -1
+
+        if state["i"] >= num_pixels and state["ascending"]:
+            state["ascending"] = False
+        if state["i"] == 0 and not state["ascending"]:
+            state["ascending"] = True
+
+        return c_r, c_g, c_b
+
+    return render
+
+LEGACY = {
+    1: legacy_solid,
+    2: legacy_dot,
+    3: legacy_blink,
+    4: legacy_breathe,
+    5: legacy_rainbow,
+    6: legacy_wave,
+}
+
+def bench(render, frames):
+    return min(timeit.repeat(render, number=frames, repeat=3)) / frames * 1e6
+
+def bench_size(num_pixels, frames):
+    stick = lighting.Stick("bench", num_pixels)
+    stick.shadow_state.update(is_on=True, mode=1, colors=COLORS)
+    frame = np.zeros((num_pixels, 3), dtype=np.uint8, order="F")
+    results = {}
+
+    for pattern_id in PATTERNS:
+        stick.shadow_state["pattern"] = pattern_id
+
+        mode = lighting.BasicMode(stick)
+        mode.run() # Build the cycle
+        pattern = mode._pattern
+
+        step = iter(range(1 << 62))
+        results[pattern_id] = (
+            bench(LEGACY[pattern_id](num_pixels), frames),
+            bench(lambda: pattern._compositor.render(frame, next(step) % pattern.period), frames),
+            bench(mode.run, frames),
+            pattern._table is not None,
+        )
+
+    # Rainbow dimmed by a breathe mask, composited every frame
+    rainbow = kernels.hsv_ramp(num_pixels)
+    compositor = Compositor(num_pixels, [
+        Layer(lambda layer, step: kernels.rotate(layer, rainbow, step)),
+        Layer(lambda layer, step: kernels.fill(layer, 255 * lighting.BreathePattern.LEVELS[step % 22]), "multiply"),
+    ])
+    step = iter(range(1 << 62))
+    stacked = bench(lambda: compositor.render(frame, next(step)), frames)
+
+    return results, stacked
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    sizes = [int(n) for n in sys.argv[2:]] or [60, 144, 500, 1000, 5000]
+
+    for num_pixels in sizes:
+        results, stacked = bench_size(num_pixels, frames)
+
+        print("%d pixels, us per frame" % num_pixels)
+        print("%-10s%10s%10s%10s%10s" % ("pattern", "legacy", "kernels", "cached", "speedup"))
+
+        for pattern_id, name in PATTERNS.items():
+            legacy, composited, cached, is_cached = results[pattern_id]
+            print("%-10s%10.1f%10.1f%10.1f%9.1fx%s" % (name, legacy, composited, cached, legacy / cached, "" if is_cached else " *"))
+
+        print("%-10s%10s%10.1f" % ("rainbow*breathe", "", stacked))
+
+        if not all(is_cached for _, _, _, is_cached in results.values()):
+            print("* cycle too large for FRAME_CACHE_MB, composited every frame")
+
+        for pattern_id, name in PATTERNS.items():
+            legacy, _, cached, _ = results[pattern_id]
+
+            if cached > legacy:
+                print("Slower than legacy: %s, %.1f us vs %.1f us per frame (%.1fx)" % (name, cached, legacy, cached / legacy))
+
+        print()
+
+if __name__ == "__main__":
+    main()
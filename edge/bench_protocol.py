@@ -0,0 +1,62 @@
+import sys
+
+import lighting
+import protocol
+
+# Average bytes per frame sent to a node for every BasicMode pattern, per encoding.
+# Every encoded stream is decoded again with the reference decoder to check it.
+#
+# Usage: python bench_protocol.py [num_pixels] [frames]
+
+PATTERNS = {
+    1: "solid",
+    2: "dot",
+    3: "blink",
+    4: "breathe",
+    5: "rainbow",
+    6: "wave",
+}
+
+ENCODERS = {
+    "raw": 1 << protocol.ENCODING_RAW,
+    "rle": 1 << protocol.ENCODING_RLE,
+    "palette": 1 << protocol.ENCODING_PALETTE,
+    "auto": protocol.ALL_ENCODINGS,
+}
+
+def bench_pattern(pattern_id, num_pixels, frames):
+    stick = lighting.Stick("bench", num_pixels)
+    stick.shadow_state.update(is_on=True, mode=1, pattern=pattern_id, colors=["FF0000", "0000FF"])
+    mode = lighting.BasicMode(stick)
+
+    encoders = {name: protocol.FrameEncoder(num_pixels, encodings) for name, encodings in ENCODERS.items()}
+    decoders = {name: protocol.FrameDecoder(num_pixels) for name in ENCODERS}
+
+    for _ in range(frames):
+        mode.run()
+        frame = mode.frame.front
+
+        for name, encoder in encoders.items():
+            packet = encoder.encode(frame)
+
+            if packet is not None:
+                decoders[name].feed(packet)
+
+            if (decoders[name].frame != frame).any():
+                raise AssertionError("%s stream decoded incorrectly" % name)
+
+    return {name: encoder.bytes_sent / frames for name, encoder in encoders.items()}
+
+def main():
+    num_pixels = int(sys.argv[1]) if len(sys.argv) > 1 else lighting.NUM_PIXELS
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    print("Bytes per frame, %d pixels, %d frames (legacy stream: %d)" % (num_pixels, frames, num_pixels * 3))
+    print("%-10s" % "pattern" + "".join("%10s" % name for name in ENCODERS))
+
+    for pattern_id, pattern in PATTERNS.items():
+        results = bench_pattern(pattern_id, num_pixels, frames)
+        print("%-10s" % pattern + "".join("%10.1f" % results[name] for name in ENCODERS))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import sys
+import timeit
+
+import numpy as np
+
+import audio
+import spectrum
+
+# Time per frame of the AudioMode/MusicMode spectrum at 44.1 kHz, for every
+# FFT size the CPU budget may pick and several strip lengths:
+#
+#   analyze   FFT, bands, AGC and smoothing of the latest samples
+#   render    lighting the band segments of the strip
+#
+# against spectrum.BUDGET.
+#
+# Usage: python bench_spectrum.py [frames] [num_pixels ...]
+
+def bench(function, frames):
+    return min(timeit.repeat(function, number=frames, repeat=3)) / frames * 1e6
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    sizes = [int(n) for n in sys.argv[2:]] or [60, 144, 1000]
+
+    samples = (np.random.randn(audio.MIC_RATE, audio.MIC_CHANNELS) * 3000).astype(np.int16)
+
+    print("budget %.0f us per frame" % (spectrum.BUDGET * 1e6))
+    print("%-10s%10s%10s%10s" % ("pixels", "fft", "analyze", "render"))
+
+    for num_pixels in sizes:
+        frame = np.zeros((num_pixels, 3), dtype=np.uint8, order="F")
+        colors = np.full((num_pixels, 3), 255, dtype=np.uint8)
+
+        fft_size = 2048
+        while fft_size >= spectrum.MIN_FFT_SIZE:
+            analyzer = spectrum.Spectrum(audio.MIC_RATE, num_pixels, fft_size=fft_size, budget=float("inf"))
+            window = samples[-fft_size:]
+
+            analyze = bench(lambda: analyzer.update(analyzer.band_amplitudes(window), 1 / 90), frames)
+            render = bench(lambda: analyzer.render(frame, colors), frames)
+
+            print("%-10d%10d%10.1f%10.1f" % (num_pixels, fft_size, analyze, render))
+            fft_size //= 2
+
+if __name__ == "__main__":
+    main()
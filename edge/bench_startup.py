@@ -0,0 +1,143 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+# Startup latency of the edge, measured in fresh interpreters:
+#
+#   import       time to import lighting
+#   first_frame  time from there to the first rendered frame of each mode,
+#                for image mode the first frame showing the image once its
+#                background decoder has the first rows ready, decoding a
+#                generated image with nothing cached
+#
+# plus the slowest modules according to python -X importtime. Pass --json FILE
+# to also write the results out, so runs can be compared across changes.
+#
+# Usage: python bench_startup.py [runs] [--json FILE]
+
+MODES = {
+    1: "basic",
+    2: "image",
+}
+
+PROBE = """
+import json, os, tempfile, time
+t0 = time.perf_counter()
+import lighting
+t1 = time.perf_counter()
+
+result = {"import": t1 - t0, "first_frame": {}, "lit": {}}
+stick = lighting.default_stick
+stick.shadow_state.update(is_on=True, pattern=5, colors=["FF0000"])
+
+# Image mode shows a generated image, decoded into an empty cache, rather than whatever was last downloaded
+from PIL import Image
+directory = tempfile.TemporaryDirectory()
+stick.directory = directory.name
+lighting.IMAGE_CACHE_DIR = os.path.join(directory.name, "cache")
+Image.new("RGB", (stick.num_pixels, 256), (255, 0, 0)).save(stick.path("image"), "PNG")
+
+for mode_id in %r:
+    t = time.perf_counter()
+    mode = lighting.create_mode(mode_id, stick)
+
+    # Image mode decodes on a background thread, a frame before its first rows are ready is blank
+    stream = getattr(mode, "_stream", None)
+    if stream is not None:
+        stream.ready.wait()
+
+    r, g, b = mode.run()
+    result["first_frame"][mode_id] = time.perf_counter() - t
+    result["lit"][mode_id] = sum(any(pixel) for pixel in zip(r, g, b))
+
+    # Don't leave the decoder running past the measurement
+    mode.exit()
+
+directory.cleanup()
+print(json.dumps(result))
+"""
+
+def run_probe():
+    env = dict(os.environ)
+    env.setdefault("NUM_PIXELS", "144")
+
+    output = subprocess.run([sys.executable, "-c", PROBE % list(MODES)],
+        env=env, check=True, capture_output=True, text=True).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+# Cumulative import time per top-level module, in seconds
+def import_times():
+    env = dict(os.environ)
+    env.setdefault("NUM_PIXELS", "144")
+
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import lighting"],
+        env=env, check=True, capture_output=True, text=True).stderr
+
+    times = {}
+
+    # Children are listed before the module importing them, keep those of lighting only
+    for line in stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+
+        if match is None:
+            continue
+
+        depth, module = len(match.group(2)), match.group(3)
+
+        if depth == 2:
+            times[module] = int(match.group(1)) / 1e6
+
+        elif depth == 0:
+            if module == "lighting":
+                return times
+
+            times = {}
+
+    return times
+
+def main():
+    args = sys.argv[1:]
+    json_path = None
+
+    if "--json" in args:
+        i = args.index("--json")
+        json_path = args[i + 1]
+        del args[i:i + 2]
+
+    runs = int(args[0]) if args else 5
+
+    probes = [run_probe() for _ in range(runs)]
+
+    results = {
+        "runs": runs,
+        "import_ms": round(statistics.median(p["import"] for p in probes) * 1000, 1),
+        "first_frame_ms": {
+            MODES[mode_id]: round(statistics.median(p["first_frame"][str(mode_id)] for p in probes) * 1000, 2)
+            for mode_id in MODES
+        },
+        "first_frame_lit": {MODES[mode_id]: probes[-1]["lit"][str(mode_id)] for mode_id in MODES},
+        "slowest_imports_ms": {
+            module: round(t * 1000, 1)
+            for module, t in sorted(import_times().items(), key=lambda item: -item[1])[:10]
+        },
+    }
+
+    print("import lighting: %.1f ms (median of %d)" % (results["import_ms"], runs))
+
+    for mode, ms in results["first_frame_ms"].items():
+        print("first frame, %s mode: %.2f ms, %d pixels lit" % (mode, ms, results["first_frame_lit"][mode]))
+
+    print("slowest imports:")
+    for module, ms in results["slowest_imports_ms"].items():
+        print("  %-30s %8.1f ms" % (module, ms))
+
+    if json_path is not None:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import shutil
+import threading
+
+# Content-addressed files derived from downloads, such as decoded images and
+# transcoded audio. Files are named after the SHA-256 of the download they
+# came from, so an identical upload finds its results already there, and the
+# least recently used ones are pruned to keep the cache directory bounded.
+
+def file_hash(filename):
+    digest = hashlib.sha256()
+
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+# Mark path as the most recently used
+def touch(path):
+    os.utime(path)
+
+# Keep the keep most recently used files ending in suffix, and remove the others
+# together with the files derived from them (named after them, up to the first dot)
+def prune(cache_dir, keep, suffix):
+    files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith(suffix)]
+    files.sort(key=os.path.getmtime, reverse=True)
+
+    for path in files[keep:]:
+        stem = os.path.basename(path).split(".")[0] + "."
+
+        for f in os.listdir(cache_dir):
+            if f.startswith(stem):
+                os.remove(os.path.join(cache_dir, f))
+
+# Put a copy of source at path, hard linked when possible, replacing whatever was there at once
+def link(source, path):
+    temp = "%s.%d.tmp" % (path, threading.get_ident())
+
+    try:
+        try:
+            os.link(source, temp)
+
+        except OSError: # Different file system, or no hard links
+            shutil.copy2(source, temp)
+
+        os.replace(temp, path)
+
+    finally:
+        # Also left behind when path already was a link to source, renaming onto it does nothing
+        if os.path.lexists(temp):
+            os.remove(temp)
@@ -0,0 +1,56 @@
+import numpy as np
+
+# Preallocated, double-buffered RGB frame for a strip of num_pixels.
+#
+# Each buffer is a (num_pixels, 3) uint8 array stored in column-major order,
+# so every channel is a contiguous block and the raw memory of a buffer is
+# laid out exactly like the wire format (all reds, all greens, all blues).
+# Modes render into the back buffer in place, then swap() publishes it and
+# hands out memoryviews over the channels without copying.
+class FrameBuffer:
+    def __init__(self, num_pixels):
+        self._num_pixels = num_pixels
+        self._buffers = [
+            np.zeros((num_pixels, 3), dtype=np.uint8, order="F")
+            for _ in range(2)
+        ]
+
+        # Views are created once, so publishing a frame never allocates
+        self._channels = [
+            tuple(memoryview(buffer[:, c]) for c in range(3))
+            for buffer in self._buffers
+        ]
+        self._views = [memoryview(buffer.T).cast("B") for buffer in self._buffers]
+
+        self._front = 0
+
+    def __len__(self):
+        return self._num_pixels
+
+    @property
+    def back(self):
+        return self._buffers[1 - self._front]
+
+    @property
+    def front(self):
+        return self._buffers[self._front]
+
+    # Channel views (r, g, b) of the front buffer
+    @property
+    def channels(self):
+        return self._channels[self._front]
+
+    # Whole front buffer as one contiguous block of 3 * num_pixels bytes
+    @property
+    def view(self):
+        return self._views[self._front]
+
+    def swap(self):
+        self._front = 1 - self._front
+
+        return self._channels[self._front]
+
+    def clear(self):
+        self.back.fill(0)
+
+        return self.swap()
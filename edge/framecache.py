@@ -0,0 +1,77 @@
+from collections import OrderedDict
+
+# LRU cache of precomputed frame tables, bounded by their total size in bytes.
+#
+# Periodic patterns render a whole cycle once into a contiguous
+# (period, num_pixels, 3) array and then just index into it every frame.
+# Tables are built on first use and the least recently used ones are evicted
+# once the budget is exceeded; a table that would not fit the budget on its
+# own is never built, and the caller renders frame by frame instead.
+# Used from the render stage only.
+class FrameCache:
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._tables = OrderedDict()
+
+    def __len__(self):
+        return len(self._tables)
+
+    def __contains__(self, key):
+        return key in self._tables
+
+    # Table for key, calling build() to render it on a miss. None if nbytes exceeds the budget.
+    def get(self, key, build, nbytes):
+        table = self._tables.get(key)
+
+        if table is not None:
+            self._tables.move_to_end(key)
+            self.hits += 1
+
+            return table
+
+        if nbytes > self.budget:
+            return None
+
+        self.misses += 1
+        table = build()
+
+        self._tables[key] = table
+        self.size += table.nbytes
+
+        while self.size > self.budget:
+            _, evicted = self._tables.popitem(last=False)
+            self.size -= evicted.nbytes
+            self.evictions += 1
+
+        return table
+
+    def discard(self, key):
+        table = self._tables.pop(key, None)
+
+        if table is not None:
+            self.size -= table.nbytes
+
+    # Drop every table whose key does not satisfy keep(key)
+    def retain(self, keep):
+        for key in [key for key in self._tables if not keep(key)]:
+            self.discard(key)
+
+    def clear(self):
+        self._tables.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "tables": len(self._tables),
+            "size_kb": round(self.size / 1024, 1),
+            "budget_kb": round(self.budget / 1024, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,223 @@
+import math
+import queue
+import threading
+import time
+
+import numpy as np
+
+# Clash and swing detection from the IMU samples the node sends.
+#
+# Every sample is processed, on a thread of its own so the node server's I/O
+# thread only has to queue them. The acceleration magnitude goes through a
+# one-pole high-pass filter that removes gravity and drift; a clash is a
+# peak in it that is both sharp (its jerk, the rate of change, is high) and
+# strong. A swing is the low-passed gyro rate rising past a threshold, or for
+# nodes without a gyro the filtered acceleration rising into the band between
+# a swing and a clash. Each kind of gesture has a refractory window after it
+# fires, so one physical clash or swing is one event however many samples
+# it spans. Events carry their sample-to-event latency: from when the sample
+# was taken (estimated from the arrival of its batch and the node's
+# timestamps) to when the event was detected.
+
+CLASH = "clash"
+SWING = "swing"
+
+# Clash: filtered acceleration peak in m/s^2, and jerk leading up to it in m/s^3.
+# LightsaberMode used to take 21 m/s^2 including gravity as a clash.
+CLASH_ACCEL = 11
+CLASH_JERK = 500
+
+# Swing: low-passed gyro rate in rad/s, or filtered acceleration for nodes without a gyro
+SWING_RATE = 4
+SWING_ACCEL = 2
+
+# Seconds after a gesture during which the same kind can't fire again
+CLASH_REFRACTORY = 0.15
+SWING_REFRACTORY = 0.3
+
+# Filter time constants in seconds: high-pass on the acceleration, low-pass on the gyro rate
+HIGH_PASS = 0.5
+LOW_PASS = 0.02
+
+# Sample period assumed when timestamps don't tell (legacy nodes stamp a whole batch alike)
+NOMINAL_PERIOD = 0.01
+
+# Latencies kept for the stats
+LATENCY_WINDOW = 256
+
+class Gesture:
+    def __init__(self, kind, strength, timestamp, latency):
+        self.kind = kind
+        self.strength = strength # Peak acceleration in m/s^2 for clashes, gyro rate in rad/s (or acceleration) for swings
+        self.timestamp = timestamp # Node's clock, ms
+        self.latency = latency # Seconds from the sample being taken to the event being detected
+
+    def __repr__(self):
+        return "Gesture(%s, %.1f, %d, %.1f ms)" % (self.kind, self.strength, self.timestamp, self.latency * 1000)
+
+# Streaming detector, fed batches of samples in order and returning the gestures they complete
+class GestureDetector:
+    def __init__(self):
+        self._timestamp = None # Of the previous sample, ms
+        self._gravity = None # Low-passed magnitude the high-pass subtracts
+        self._accel = 0.0 # Filtered acceleration of the previous sample
+        self._jerk = 0.0 # Largest jerk since the filtered acceleration last fell
+        self._rising = False
+        self._rate = 0.0 # Low-passed gyro rate
+        self._swinging = False
+        self._last = {CLASH: -math.inf, SWING: -math.inf} # When each kind last fired, seconds on the node's clock
+        self._elapsed = 0.0 # Seconds on the node's clock since the first sample
+
+        self.has_gyro = False
+
+    # Gestures completed by samples, which arrived at arrival (time.perf_counter())
+    def process(self, samples, arrival, clock=time.perf_counter):
+        gestures = []
+        accels = np.linalg.norm(samples["accel"], axis=1)
+        rates = np.linalg.norm(samples["gyro"], axis=1)
+        timestamps = samples["timestamp"]
+
+        if rates.any():
+            self.has_gyro = True
+
+        for i in range(len(samples)):
+            timestamp = int(timestamps[i])
+            dt = NOMINAL_PERIOD
+
+            if self._timestamp is not None:
+                elapsed = ((timestamp - self._timestamp) & 0xFFFFFFFF) / 1000 # The node's clock wraps
+
+                if 0 < elapsed < 1:
+                    dt = elapsed
+
+            self._timestamp = timestamp
+            self._elapsed += dt
+
+            accel = self._filter(float(accels[i]), dt)
+            jerk = (accel - self._accel) / dt
+            gesture = None
+
+            # Clash: the filtered acceleration just peaked, sharply and strongly enough
+            if accel > self._accel:
+                self._rising = True
+                self._jerk = max(self._jerk, jerk)
+
+            else:
+                if self._rising and self._accel >= CLASH_ACCEL and self._jerk >= CLASH_JERK:
+                    gesture = self._fire(CLASH, self._accel, timestamp)
+
+                self._rising = False
+                self._jerk = 0.0
+
+            # Swing: the rate crosses the threshold on the way up
+            if self.has_gyro:
+                self._rate += (float(rates[i]) - self._rate) * (1 - math.exp(-dt / LOW_PASS))
+                swing = self._rate
+                swinging = swing >= SWING_RATE
+            else:
+                swing = accel
+                swinging = SWING_ACCEL <= accel < CLASH_ACCEL
+
+            if swinging and not self._swinging and gesture is None:
+                gesture = self._fire(SWING, swing, timestamp)
+
+            self._swinging = swinging
+            self._accel = accel
+
+            if gesture is not None:
+                # The batch arrived with its last sample, this one was taken that much earlier
+                taken = arrival - ((int(timestamps[-1]) - timestamp) & 0xFFFFFFFF) / 1000
+                gesture.latency = clock() - taken
+                gestures.append(gesture)
+
+        return gestures
+
+    # High-pass the acceleration magnitude, removing gravity and slow drift
+    def _filter(self, magnitude, dt):
+        if self._gravity is None:
+            self._gravity = magnitude
+
+        self._gravity += (magnitude - self._gravity) * (1 - math.exp(-dt / HIGH_PASS))
+
+        return max(0.0, magnitude - self._gravity)
+
+    def _fire(self, kind, strength, timestamp):
+        refractory = CLASH_REFRACTORY if kind == CLASH else SWING_REFRACTORY
+
+        if self._elapsed - self._last[kind] < refractory:
+            return None
+
+        self._last[kind] = self._elapsed
+
+        return Gesture(kind, strength, timestamp, 0.0)
+
+# Runs a GestureDetector on its own thread, fed by a stick's sensor listener.
+#
+# on_samples() is the listener; it copies the batch and returns straight away.
+# Detected gestures are queued for the mode to take with events().
+class GestureEngine:
+    def __init__(self, clock=time.perf_counter):
+        self.detector = GestureDetector()
+
+        self.samples = 0
+        self.counts = {CLASH: 0, SWING: 0}
+
+        self._clock = clock
+        self._latencies = np.zeros(LATENCY_WINDOW)
+        self._detected = 0
+        self._batches = queue.Queue()
+        self._events = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="gestures", daemon=True)
+        self._thread.start()
+
+    # Sensor listener, called on the node server thread. samples are only valid until it returns.
+    def on_samples(self, samples):
+        self._batches.put((samples.copy(), self._clock()))
+
+    # Gestures detected since the last call
+    def events(self):
+        events = []
+
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+
+            except queue.Empty:
+                return events
+
+    def stop(self):
+        self._batches.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = self._batches.get()
+
+            if batch is None:
+                return
+
+            samples, arrival = batch
+            self.samples += len(samples)
+
+            for gesture in self.detector.process(samples, arrival, self._clock):
+                self.counts[gesture.kind] += 1
+                self._latencies[self._detected % LATENCY_WINDOW] = gesture.latency
+                self._detected += 1
+                self._events.put(gesture)
+
+    def stats(self):
+        latencies = self._latencies[:min(self._detected, LATENCY_WINDOW)]
+
+        if not len(latencies):
+            latencies = np.zeros(1)
+
+        return {
+            "samples": self.samples,
+            "clashes": self.counts[CLASH],
+            "swings": self.counts[SWING],
+            "latency_ms": {
+                "mean": round(float(latencies.mean()) * 1000, 2),
+                "p95": round(float(np.percentile(latencies, 95)) * 1000, 2),
+                "max": round(float(latencies.max()) * 1000, 2),
+            },
+        }
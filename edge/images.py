@@ -0,0 +1,265 @@
+import json
+import math
+import os
+import queue
+import threading
+
+import numpy as np
+
+import filecache
+
+# Decoding images into strip rows for ImageMode.
+#
+# An image becomes a (height, num_pixels, 3) uint8 array, one row per frame:
+# scaled down to the strip length if it is wider, keeping its aspect ratio,
+# with pixels past its width left black. Animated GIFs and PNGs become a
+# (frames, height, num_pixels, 3) array, with the duration of every frame
+# kept next to it. Decoded images are cached on disk as .npy files named
+# after the image content hash and the strip length, and mapped back into
+# memory on later loads, so choosing the same image again or restarting the
+# edge does not decode it again.
+#
+# ImageStream does all of this on a background thread, handing the rows to
+# the render thread a chunk or animation frame at a time through a bounded
+# queue. A still image is converted and scaled one chunk of rows at a time,
+# so the first row shows without waiting for the rest to be scaled, and
+# besides the source image PIL decodes, memory stays bounded however tall the
+# image is or however many frames it has.
+
+# Most decoded images kept in the cache directory
+CACHE_FILES = 16
+
+# Rows of a still image handed to the render thread at a time
+CHUNK_ROWS = 64
+
+# Chunks or animation frames decoded ahead of the render thread
+PREFETCH = 4
+
+# Seconds to show animation frames that don't say how long, as browsers do
+DEFAULT_DURATION = 0.1
+
+def cache_path(filename, num_pixels, cache_dir):
+    return os.path.join(cache_dir, "%s-%d.npy" % (filecache.file_hash(filename), num_pixels))
+
+# Frame durations of a cached animation are kept in a JSON file next to it
+def durations_path(path):
+    return os.path.splitext(path)[0] + ".json"
+
+# Size of a PIL image fitted to the strip, at most num_pixels wide keeping its aspect ratio
+def fitted_size(im, num_pixels):
+    if im.width > num_pixels:
+        return num_pixels, max(1, round(num_pixels * im.height / im.width))
+
+    return im.size
+
+# Fit a PIL image to the strip, returns an RGB image at most num_pixels wide
+def fit_image(im, num_pixels):
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+
+    size = fitted_size(im, num_pixels)
+
+    return im.resize(size) if size != im.size else im
+
+# Rows start to stop of a PIL image fitted to size, converting and scaling
+# only the source rows they cover plus enough around them for the filter, so
+# they come out as the rows of the whole image fitted at once, up to rounding
+def fit_band(im, size, start, stop):
+    if size == im.size:
+        band = im.crop((0, start, im.width, stop))
+
+        return band.convert("RGB") if band.mode != "RGB" else band
+
+    scale = im.height / size[1]
+    margin = math.ceil(2 * max(scale, 1)) + 1 # Support of the bicubic filter
+    top = max(0, math.floor(start * scale) - margin)
+    bottom = min(im.height, math.ceil(stop * scale) + margin)
+
+    band = im.crop((0, top, im.width, bottom))
+
+    if band.mode != "RGB":
+        band = band.convert("RGB")
+
+    return band.resize((size[0], stop - start), box=(0, start * scale - top, im.width, stop * scale - top))
+
+# Copy an RGB image into out, a (height, num_pixels, 3) array
+def image_rows(im, out):
+    width = min(im.width, out.shape[1])
+
+    out[:, :width] = np.asarray(im)[:, :width]
+    out[:, width:] = 0
+
+    return out
+
+# Duration of the current frame of an animation, in seconds
+def frame_duration(im):
+    duration = im.info.get("duration")
+
+    return duration / 1000 if duration else DEFAULT_DURATION
+
+# (rows, duration) chunks of an image as it is decoded: CHUNK_ROWS rows of a
+# still image with no duration, or every frame of an animation with its own.
+# The rows are written to path as they go, and moved into place once the
+# whole image is decoded.
+def decode_chunks(filename, num_pixels, path):
+    from PIL import Image
+
+    with Image.open(filename) as im:
+        frames = getattr(im, "n_frames", 1)
+        size = fitted_size(im, num_pixels)
+        height = size[1]
+        shape = (height, num_pixels, 3) if frames == 1 else (frames, height, num_pixels, 3)
+
+        temp = "%s.%d.tmp" % (path, threading.get_ident())
+        cache = None
+
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            cache = np.lib.format.open_memmap(temp, mode="w+", dtype=np.uint8, shape=shape)
+
+        except OSError as e:
+            print("Could not cache decoded image:", e)
+
+        durations = []
+
+        try:
+            if frames == 1:
+                for start in range(0, height, CHUNK_ROWS):
+                    stop = min(start + CHUNK_ROWS, height)
+                    rows = image_rows(fit_band(im, size, start, stop), np.empty((stop - start, num_pixels, 3), dtype=np.uint8))
+
+                    if cache is not None:
+                        cache[start:stop] = rows
+
+                    yield rows, None
+
+            else:
+                for i in range(frames):
+                    im.seek(i)
+                    frame = fit_image(im, num_pixels)
+
+                    # Frames are the size of the canvas, but guard against a decoder that disagrees
+                    if frame.height != height:
+                        frame = frame.resize((frame.width, height))
+
+                    rows = image_rows(frame, np.empty((height, num_pixels, 3), dtype=np.uint8))
+                    durations.append(frame_duration(im))
+
+                    if cache is not None:
+                        cache[i] = rows
+
+                    yield rows, durations[-1]
+
+            if cache is not None:
+                cache.flush()
+                del cache
+                cache = None
+
+                if frames > 1:
+                    with open(durations_path(path), "w") as f:
+                        json.dump(durations, f)
+
+                # Rename once complete, so a crash or an early stop never leaves a partial cache file
+                os.replace(temp, path)
+                filecache.prune(os.path.dirname(path) or ".", CACHE_FILES, ".npy")
+
+        finally:
+            if os.path.exists(temp):
+                del cache
+                os.remove(temp)
+
+# Frames of a cached image and their durations (None for a still image),
+# memory-mapped from path. None if the image is not cached.
+def load_cached(path):
+    try:
+        frames = np.load(path, mmap_mode="r")
+        durations = None
+
+        if frames.ndim == 4:
+            with open(durations_path(path)) as f:
+                durations = json.load(f)
+
+        filecache.touch(path)
+
+        return frames, durations
+
+    except (OSError, ValueError):
+        return None
+
+# (rows, duration) chunks of a cached image, copied out of the memory map
+def cached_chunks(frames, durations):
+    if durations is None:
+        for start in range(0, len(frames), CHUNK_ROWS):
+            yield np.array(frames[start:start + CHUNK_ROWS]), None
+
+    else:
+        for rows, duration in zip(frames, durations):
+            yield np.array(rows), duration
+
+# Streams the rows of an image from a background thread.
+#
+# next() returns the next (rows, duration) chunk, see decode_chunks(), or None
+# if the decoder has not caught up yet. The image loops forever: the first
+# pass decodes it and fills the cache, the following ones read it back from
+# the cache. At most prefetch chunks are held in the queue.
+class ImageStream:
+    def __init__(self, filename, num_pixels, cache_dir, prefetch=PREFETCH):
+        self.filename = filename
+        self.num_pixels = num_pixels
+        self.cache_dir = cache_dir
+
+        self.ready = threading.Event() # Set once the first chunk is queued, or decoding failed
+        self.underruns = 0 # Times next() found the queue empty
+
+        self._queue = queue.Queue(prefetch)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="image-stream", daemon=True)
+        self._thread.start()
+
+    def next(self):
+        try:
+            return self._queue.get_nowait()
+
+        except queue.Empty:
+            self.underruns += 1
+            return None
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _chunks(self):
+        path = cache_path(self.filename, self.num_pixels, self.cache_dir)
+
+        while True:
+            cached = load_cached(path)
+
+            if cached is None:
+                yield from decode_chunks(self.filename, self.num_pixels, path)
+            else:
+                yield from cached_chunks(*cached)
+
+    def _run(self):
+        chunks = self._chunks()
+
+        try:
+            for chunk in chunks:
+                while not self._stop.is_set():
+                    try:
+                        self._queue.put(chunk, timeout=0.1)
+                        break
+
+                    except queue.Full:
+                        pass
+
+                if self._stop.is_set():
+                    break
+
+                self.ready.set()
+
+        except Exception as e:
+            print("Could not stream image %s: %r" % (self.filename, e))
+
+        finally:
+            chunks.close()
+            self.ready.set()
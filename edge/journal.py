@@ -0,0 +1,212 @@
+import sqlite3
+import threading
+import time
+
+# Store-and-forward for telemetry.
+#
+# Telemetry messages are appended to a local SQLite journal first, and a
+# Drainer thread replays the journal to MQTT whenever the connection is
+# up, in batches and at a limited rate so a backlog built up while offline
+# doesn't flood the broker (or the IoT rule's DynamoDB writes) when it comes
+# back. A message leaves the journal only once the broker acknowledges it,
+# so delivery is at least once: a message whose acknowledgement was lost is
+# sent again. The journal is bounded by size on disk, the oldest messages
+# are dropped to make room once it is full.
+
+# Bytes of messages kept at most, about a day of one second windows without a series
+MAX_BYTES = 16 * 1024 * 1024
+
+# Largest the write-ahead log is left at after a checkpoint
+WAL_BYTES = 1024 * 1024
+
+# Messages read from the journal at a time, and published per second at most, each spaced out
+DRAIN_BATCH = 50
+DRAIN_RATE = 20
+
+# Seconds to wait for the broker to acknowledge a message
+ACK_TIMEOUT = 10
+
+# Seconds between attempts while the connection is down or failing
+RETRY = 5
+
+class Journal:
+    def __init__(self, path, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dropped = 0 # Messages rotated out before they could be sent
+
+        self._lock = threading.Lock() # Appended to by publish threads, drained by the drainer
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+
+        # Appends only need to survive the process, not a power cut, so skip the fsync on every commit
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA journal_size_limit=%d" % WAL_BYTES)
+        self._db.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, payload TEXT NOT NULL)")
+
+        self._depth = self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        self._page_size = self._db.execute("PRAGMA page_size").fetchone()[0]
+
+    # Messages waiting to be sent
+    @property
+    def depth(self):
+        return self._depth
+
+    # Bytes of the database in use, pages freed by sent or dropped messages are reused rather than counted
+    @property
+    def size(self):
+        with self._lock:
+            return self._size()
+
+    def _size(self):
+        pages = self._db.execute("PRAGMA page_count").fetchone()[0] - self._db.execute("PRAGMA freelist_count").fetchone()[0]
+
+        return pages * self._page_size
+
+    def append(self, topic, payload):
+        with self._lock:
+            self._db.execute("INSERT INTO messages (topic, payload) VALUES (?, ?)", (topic, payload))
+            self._depth += 1
+
+            # Full, drop the oldest, about as many as the excess is of the average message
+            while self._depth > 1:
+                size = self._size()
+
+                if size <= self.max_bytes:
+                    break
+
+                excess = min(self._depth - 1, int(self._depth * (size - self.max_bytes) / size) + 1)
+                self._db.execute("DELETE FROM messages WHERE id IN (SELECT id FROM messages ORDER BY id LIMIT ?)", (excess,))
+                self._depth -= excess
+                self.dropped += excess
+
+    # Oldest messages, up to limit of them, as (id, topic, payload)
+    def peek(self, limit):
+        with self._lock:
+            return self._db.execute("SELECT id, topic, payload FROM messages ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+    # Remove messages up to and including id, once they have been sent
+    def remove(self, id):
+        with self._lock:
+            self._depth -= self._db.execute("DELETE FROM messages WHERE id <= ?", (id,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+# Replays a Journal through publish(topic, payload), which returns a future resolved once the broker acknowledges the message
+class Drainer:
+    def __init__(self, journal, publish, batch=DRAIN_BATCH, rate=DRAIN_RATE, clock=time.monotonic):
+        self.journal = journal
+        self.batch = batch
+        self.rate = rate
+
+        self.sent = 0
+        self.failures = 0
+        self.connected = threading.Event() # Set while the MQTT connection is up
+
+        self._publish = publish
+        self._clock = clock
+        self._next_send = 0.0 # When the rate allows the next message out
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    # Journal a message and have it sent as soon as possible
+    def append(self, topic, payload):
+        self.journal.append(topic, payload)
+        self._wake.set()
+
+    # MQTT connection callbacks
+    def on_connection_interrupted(self, connection, error, **kwargs):
+        print("Connection interrupted, journaling telemetry: %s" % error)
+        self.connected.clear()
+
+    def on_connection_resumed(self, connection, return_code, session_present, **kwargs):
+        print("Connection resumed, %d telemetry messages to send." % self.journal.depth)
+        self.connected.set()
+        self._wake.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="telemetry-drainer", daemon=True)
+        self._thread.start()
+
+    # Run on the calling thread until stopped
+    def run(self):
+        while not self._stopping.is_set():
+            self._wake.clear()
+
+            if not self.connected.is_set() or not self.journal.depth:
+                self._wake.wait(RETRY)
+                continue
+
+            sent, ok = self.drain()
+
+            # Failing despite the connection looking up, give it a moment rather than retrying straight away
+            if not ok:
+                self._stopping.wait(RETRY)
+
+    # Send one batch, returning how many were acknowledged and False if publishing or an acknowledgement failed.
+    # Messages go out one at a time at the rate, so a backlog never reaches the broker as a burst.
+    def drain(self):
+        messages = self.journal.peek(self.batch)
+        futures = []
+        ok = True
+
+        try:
+            for id, topic, payload in messages:
+                now = self._clock()
+                self._next_send = max(self._next_send, now)
+
+                if self._next_send > now and self._stopping.wait(self._next_send - now):
+                    break
+
+                futures.append((id, self._publish(topic, payload)))
+                self._next_send += 1 / self.rate
+
+        except Exception as e:
+            print("Failed to publish telemetry: %r" % e)
+            ok = False
+
+        sent = 0
+        last = None
+
+        # Everything up to the first unacknowledged message can go, the rest is sent again next time
+        for id, future in futures:
+            try:
+                future.result(ACK_TIMEOUT)
+
+            except Exception as e:
+                print("Telemetry not acknowledged: %r" % e)
+                ok = False
+                break
+
+            sent += 1
+            last = id
+
+        if last is not None:
+            self.journal.remove(last)
+
+        self.sent += sent
+
+        if not ok:
+            self.failures += 1
+
+        return sent, ok
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        return {
+            "depth": self.journal.depth,
+            "bytes": self.journal.size,
+            "dropped": self.journal.dropped,
+            "sent": self.sent,
+            "failures": self.failures,
+            "connected": self.connected.is_set(),
+        }
@@ -0,0 +1,140 @@
+import numpy as np
+
+# Vectorized pattern kernels and a layer compositor.
+#
+# A kernel renders one layer in place: a (num_pixels, 3) float32 array of
+# 0-255 channel values. Patterns are stacks of layers, each combined with
+# the layers below it by a blend mode, and the Compositor renders a whole
+# stack for one frame with a handful of array operations and a single
+# conversion to the uint8 frame at the end.
+
+# Ping-pong position for step, running 0 .. length - 1 and back to 1
+def bounce(step, length):
+    period = max(2 * (length - 1), 1)
+    step %= period
+
+    return step if step < length else period - step
+
+def fill(layer, rgb):
+    layer[:] = rgb
+
+def fill_range(layer, start, end, rgb):
+    layer[start:end] = rgb
+
+# Evenly spaced color stops blended linearly along the strip
+def gradient(layer, colors):
+    colors = np.asarray(colors, dtype=np.float32).reshape(-1, 3)
+
+    if len(colors) == 1:
+        layer[:] = colors[0]
+        return
+
+    stops = np.linspace(0, len(layer) - 1, len(colors))
+    positions = np.arange(len(layer))
+
+    for channel in range(3):
+        layer[:, channel] = np.interp(positions, stops, colors[:, channel])
+
+# Dot of width pixels at position on a background
+def dot(layer, position, rgb, width=1, background=(0, 0, 0)):
+    layer[:] = background
+    layer[position:position + width] = rgb
+
+# Sine wave of brightness along the strip, phase in wavelengths
+def sine(layer, rgb, wavelength, phase=0.0, low=0.0):
+    x = np.arange(len(layer), dtype=np.float32) / wavelength - phase
+    brightness = low + (1 - low) * (0.5 + 0.5 * np.sin(2 * np.pi * x))
+
+    np.multiply(brightness[:, None], np.asarray(rgb, dtype=np.float32), out=layer)
+
+# hsv_to_rgb for arrays of hue, saturation and value in 0-1, returns (n, 3) in 0-1
+def hsv_to_rgb(h, s=1.0, v=1.0):
+    h, s, v = np.broadcast_arrays(np.asarray(h, dtype=np.float64) % 1.0, s, v)
+
+    i = np.floor(h * 6).astype(np.int64) % 6
+    f = h * 6 - np.floor(h * 6)
+    p = v * (1 - s)
+    q = v * (1 - s * f)
+    t = v * (1 - s * (1 - f))
+
+    choices = np.stack((
+        np.stack((v, t, p), axis=-1),
+        np.stack((q, v, p), axis=-1),
+        np.stack((p, v, t), axis=-1),
+        np.stack((p, q, v), axis=-1),
+        np.stack((t, p, v), axis=-1),
+        np.stack((v, p, q), axis=-1),
+    ))
+
+    return np.take_along_axis(choices, i[None, :, None], axis=0)[0]
+
+# Full hue circle spread over num_pixels, as 0-255 channel values
+def hsv_ramp(num_pixels, s=1.0, v=1.0):
+    hues = np.arange(num_pixels) / max(num_pixels - 1, 1)
+
+    return np.floor(hsv_to_rgb(hues, s, v) * 255).astype(np.float32)
+
+# source rotated offset pixels along the strip
+def rotate(layer, source, offset):
+    offset %= len(layer)
+
+    layer[offset:] = source[:len(layer) - offset]
+    layer[:offset] = source[len(layer) - offset:]
+
+# Blend modes, combining layer into the composite below it in place
+def blend_normal(below, layer, opacity):
+    if opacity >= 1:
+        below[:] = layer
+    else:
+        below += (layer - below) * opacity
+
+def blend_add(below, layer, opacity):
+    below += layer * opacity
+    np.minimum(below, 255, out=below)
+
+def blend_multiply(below, layer, opacity):
+    below *= 1 + (layer / 255 - 1) * opacity
+
+def blend_screen(below, layer, opacity):
+    below[:] = 255 - (255 - below) * (255 - layer * opacity) / 255
+
+def blend_lighten(below, layer, opacity):
+    np.maximum(below, layer * opacity, out=below)
+
+BLEND_MODES = {
+    "normal": blend_normal,
+    "add": blend_add,
+    "multiply": blend_multiply,
+    "screen": blend_screen,
+    "lighten": blend_lighten,
+}
+
+# One layer of a pattern, kernel(layer, step) rendering it for frame step
+class Layer:
+    def __init__(self, kernel, blend="normal", opacity=1.0):
+        if blend not in BLEND_MODES:
+            raise ValueError("Unknown blend mode %s" % blend)
+
+        self.kernel = kernel
+        self.blend = blend
+        self.opacity = opacity
+
+class Compositor:
+    def __init__(self, num_pixels, layers=()):
+        self.layers = list(layers)
+
+        self._composite = np.zeros((num_pixels, 3), dtype=np.float32)
+        self._layer = np.zeros((num_pixels, 3), dtype=np.float32)
+
+    # Render every layer for frame step and write the result into a (num_pixels, 3) uint8 frame
+    def render(self, frame, step=0):
+        composite = self._composite
+        composite.fill(0)
+
+        for layer in self.layers:
+            layer.kernel(self._layer, step)
+            BLEND_MODES[layer.blend](composite, self._layer, layer.opacity)
+
+        np.clip(composite, 0, 255, out=composite)
+        np.rint(composite, out=composite)
+        frame[:] = composite
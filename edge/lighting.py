@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
 from dotenv import load_dotenv
 import json
+import math
 from multiprocessing import Value
 import os
 import sys
@@ -8,43 +9,75 @@ import threading
 import time
 import traceback
 
+# Heavy dependencies (awscrt/awsiot/boto3 for the cloud, PIL, pygame, pydub
+# and pyaudio for the modes, graphics for the virtual lightstick) are
+# imported where they are first needed, so startup and the modes that don't
+# use them don't pay for them. bench_startup.py keeps track of import time.
+
 # Cloud connectivity
-from awscrt import io, mqtt
-from awsiot import iotshadow
-from awsiot import mqtt_connection_builder
-import boto3
 from concurrent.futures import Future
+from functools import partial
 from uuid import uuid4
+from journal import Drainer, Journal
 
 # Basic Mode
-from colorsys import hls_to_rgb
+import kernels
+from kernels import Compositor, Layer
 
 # Image Mode
-from PIL import Image
+import images
+from pov import RowClock, SwingTracker
 
 # Music Mode
-# import numpy as np
+import audio
+from spectrum import Spectrum
+import numpy as np
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
-import pygame
 # from audio_analyzer import *
-from pydub import AudioSegment
-import pyaudio
-import audioop
-import wave
 from gradient_generator import *
 
-# Wireless/Virtual output
-import select
-import socket
-from virtual import VirtualLightstick
+# Frame output
+from framebuffer import FrameBuffer
+from framecache import FrameCache
+from pipeline import FrameSlot, Stage
+
+# Mode and pattern lookup
+from registry import Registry, load_catalog
+
+# Wireless output
+from server import NodeServer
 
 #lightsaber mode
-import librosa
+import gestures
+from gestures import GestureEngine
 import random
+from telemetry import TelemetryWindow
 
 load_dotenv()
 
+# Plugins import lighting, make sure they get this module rather than a second copy when run as a script
+if __name__ == "__main__":
+    sys.modules.setdefault("lighting", sys.modules[__name__])
+
 NUM_PIXELS = int(os.environ.get("NUM_PIXELS"))
+TARGET_FPS = float(os.environ.get("TARGET_FPS") or 90)
+DISPLAY_FPS = float(os.environ.get("DISPLAY_FPS") or 30)
+STATS_INTERVAL = float(os.environ.get("STATS_INTERVAL") or 10)
+FRAME_CACHE_MB = float(os.environ.get("FRAME_CACHE_MB") or 16)
+MODE_PLUGINS = os.environ.get("MODE_PLUGINS") or ""
+PATTERN_PLUGINS = os.environ.get("PATTERN_PLUGINS") or ""
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR") or ".image-cache"
+AUDIO_CACHE_DIR = os.environ.get("AUDIO_CACHE_DIR") or ".audio-cache"
+POV_ROW_DEGREES = float(os.environ.get("POV_ROW_DEGREES") or 0)
+POV_MAX_ROW_RATE = float(os.environ.get("POV_MAX_ROW_RATE") or 2000)
+TELEMETRY_WINDOW = float(os.environ.get("TELEMETRY_WINDOW") or 1)
+TELEMETRY_SERIES = int(os.environ.get("TELEMETRY_SERIES") or 0)
+TELEMETRY_JOURNAL = os.environ.get("TELEMETRY_JOURNAL") or ".telemetry.db"
+TELEMETRY_JOURNAL_MB = float(os.environ.get("TELEMETRY_JOURNAL_MB") or 16)
+TELEMETRY_DRAIN_RATE = float(os.environ.get("TELEMETRY_DRAIN_RATE") or 20)
+
+# Frame rate the patterns were designed at, their animations advance at this rate whatever the render rate
+PATTERN_FPS = 90
 
 CLIENT_ID = os.environ.get("CLIENT_ID") or str(uuid4())
 S3_BUCKET = os.environ.get("S3_BUCKET")
@@ -52,11 +85,9 @@ THING_NAME = os.environ.get("THING_NAME")
 
 lightstick = None
 
-mode_id = None
-mode = None
-
 mqtt_connection = None
 shadow_client = None
+telemetry_drainer = None # Sends telemetry journaled by the publish threads
 
 is_done = threading.Event()
 
@@ -75,6 +106,97 @@ class LockedData:
 
 locked_data = LockedData()
 
+# Precomputed cycles of the periodic BasicMode patterns, shared by every stick
+frame_cache = FrameCache(int(FRAME_CACHE_MB * 1024 * 1024))
+
+# A lightstick driven by this edge, with its own shadow, strip length, output and sensor data
+class Stick:
+    def __init__(self, name, num_pixels, directory="", state=None):
+        self.name = name
+        self.num_pixels = num_pixels
+        self.directory = directory # Where the stick's uploaded files are downloaded to
+        self.locked_data = state or LockedData()
+
+        self.frame_slot = FrameSlot(num_pixels)
+        self.sensor_value = Value("f", 0) # Latest acceleration magnitude, written by the node server
+        self.sensor_listeners = [] # Called with every batch of IMU samples from the node, on the I/O thread
+        self.reload = threading.Event() # Set when the stick's mode has to reload its files
+
+    @property
+    def shadow_state(self):
+        return self.locked_data.shadow_state
+
+    @property
+    def mode_id(self):
+        return self.shadow_state["mode"] if self.shadow_state["is_on"] else 0
+
+    def path(self, file_type):
+        return os.path.join(self.directory, file_type)
+
+    def publish(self, frame):
+        self.frame_slot.publish(frame)
+
+    def request_reload(self):
+        self.reload.set()
+
+# Sticks whose config renders identically, sharing a single mode instance.
+# The group stands in for a stick when creating the mode: the config of
+# every member is the same, so the mode reads it from whichever comes first.
+class RenderGroup:
+    def __init__(self, key, mode_id, sticks):
+        self.key = key
+        self.sticks = sticks
+        self.mode = create_mode(mode_id, self)
+
+        self._next_render = 0
+
+    @property
+    def name(self):
+        return self.sticks[0].name
+
+    @property
+    def num_pixels(self):
+        return self.sticks[0].num_pixels
+
+    @property
+    def shadow_state(self):
+        return self.sticks[0].shadow_state
+
+    @property
+    def sensor_value(self):
+        return self.sticks[0].sensor_value
+
+    @property
+    def sensor_listeners(self):
+        return self.sticks[0].sensor_listeners
+
+    def path(self, file_type):
+        return self.sticks[0].path(file_type)
+
+    def request_reload(self):
+        for stick in self.sticks:
+            stick.request_reload()
+
+    # Render once, at the mode's own frame rate, and fan the frame out to every member
+    def render(self, now):
+        if now < self._next_render:
+            return
+
+        if self.mode.fps:
+            self._next_render = max(self._next_render + 1 / self.mode.fps, now)
+
+        self.mode.run(now)
+
+        if not self.mode.publishes_frames:
+            self.publish(self.mode.frame.front)
+
+    def publish(self, frame):
+        for stick in self.sticks:
+            stick.publish(frame)
+
+    def exit(self):
+        self.mode.exit()
+
 # Custom data type for color
 class Color:
     def __init__(self, color="000000"):
@@ -85,23 +207,56 @@ class Color:
         self.g = int(color[2:4], 16)
         self.b = int(color[4:], 16)
 
+    @property
+    def rgb(self):
+        return self.r, self.g, self.b
+
 class Mode(ABC):
+    # Frame rate to render this mode at, None for TARGET_FPS
+    fps = None
+
+    # Whether the mode publishes its frames itself, through the stick's publish(), rather than after every run()
+    publishes_frames = False
+
+    def __init__(self, stick=None):
+        self._stick = stick or default_stick
+        self._num_pixels = self._stick.num_pixels
+        self._frame = FrameBuffer(self._num_pixels)
+        self._t = None
+
+    @property
+    def frame(self):
+        return self._frame
+
+    # Render the frame for time t (time.perf_counter() seconds) into self._frame.back
+    # and return the channels of the swapped frame. Without t, render the frame one
+    # nominal frame period after the previous one.
     @abstractmethod
-    def run(self):
+    def run(self, t=None):
         pass
 
+    def _frame_time(self, t):
+        if t is None:
+            t = time.perf_counter() if self._t is None else self._t + 1 / PATTERN_FPS
+
+        self._t = t
+
+        return t
+
     @abstractmethod
     def exit(self):
         pass
+
+    # Mode specific stats for the periodic stats output, None if there are none
+    def stats(self):
+        return None
     
     def _get_colors(self):
-        return locked_data.shadow_state["colors"]
+        return self._stick.shadow_state["colors"]
 
 class NullMode(Mode):
-    def run(self):
-        c_r = c_g = c_b = bytearray([0] * NUM_PIXELS)
-
-        return c_r, c_g, c_b
+    def run(self, t=None):
+        return self._frame.clear()
 
     def exit(self):
         pass
@@ -109,46 +264,43 @@ class NullMode(Mode):
 
 class MusicMode(Mode):
 #     https://stackoverflow.com/questions/19529230/mp3-with-pyaudio?rq=1
-    def __init__(self):
+    def __init__(self, stick=None):
+        super().__init__(stick)
         self._set = True
 
-        if not os.path.exists("audio"):
+        download = self._stick.path("audio")
+        filename = audio.ready_path(download)
+
+        if not os.path.exists(filename):
+            # Downloaded before tracks were prepared, do it now and reload once it is ready
+            if os.path.exists(download):
+                threading.Thread(target=prepare_audio, args=(download, self._stick.request_reload), daemon=True).start()
+
             print("not exist")
             self._set = False
             return
 
-        # Don't add songs with any extension
-        # The conversion will cause it to break T-T
-        filename = r"audio"
+        import pygame
+
+        # Samples are memory-mapped, windows are read straight from the file as the track plays
         try:
-            self._wf = wave.open(filename,'rb')
-        except:
-            print("Incompatible format, converting file")
-            new_file = AudioSegment.from_mp3(filename)
-            new_file.export(filename,format="wav")
-            self._wf = wave.open(filename,'rb')
-            
-        self._data = self._wf.readframes(self._wf.getnframes())
-        
-#         self._pixels = 0
-        self._previous = 0
+            self._wav = audio.WavSource(filename)
+        except Exception as e:
+            print("Could not open audio: %r" % e)
+            self._set = False
+            return
 
-        pygame.init()
-        self._rate = self._wf.getframerate()
-        
-        self._frames_per_sec = int(len(self._data)/(self._wf.getnframes()/self._rate))
+        # Bands precomputed when the track was prepared, analysed from the samples as it plays otherwise
+        self._features = audio.load_features(filename)
 
-        #32767(max data for 16bit integer 2^15 -1)
-        self._max = int(32767 * 1.05)
-        self._lastHeartBeat = time.time()
-        self._increaseHeartBeat = True
+        pygame.init()
+        self._rate = self._wav.rate
+        self._spectrum = Spectrum(self._rate, self._num_pixels)
 
-        half_pixels = int(NUM_PIXELS/2)
+        half_pixels = int(self._num_pixels/2)
         array1 = get_gradient_3d(half_pixels,1,(30,150,0),(255,242,0),(True,True,True))
-        array2 = get_gradient_3d((NUM_PIXELS - half_pixels),1,(255,242,0),(255,0,0),(True,True,True))
-        self._r = [int(val[0]) for val in array1[0]] + [int(val[0]) for val in array2[0]]
-        self._g = [int(val[1]) for val in array1[0]] + [int(val[1]) for val in array2[0]]
-        self._b = [int(val[2]) for val in array1[0]] + [int(val[2]) for val in array2[0]]
+        array2 = get_gradient_3d((self._num_pixels - half_pixels),1,(255,242,0),(255,0,0),(True,True,True))
+        self._gradient = np.concatenate((array1[0], array2[0])).astype(np.uint8)
         
         #quit to reset the initial
         pygame.mixer.quit()
@@ -156,256 +308,220 @@ class MusicMode(Mode):
         pygame.mixer.music.load(filename)
         pygame.mixer.music.play()
     
-    def run(self):
+    def run(self, t=None):
         if not self._set:
-            c_r = c_g = c_b = bytearray([0] * NUM_PIXELS)
+            return self._frame.clear()
 
-            return c_r, c_g, c_b
+        import pygame
 
-        c_r = bytearray([0] * NUM_PIXELS)
-        c_g = bytearray([0] * NUM_PIXELS)
-        c_b = bytearray([0] * NUM_PIXELS)
-        
-        try:
-            if pygame.mixer.get_init() and pygame.mixer.music.get_busy():
-                sound = 0
-                place = int(pygame.mixer.music.get_pos()/1000*self._frames_per_sec)
-                try:
-                    data = self._data[place:place+2048]
-                    if(len(data)>1):
-                        reading = audioop.max(data,2)
-                    else:
-                        reading = self._previous
-                    
-                    if(self._previous is 0):
-                        self._previous = reading
-                    else:
-                        if(reading >= 32760 or abs(self._previous-reading)>20000):
-                            reading = self._previous
-                        else:
-                            self._previous = reading
-                            
-                    sound += reading
-#                 print(reading)
-                    percentage = int(sound/self._max * NUM_PIXELS)
-                    
-#                 if(self._pixels < percentage):
-#                     self._pixels += 1
-#                 
-#                 if(self._pixels > percentage):
-#                     self._pixels -= 1
-#                 
-#                 percentage = self._pixels
-                        
-                    minimum = int(0.05 * NUM_PIXELS)
-                    if(time.time() - self._lastHeartBeat > 0.1 and percentage >0):
-            #                 print("Sending heartbeat")
-                        if(percentage < minimum):
-                            self._increaseHeartBeat = True
-                        if(percentage > (NUM_PIXELS - minimum)):
-                            self._increaseHeartBeat = False
-                            
-                        if(self._increaseHeartBeat):
-                            percentage += minimum
-                            self._increaseHeartBeat = False
-                        else:
-                            percentage -= minimum
-                            self._increaseHeartBeat = True
-                        self._lastHeartBeat = time.time()
-                except:
-                    percentage = 0
-            else:
-                percentage = 0
-            c_r[0:percentage] = bytearray(self._r[0:percentage])
-            c_g[0:percentage] = bytearray(self._g[0:percentage])
-            c_b[0:percentage] = bytearray(self._b[0:percentage])
+        previous = self._t
+        t = self._frame_time(t)
 
-        except AttributeError:
-            c_r = c_g = c_b = bytearray([0] * NUM_PIXELS)
+        if not (pygame.mixer.get_init() and pygame.mixer.music.get_busy()):
+            return self._frame.clear()
+
+        seconds = pygame.mixer.music.get_pos()/1000
+        dt = t - previous if previous is not None else 1 / PATTERN_FPS
+
+        features = None if self._features is None else audio.feature_at(self._features, seconds)
+
+        if features is not None:
+            self._spectrum.update(features["bands"], dt)
+        else:
+            # Window centred on the playback position
+            start = int(seconds * self._rate) - self._spectrum.fft_size // 2
+            self._spectrum.analyze(self._wav.window(start, self._spectrum.fft_size), dt)
+
+        self._spectrum.render(self._frame.back, self._gradient)
+
+        return self._frame.swap()
 
-        return c_r,c_g,c_b
-    
     def exit(self):
         if self._set:
-            self._wf.close()
+            import pygame
+
+            self._wav.close()
             print("Closed wave")
             pygame.quit()
 
+    def stats(self):
+        return self._spectrum.stats() if self._set else None
+
 class AudioMode(Mode):
-    def __init__(self):
-        self._chunk = 1024
-        self._format = pyaudio.paInt16
-        self._channels = 2
-        self._rate = 44100
-        #Low: 16383
-        #Medium: 32767
-        #High: 65534
-        #self._max = locked_data.shadow_state["microphone_max"]
-        self._dev_index = 0
-        
-        half_pixels = int(NUM_PIXELS/2)
+    def __init__(self, stick=None):
+        super().__init__(stick)
+
+        half_pixels = int(self._num_pixels/2)
         array1 = get_gradient_3d(half_pixels,1,(30,150,0),(255,242,0),(True,True,True))
-        array2 = get_gradient_3d((NUM_PIXELS - half_pixels),1,(255,242,0),(255,0,0),(True,True,True))
-        self._r = [int(val[0]) for val in array1[0]] + [int(val[0]) for val in array2[0]]
-        self._g = [int(val[1]) for val in array1[0]] + [int(val[1]) for val in array2[0]]
-        self._b = [int(val[2]) for val in array1[0]] + [int(val[2]) for val in array2[0]]
-        
-        self._p = pyaudio.PyAudio()
-        
-        for ii in range(self._p.get_device_count()):
-#             print(p.get_device_info_by_index(ii).get('name'))
-            dev = self._p.get_device_info_by_index(ii)
-            if(dev['maxInputChannels']>1):
-                print('Using the first compatible audio device detected:')
-                print((ii,dev['name'],dev['maxInputChannels']))
-                self._dev_index = ii
-#                 if(dev['maxInputChannels']>1):
-#                     self._channels = 2
-                break
-            
-        self._stream = self._p.open(format = self._format,
-                              channels = self._channels,
-                              input_device_index = self._dev_index,
-                              rate = self._rate,
-                              input = True,
-                              output = True,
-                              frames_per_buffer=self._chunk
-                              )
-
-    def run(self):
+        array2 = get_gradient_3d((self._num_pixels - half_pixels),1,(255,242,0),(255,0,0),(True,True,True))
+        self._gradient = np.concatenate((array1[0], array2[0])).astype(np.uint8)
+
+        # Captured in the background and kept open across mode switches, see audio.Microphone
+        self._microphone = get_microphone()
+        self._spectrum = Spectrum(audio.MIC_RATE, self._num_pixels)
+
+    def run(self, t=None):
 #         colors = locked_data.shadow_state["colors"]
 #         color = Color(colors[0]) if len(colors) > 0 and len(colors[0]) == 6 else Color()
-        c_r = bytearray([0] * NUM_PIXELS)
-        c_g = bytearray([0] * NUM_PIXELS)
-        c_b = bytearray([0] * NUM_PIXELS)
-        
-        sound = 0
-        for i in range(0,2):
-            data = self._stream.read(self._chunk)
-            reading = audioop.max(data,2)
-            sound += reading
-            # time.sleep(.0001)
-        microphone_max = locked_data.shadow_state["microphone_max"]
-        if(len(data) > 0):
-            percentage = int(sound/microphone_max * NUM_PIXELS)
-#             print(percentage)
-            c_r[0:percentage] = bytearray(self._r[0:percentage])
-            c_g[0:percentage] = bytearray(self._g[0:percentage])
-            c_b[0:percentage] = bytearray(self._b[0:percentage])
+        previous = self._t
+        t = self._frame_time(t)
+
+        if self._microphone is None:
+            return self._frame.clear()
+
+        # Levels are scaled by the spectrum's AGC, the web app's sensitivity shifts them on top of it
+        self._spectrum.gain_db = microphone_gain(self._stick.shadow_state.get("microphone_max"))
+        dt = t - previous if previous is not None else 1 / PATTERN_FPS
+        self._spectrum.analyze(self._microphone.buffer.latest(self._spectrum.fft_size), dt)
+        self._spectrum.render(self._frame.back, self._gradient)
         
-        return c_r,c_g,c_b
+        return self._frame.swap()
         
     def exit(self):
-#         pass
-        self._stream.stop_stream()
-        self._stream.close()
-        print("Closed stream")
-        self._p.terminate()
-        print("PyAudio Terminated")
+        pass
+
+    def stats(self):
+        return None if self._microphone is None else dict(self._spectrum.stats(), overflows=self._microphone.overflows)
+
 
+# Decibels of gain for the web app's microphone_max, the level that used to fill the strip: 32767 for 1x, half that for 2x
+def microphone_gain(microphone_max):
+    if not microphone_max or microphone_max <= 0:
+        return 0.0
+
+    return 20 * math.log10(32767 / microphone_max)
 
 class BasicMode(Mode):
-    def __init__(self):
+    def __init__(self, stick=None):
+        super().__init__(stick)
         self._pattern_id = None
         self._pattern = None
 
-    def run(self):
+    def run(self, t=None):
         self._get_pattern()
+        self._pattern.render(self._frame.back, self._frame_time(t))
 
-        return self._pattern.render()
+        return self._frame.swap()
 
     def exit(self):
         pass
 
     def _get_pattern(self):
-        new_pattern_id = locked_data.shadow_state["pattern"]
+        new_pattern_id = self._stick.shadow_state["pattern"]
 
         # If pattern has actually changed
         if new_pattern_id != self._pattern_id:
-            if new_pattern_id == 1:
-                self._pattern = SolidPattern()
-            elif new_pattern_id == 2:
-                self._pattern = DotPattern()
-            elif new_pattern_id == 3:
-                self._pattern = BlinkPattern()
-            elif new_pattern_id == 4:
-                self._pattern = BreathePattern()
-            elif new_pattern_id == 5:
-                self._pattern = RainbowPattern()
-            elif new_pattern_id == 6:
-                self._pattern = WavePattern()
-            else:
-                self._pattern = NullPattern()
-
+            self._pattern = pattern_registry.get(new_pattern_id, NullPattern)(self._stick)
             self._pattern_id = new_pattern_id
 
 class ImageMode(Mode):
-    def __init__(self):
+    def __init__(self, stick=None):
+        super().__init__(stick)
         self._set = True
+        self._rows_clock = None
 
-        if not os.path.exists("image"):
+        filename = self._stick.path("image")
+
+        if not os.path.exists(filename):
             self._set = False
             return
 
-        # Load and resize image
-        im = Image.open("image")
+        # Rows -> Pixels -> Channels, resized to the strip and decoded on a background thread
+        self._stream = images.ImageStream(filename, self._num_pixels, IMAGE_CACHE_DIR)
+        self._rows = None # Chunk of rows or animation frame being shown
+        self._row = 0
+        self._duration = None # How long to show an animation frame for, None for still images
+        self._start = None # When the animation frame started showing
 
-        if im.mode == "P":
-            im = im.convert("RGB")
+        # Persistence of vision: rows follow the swing of the stick on their own thread instead of the render loop
+        if POV_ROW_DEGREES > 0:
+            self.publishes_frames = True
+            self._swing = SwingTracker()
+            self._stick.sensor_listeners.append(self._swing.on_samples)
 
-        # Resize image while keeping aspect ratio if image width is larger than NUM_PIXELS
-        if im.width > NUM_PIXELS:
-            ratio = im.height / im.width
-            im = im.resize((NUM_PIXELS, max(1, round(NUM_PIXELS * ratio))))
+            self._rows_clock = RowClock(self._emit_row, self._swing, math.radians(POV_ROW_DEGREES), TARGET_FPS, POV_MAX_ROW_RATE)
+            self._rows_clock.start()
 
-        rows = [] # 3D-Array: Rows -> Channels -> Color
+    def run(self, t=None):
+        if self._rows_clock is not None:
+            return self._frame.channels
 
-        for y in range(im.height):
-            rows.append([]) # Initialize row arrays
+        if not self._set or not self._next_row(self._frame_time(t)):
+            return self._frame.clear()
 
-            for c in range(3):
-                rows[y].append([]) # Initialize channel arrays
+        return self._frame.swap()
 
-            # Fill channel arrays with color data
-            for x in range(NUM_PIXELS):
-                if x < im.width:
-                    colors = im.getpixel((x, y))
+    # Called by the row clock for every row, on its thread
+    def _emit_row(self):
+        if not self._next_row(time.perf_counter()):
+            self._frame.back.fill(0)
 
-                    for c in range(3):
-                        rows[y][c].append(colors[c])
+        self._frame.swap()
+        self._stick.publish(self._frame.front)
 
-                else:
-                    for c in range(3):
-                        rows[y][c].append(0)
+    # Copy the row for time t into the back buffer and move on to the next one, False if there is none yet
+    def _next_row(self, t):
+        if self._rows is None or self._chunk_done(t):
+            chunk = self._stream.next()
 
-        im.close()
+            # Otherwise the decoder fell behind, keep showing the current chunk
+            if chunk is not None:
+                self._show(chunk, t)
 
-        self._rows = rows
-        self._row = 0
+        if self._rows is None:
+            return False
 
-    def run(self):
-        if self._set:
-            c_r = bytearray(self._rows[self._row][0])
-            c_g = bytearray(self._rows[self._row][1])
-            c_b = bytearray(self._rows[self._row][2])
+        self._frame.back[:] = self._rows[min(self._row, len(self._rows) - 1)]
 
-            self._row += 1
+        self._row += 1
 
-            if self._row >= len(self._rows):
-                self._row = 0
+        # Animation frames are swept over and over until their time is up
+        if self._duration is not None:
+            self._row %= len(self._rows)
 
+        return True
+
+    def _chunk_done(self, t):
+        if self._duration is None:
+            return self._row >= len(self._rows)
+
+        return t - self._start >= self._duration
+
+    def _show(self, chunk, t):
+        rows, duration = chunk
+
+        # Start animation frames where the previous one ended, so frame times don't drift with the render rate
+        if self._duration is not None and duration is not None and t - self._start - self._duration < duration:
+            self._start += self._duration
         else:
-            c_r = c_g = c_b = bytearray([0] * NUM_PIXELS)
+            self._start = t
 
-        return c_r, c_g, c_b
+        self._rows, self._duration, self._row = rows, duration, 0
 
     def exit(self):
-        pass
+        if self._rows_clock is not None:
+            self._rows_clock.stop()
+            self._stick.sensor_listeners.remove(self._swing.on_samples)
+
+        if self._set:
+            self._stream.close()
+
+    def stats(self):
+        return self._rows_clock.stats() if self._rows_clock is not None else None
 
 class LightsaberMode(Mode):
-    
-    def __init__(self):
-        self._value = Value("f", 0)
+    # Limit to 30 frames per second
+    fps = 30
+
+    def __init__(self, stick=None):
+        super().__init__(stick)
+        self._value = self._stick.sensor_value
+        # Every IMU sample goes through clash and swing detection on its own thread
+        self._gestures = GestureEngine()
+        self._stick.sensor_listeners.append(self._gestures.on_samples)
+        # Every IMU sample is summarised too, and the publish thread sends one summary per window
+        self._telemetry = TelemetryWindow(TELEMETRY_SERIES)
+        self._stick.sensor_listeners.append(self._telemetry.on_samples)
         self._thread = None
         self._phase = 0
         self._pixels = 0
@@ -413,24 +529,35 @@ class LightsaberMode(Mode):
 #         self._values = self._value_file.read().split("|")
 #         self._tracker = 0
 #         self._stime = 0
-        self._last_val = 0
-        self._consequtive_val = 0
+
+        import pygame
         pygame.mixer.init()
         pygame.mixer.set_num_channels(4)
         
         self._direct = "./saber-sounds/"
-        self._start_sound = self._direct+ "saber-on.wav"
-        self._idle_sound = self._direct + "saber-idle.wav"
-        self._clash_sounds = ["saber-clash1.wav","saber-clash2.wav","saber-clash3.wav","saber-clash4.wav"]
-        self._swing_sound = self._direct + "saber-swing.wav"
+
+        # Decoded once here, so run() only ever plays them
+        self._sounds = audio.SoundBank(self._direct)
+        self._start_sound = self._sounds["saber-on.wav"]
+        self._start_length = self._sounds.durations["saber-on.wav"] * 1000
+        self._started = None # When the start sound started playing
+        self._idle_sound = self._sounds["saber-idle.wav"]
+        self._clash_sounds = [self._sounds[name] for name in ["saber-clash1.wav","saber-clash2.wav","saber-clash3.wav","saber-clash4.wav"]]
+        self._swing_sound = self._sounds["saber-swing.wav"]
+        self._channels = [pygame.mixer.Channel(i) for i in range(4)] # Idle, clash, swing, start
         
 
-    def run(self):
-        val = self._value.value
+    def run(self, t=None):
+        import pygame
+
+        # Gestures detected since the last frame
+        events = self._gestures.events()
+        clash = any(event.kind == gestures.CLASH for event in events)
+        swing = any(event.kind == gestures.SWING for event in events)
+        self._telemetry.add_clashes(sum(event.kind == gestures.CLASH for event in events))
 
-        c_r = bytearray([0] * NUM_PIXELS)
-        c_g = bytearray([0] * NUM_PIXELS)
-        c_b = bytearray([0] * NUM_PIXELS)
+        frame = self._frame.back
+        frame.fill(0)
         
 #         colors=['0000ff']
         colors = self._get_colors()
@@ -439,12 +566,12 @@ class LightsaberMode(Mode):
         
         if self._thread == None:
             print("Starting publish thread... ", end="")
-            self._thread = threading.Thread(target=publish_sensors_data, args=(self._value,))
+            self._thread = threading.Thread(target=publish_sensors_data, args=(self._stick, self._telemetry))
             self._thread.start()
             print("Started.")
 
         if(self._phase == 1):
-            self._pixels = NUM_PIXELS
+            self._pixels = self._num_pixels
 #             value = float(self._values[self._tracker])
 #             if(self._tracker < len(self._values)-1):
 #                 self._tracker += 1
@@ -453,77 +580,65 @@ class LightsaberMode(Mode):
                 
 #             print (value)
             
-            clash_channel = pygame.mixer.Channel(1)
-            swing_channel = pygame.mixer.Channel(2)
-            swing_sound = pygame.mixer.Sound(self._swing_sound)
-            clash_sound = pygame.mixer.Sound(self._direct + random.choice(self._clash_sounds))
+            clash_channel = self._channels[1]
+            swing_channel = self._channels[2]
+            swing_sound = self._swing_sound
+            clash_sound = random.choice(self._clash_sounds)
 #             if (self._last_val < value):
 #             if channel.get_busy():
 #                 pass
 #             else:
-            if(val > 21):
+            if(clash):
                 if(clash_channel.get_busy()):
                     pass
                 else:
                     clash_channel.play(clash_sound)
                     colors = ['ffffff']
-            elif(val > 11):
+            elif(swing):
+                # One event per swing, the detector's refractory window keeps it from retriggering
                 if(clash_channel.get_busy() or swing_channel.get_busy()):
                     pass
                 else:
-                    if(self._consequtive_val == 0):
-                        swing_channel.play(swing_sound)
-                        
-                    if(self._consequtive_val >= 3):
-                        swing_channel.play(swing_sound)
-                        self._consequtive_val = 0
-                    
-                    if(val >0.0 and abs(val - self._last_val)<=3):
-                        self._consequtive_val += 1
-                    else:
-                        self._consequtive_val = 0
-                        
-        #             print("Consequtive:",self._consequtive_val)
-                    self._last_val = val
+                    swing_channel.play(swing_sound)
             else:
                 pass
                       
             
         if(self._phase == 0):
-            song_length = librosa.get_duration(filename=self._start_sound) * 1000
-            if pygame.mixer.music.get_busy():
-                self._pixels = int((pygame.mixer.music.get_pos()/song_length)*NUM_PIXELS)
+            song_length = self._start_length
+            # Played from the bank rather than streamed from disk, so its position comes from when it started
+            position = None if self._started is None else (time.perf_counter() - self._started) * 1000
+            if position is not None and position < song_length:
+                self._pixels = int((position/song_length)*self._num_pixels)
                 
-                if (pygame.mixer.music.get_pos() > int(song_length*0.95)):
-                    channel = pygame.mixer.Channel(0)
-                    sound = pygame.mixer.Sound(self._idle_sound)
-                    channel.play(sound,loops = -1)
+                # Start the idle hum once, rather than restarting it every frame until the start sound ends
+                if (position > int(song_length*0.95)) and not self._channels[0].get_busy():
+                    self._channels[0].play(self._idle_sound,loops = -1)
             else:
-                if(self._pixels == 0):
-                    pygame.mixer.music.load(self._start_sound)
-                    pygame.mixer.music.play()
-#                     self._stime = time.time()
+                if(self._started is None):
+                    self._channels[3].play(self._start_sound)
+                    self._started = time.perf_counter()
                 else:
 #                     idle = pygame.mixer.music.load(direct+ "saber-idle.wav")
 #                     pygame.mixer.music.play(loops=-1)
-                    self.pixels = NUM_PIXELS
+                    self.pixels = self._num_pixels
                     self._phase = 1
                     
 #         print(pygame.mixer.music.get_pos())        
-        if(self._pixels > NUM_PIXELS):
-            self._pixels = NUM_PIXELS
+        if(self._pixels > self._num_pixels):
+            self._pixels = self._num_pixels
                 
         color = Color(colors[0]) if len(colors) > 0 and len(colors[0]) == 6 else Color()
-        c_r[0:self._pixels] = bytearray([color.r] * self._pixels)
-        c_g[0:self._pixels] = bytearray([color.g] * self._pixels)
-        c_b[0:self._pixels] = bytearray([color.b] * self._pixels)
+        frame[0:self._pixels] = color.rgb
         
-        # Limit to 30 frames per second
-        time.sleep(0.034)
-        return c_r, c_g, c_b
+        return self._frame.swap()
     
     def exit(self):
 #         self._value_file.close()
+        self._stick.sensor_listeners.remove(self._gestures.on_samples)
+        self._stick.sensor_listeners.remove(self._telemetry.on_samples)
+        self._gestures.stop()
+
         if self._thread != None:
             print("Stopping publish thread... ", end="")
 
@@ -533,6 +648,9 @@ class LightsaberMode(Mode):
             self._thread = None
             print("Stopped publish thread.")
 
+    def stats(self):
+        return self._gestures.stats()
+
     @property
     def value(self):
         return self._value.value
@@ -542,167 +660,178 @@ class LightsaberMode(Mode):
         self._value.value = value
 
 class Pattern(ABC):
+    def __init__(self, stick=None):
+        self._stick = stick or default_stick
+        self._num_pixels = self._stick.num_pixels
+
+    # Render the frame for time t, in seconds, in place into a (num_pixels, 3) uint8 array
     @abstractmethod
-    def render(self):
+    def render(self, frame, t):
         pass
 
     def _get_colors(self):
-        return locked_data.shadow_state["colors"]
+        return self._stick.shadow_state["colors"]
+
+# Pattern that repeats every period frames, drawn as a stack of kernel layers.
+#
+# The frame shown at time t is the step of the cycle reached at PATTERN_FPS
+# since the pattern first rendered, so the animation runs at the same speed
+# whatever the render rate, late frames skip ahead and frames can be rendered
+# for any time. A whole cycle is rendered once into a table in frame_cache,
+# keyed by (pattern_id, colors, num_pixels), and every frame after that is a
+# copy out of the table. The colors are part of the key, so a change of the
+# shadow colors builds a new table, and render() drops the tables of colors
+# no stick is showing any more. Plugins without a pattern_id are keyed by
+# their class. Cycles too large for the cache are composited frame by frame
+# instead.
+class CyclePattern(Pattern):
+    pattern_id = None
+    uses_colors = True
+
+    def __init__(self, stick=None):
+        super().__init__(stick)
+        self._start = None
+        self._key = None
+        self._table = None
+        self._compositor = None
+
+    # Length of the cycle in frames
+    @property
+    @abstractmethod
+    def period(self):
+        pass
+
+    # Layers drawing the pattern, colors being the parsed Colors
+    @abstractmethod
+    def _layers(self, colors):
+        pass
+
+    def render(self, frame, t):
+        colors = tuple(self._get_colors()) if self.uses_colors else ()
+        key = (self.pattern_id or type(self), colors, self._num_pixels)
+
+        if key != self._key:
+            colors = [Color(c) if len(c) == 6 else Color() for c in colors]
+            self._compositor = Compositor(self._num_pixels, self._layers(colors))
+            self._table = frame_cache.get(key, self._render_cycle, self.period * self._num_pixels * 3)
+            self._key = key
+
+        if self._start is None:
+            self._start = t
+
+        # Nearest step, so frames rendered on schedule never repeat or skip one to timer jitter
+        step = round((t - self._start) * PATTERN_FPS) % self.period
+
+        if self._table is not None:
+            frame[:] = self._table[step]
+        else:
+            self._compositor.render(frame, step)
+
+    def _render_cycle(self):
+        table = np.empty((self.period, self._num_pixels, 3), dtype=np.uint8)
+
+        for step in range(self.period):
+            self._compositor.render(table[step], step)
+
+        return table
+
+    @staticmethod
+    def _color(colors, i=0):
+        return colors[i] if len(colors) > 0 else Color()
 
 class NullPattern(Pattern):
-    def render(self):
-        c_r = c_g = c_b = bytearray([0] * NUM_PIXELS)
+    def render(self, frame, t):
+        frame.fill(0)
 
-        return c_r, c_g, c_b
+class SolidPattern(CyclePattern):
+    pattern_id = 1
 
-class SolidPattern(Pattern):
-    def render(self):
-        colors = self._get_colors()
+    @property
+    def period(self):
+        return 1
 
-        color = Color(colors[0]) if len(colors) > 0 and len(colors[0]) == 6 else Color()
+    def _layers(self, colors):
+        rgb = self._color(colors).rgb
 
-        c_r = bytearray([color.r] * NUM_PIXELS)
-        c_g = bytearray([color.g] * NUM_PIXELS)
-        c_b = bytearray([color.b] * NUM_PIXELS)
+        return [Layer(lambda layer, step: kernels.fill(layer, rgb))]
 
-        return c_r, c_g, c_b
+# Dot bouncing from one end of the strip to the other
+class DotPattern(CyclePattern):
+    pattern_id = 2
 
-class DotPattern(Pattern):
-    def __init__(self):
-        self._i = 0
-        self._dir = 1
+    @property
+    def period(self):
+        return max(2 * (self._num_pixels - 1), 1)
 
-    def render(self):
-        colors = self._get_colors()
+    def _layers(self, colors):
+        rgb = self._color(colors).rgb
 
-        color = Color(colors[0]) if len(colors) > 0 and len(colors[0]) == 6 else Color()
+        return [Layer(lambda layer, step: kernels.dot(layer, kernels.bounce(step, self._num_pixels), rgb))]
 
-        c_r = bytearray([0] * NUM_PIXELS)
-        c_g = bytearray([0] * NUM_PIXELS)
-        c_b = bytearray([0] * NUM_PIXELS)
+# Second color filling the strip and receding again
+class WavePattern(CyclePattern):
+    pattern_id = 6
 
-        c_r[self._i] = color.r
-        c_g[self._i] = color.g
-        c_b[self._i] = color.b
+    @property
+    def period(self):
+        return 2 * self._num_pixels
 
-        if self._i >= NUM_PIXELS - 1:
-            self._dir = -1
+    def _layers(self, colors):
+        rgb0 = self._color(colors).rgb
+        rgb1 = self._color(colors, -1).rgb
 
-        if self._i <= 0:
-            self._dir = 1
+        return [
+            Layer(lambda layer, step: kernels.fill(layer, rgb0)),
+            Layer(lambda layer, step: kernels.fill_range(layer, 0, kernels.bounce(step, self._num_pixels + 1), rgb1)),
+        ]
 
-        self._i += self._dir
+# Fade in and out in steps of a tenth, holding full brightness for two frames
+class BreathePattern(CyclePattern):
+    pattern_id = 4
 
-        return c_r, c_g, c_b
-        
-class WavePattern(Pattern):
-    def __init__(self):
-        self._i = 0
-        self._ascending = True
-        
-    def render(self):
-        colors = self._get_colors()
+    LEVELS = np.concatenate((np.arange(11), [10], np.arange(9, -1, -1))) / 10
 
-        color0 = Color(colors[0]) if len(colors[0]) == 6 else Color()
-        color1 = Color(colors[-1]) if len(colors[-1]) == 6 else Color()
-        c_r = bytearray([color0.r] * NUM_PIXELS)
-        c_g = bytearray([color0.g] * NUM_PIXELS)
-        c_b = bytearray([color0.b] * NUM_PIXELS)
-        
-        c_r[0:self._i] = bytearray([color1.r] * self._i)
-        c_g[0:self._i] = bytearray([color1.g] * self._i)
-        c_b[0:self._i] = bytearray([color1.b] * self._i)
-        
-        if self._ascending:
-            self._i += 1
-        else:
-            self._i -= 1
+    @property
+    def period(self):
+        return len(BreathePattern.LEVELS)
 
-        if self._i >= NUM_PIXELS and self._ascending:
-            self._ascending = False
-        if self._i == 0 and not self._ascending:
-            self._ascending = True
+    def _layers(self, colors):
+        rgb = self._color(colors).rgb
 
-        return c_r, c_g, c_b
+        return [
+            Layer(lambda layer, step: kernels.fill(layer, rgb)),
+            Layer(lambda layer, step: kernels.fill(layer, 255 * BreathePattern.LEVELS[step]), "multiply"),
+        ]
 
-class BreathePattern(Pattern):
-    def __init__(self):
-        self._mult = 0
-        self._fade_in = True
+# Three frames on, three frames off
+class BlinkPattern(CyclePattern):
+    pattern_id = 3
 
-    def render(self):
-        colors = self._get_colors()
+    @property
+    def period(self):
+        return 6
 
-        color = Color(colors[0]) if len(colors) > 0 and len(colors[0]) == 6 else Color()
+    def _layers(self, colors):
+        rgb = self._color(colors).rgb
 
-        c_r = bytearray([round(color.r * self._mult)] * NUM_PIXELS)
-        c_g = bytearray([round(color.g * self._mult)] * NUM_PIXELS)
-        c_b = bytearray([round(color.b * self._mult)] * NUM_PIXELS)
-        
-        if self._fade_in:
-            self._mult += 0.1
-        else:
-            self._mult -= 0.1
-        
-        if self._mult >= 1.0 and self._fade_in:
-            self._mult = 1.0
-            self._fade_in = False
-            
-        if self._mult <= 0.0 and not self._fade_in:
-            self._mult = 0.0
-            self._fade_in = True
+        return [
+            Layer(lambda layer, step: kernels.fill(layer, rgb)),
+            Layer(lambda layer, step: kernels.fill(layer, 255 if step < 3 else 0), "multiply"),
+        ]
 
-        return c_r, c_g, c_b
-    
-class BlinkPattern(Pattern):
-    def __init__(self):
-        self._all_up = True
-        self._count = 0
-        self._threshold = 3
+# Rainbow rotating one pixel further along the strip every frame
+class RainbowPattern(CyclePattern):
+    pattern_id = 5
+    uses_colors = False
 
-    def render(self):
-        colors = self._get_colors()
+    @property
+    def period(self):
+        return self._num_pixels
 
-        selected = Color(colors[0]) if len(colors) > 0 and len(colors[0]) == 6 else Color()
-        
-        if self._all_up:
-            color = selected
-        else:
-            color = Color()
-        self._count += 1
-        
-        if self._count >= self._threshold:
-            self._all_up = not self._all_up
-            self._count = 0
-        
-        c_r = bytearray([color.r] * NUM_PIXELS)
-        c_g = bytearray([color.g] * NUM_PIXELS)
-        c_b = bytearray([color.b] * NUM_PIXELS)
-        
-        return c_r, c_g, c_b
-    
-class RainbowPattern(Pattern):
-    def __init__(self):
-        rainbow = [ hls_to_rgb(1 * i/(NUM_PIXELS-1), 0.5, 1) for i in range(NUM_PIXELS) ]
-        self._r_vals = []
-        self._g_vals = []
-        self._b_vals = []
-        for colors in rainbow:
-            self._r_vals.append(int(colors[0]*255))
-            self._g_vals.append(int(colors[1]*255))
-            self._b_vals.append(int(colors[2]*255))
-
-    def render(self):
-        c_r = bytearray(self._r_vals)
-        c_g = bytearray(self._g_vals)
-        c_b = bytearray(self._b_vals)
-        
-        self._r_vals.insert(0,self._r_vals.pop())
-        self._b_vals.insert(0,self._b_vals.pop())
-        self._g_vals.insert(0,self._g_vals.pop())
-                 
-        return c_r, c_g, c_b
-        
+    def _layers(self, colors):
+        rainbow = kernels.hsv_ramp(self._num_pixels)
+
+        return [Layer(lambda layer, step: kernels.rotate(layer, rainbow, step))]
 
 # Function for gracefully quitting
 def exit(msg_or_exception):
@@ -713,32 +842,50 @@ def exit(msg_or_exception):
         print("Exiting:", msg_or_exception)
 
     print("Disconnecting... ", end="")
-    if mode != None:
-        mode.exit()
+    for stage in stages:
+        stage.stop()
+
+    node_server.stop()
+
+    for group in render_groups.values():
+        group.exit()
 
-    for s in sockets:
-        s.close()
+    if microphone is not None:
+        microphone.close()
+
+    # Whatever is still journaled is sent after the next start
+    if telemetry_drainer is not None:
+        telemetry_drainer.stop()
+        telemetry_drainer.journal.close()
 
     future = mqtt_connection.disconnect()
     future.add_done_callback(on_disconnected)
 
+# Report an error in a callback the edge can carry on after, rather than exiting
+def report(msg_or_exception):
+    if isinstance(msg_or_exception, Exception):
+        print("Error, carrying on.")
+        traceback.print_exception(msg_or_exception.__class__, msg_or_exception, msg_or_exception.__traceback__)
+    else:
+        print("Error, carrying on:", msg_or_exception)
+
 def on_disconnected(disconnect_future):
     # type: (Future) -> None
     print("Disconnected.")
     is_done.set()
 
-def on_get_shadow_accepted(response):
-    # type: (iotshadow.GetShadowResponse) -> None
+def on_get_shadow_accepted(stick, response):
+    # type: (Stick, iotshadow.GetShadowResponse) -> None
     try:
         is_update = False
 
-        print("Finished getting initial shadow state.")
+        print("Finished getting initial shadow state of %s." % stick.name)
 
         if response.state.reported:
             print("  Shadow reported state: ", end="")
             print(json.dumps(response.state.reported))
 
-            change_local_state(response.state.reported)
+            change_local_state(stick, response.state.reported)
         else:
             is_update = True
 
@@ -747,55 +894,55 @@ def on_get_shadow_accepted(response):
             print("  Shadow delta: ", end="")
             print(json.dumps(delta))
 
-            change_local_state(delta)
+            change_local_state(stick, delta)
 
             if ("upload_image" in delta):
-                start_download_thread("image")
+                start_download_thread(stick, "image")
 
             if ("upload_audio" in delta):
-                start_download_thread("audio")
+                start_download_thread(stick, "audio")
 
             is_update = True
 
         if is_update:
             print("  Shadow state has changed/does not exist.")
 
-            change_shadow_state()
+            change_shadow_state(stick)
 
     except Exception as e:
-        exit(e)
+        report(e)
 
-def on_get_shadow_rejected(error):
-    # type: (iotshadow.ErrorResponse) -> None
+def on_get_shadow_rejected(stick, error):
+    # type: (Stick, iotshadow.ErrorResponse) -> None
     if error.code == 404:
-        print("Thing has no shadow document.")
-        change_shadow_state()
+        print("Thing %s has no shadow document." % stick.name)
+        change_shadow_state(stick)
     else:
-        exit("Get request was rejected. code:{} message:'{}'".format(
+        report("Get request was rejected. code:{} message:'{}'".format(
             error.code, error.message))
 
-def on_shadow_delta_updated(delta):
-    # type: (iotshadow.ShadowDeltaUpdatedEvent) -> None
+def on_shadow_delta_updated(stick, delta):
+    # type: (Stick, iotshadow.ShadowDeltaUpdatedEvent) -> None
     try:
-        print("Received shadow delta event.")
+        print("Received shadow delta event for %s." % stick.name)
         if delta.state:
             print("  Delta reports desired values are: ", end="")
             print(json.dumps(delta.state))
 
-            change_local_state(delta.state)
+            change_local_state(stick, delta.state)
 
             if ("upload_image" in delta.state):
-                start_download_thread("image")
+                start_download_thread(stick, "image")
 
             if ("upload_audio" in delta.state):
-                start_download_thread("audio")
+                start_download_thread(stick, "audio")
 
-            change_shadow_state()
+            change_shadow_state(stick)
         else:
             print("  Delta did not report a change.")
 
     except Exception as e:
-        exit(e)
+        report(e)
 
 def on_publish_update_shadow(future):
     #type: (Future) -> None
@@ -804,7 +951,7 @@ def on_publish_update_shadow(future):
         print("Update request published.")
     except Exception as e:
         print("Failed to publish update request.")
-        exit(e)
+        report(e)
 
 def on_update_shadow_accepted(response):
     # type: (iotshadow.UpdateShadowResponse) -> None
@@ -812,65 +959,123 @@ def on_update_shadow_accepted(response):
         print("Finished updating reported shadow state to: ", end="")
         print(json.dumps(response.state.reported))
     except:
-        exit("Updated shadow is missing the target property.")
+        report("Updated shadow is missing the target property.")
 
 def on_update_shadow_rejected(error):
     # type: (iotshadow.ErrorResponse) -> None
-    exit("Update request was rejected. code:{} message:'{}'".format(
+    report("Update request was rejected. code:{} message:'{}'".format(
         error.code, error.message))
 
-def download_file(file_type):
-    global mode, mode_id
-    key = THING_NAME + "/" + file_type
+def download_file(stick, file_type):
+    key = stick.name + "/" + file_type
+
+    if stick.directory:
+        os.makedirs(stick.directory, exist_ok=True)
 
-    print("Downloading %s... " % file_type, end="")
-    s3.download_file(S3_BUCKET, key, file_type)
+    print("Downloading %s for %s... " % (file_type, stick.name), end="")
+    s3.download_file(S3_BUCKET, key, stick.path(file_type))
     print("Download completed.")
 
-    # Reset mode to load in newly downloaded image
-    if mode_id == 2 and file_type == "image":
-        mode.exit()
-        mode = ImageMode()
+    if file_type == "audio":
+        prepare_audio(stick.path(file_type))
+
+    # Have the render stage reset the mode to load in the newly downloaded file
+    if (stick.mode_id == 2 and file_type == "image") or (stick.mode_id == 3 and file_type == "audio"):
+        stick.reload.set()
 
-    elif mode_id == 3 and file_type == "audio":
-        mode.exit()
-        mode = MusicMode()
+microphone = None
 
-def start_download_thread(file_type):
-    thread = threading.Thread(target=download_file, args=(file_type,))
+# The microphone, started on first use and kept running from then on. None if it can't be opened.
+def get_microphone():
+    global microphone
+
+    if microphone is None:
+        microphone = audio.Microphone()
+
+    try:
+        microphone.start()
+
+    except Exception as e:
+        print("Could not open microphone: %r" % e)
+        return None
+
+    return microphone
+
+# Transcode and analyse a downloaded track for MusicMode, see audio.prepare()
+def prepare_audio(filename, on_ready=None):
+    print("Preparing %s... " % filename, end="")
+
+    try:
+        start = time.perf_counter()
+        audio.prepare(filename, AUDIO_CACHE_DIR)
+        print("Ready in %.1f s." % (time.perf_counter() - start))
+
+    except Exception as e:
+        print("Failed: %r" % e)
+        return
+
+    if on_ready is not None:
+        on_ready()
+
+def start_download_thread(stick, file_type):
+    thread = threading.Thread(target=download_file, args=(stick, file_type))
     thread.start()
 
-def publish_sensors_data(v):
+# Publish a summary of telemetry every TELEMETRY_WINDOW seconds until the thread's is_run is cleared, then the last partial window
+def publish_sensors_data(stick, telemetry):
     t = threading.currentThread()
-    while getattr(t, "is_run", True):
-        topic = "lightstick/" + THING_NAME + "/data"
+    topic = "lightstick/" + stick.name + "/data"
+    deadline = time.monotonic()
+    running = True
+
+    while running:
+        deadline += TELEMETRY_WINDOW
+
+        # Check for stopping every so often rather than sleeping through the whole window
+        while getattr(t, "is_run", True) and time.monotonic() < deadline:
+            time.sleep(min(0.1, max(0, deadline - time.monotonic())))
+
+        running = getattr(t, "is_run", True)
+        summary = telemetry.summary()
+
+        # Nothing to report while the node is silent
+        if summary is None:
+            continue
+
+        # acceleration and is_clash stay for the web app, the peak and any clash of the window
         payload = {
-            "acceleration": v.value,
-            "is_clash": v.value > 21
+            "acceleration": summary["max"],
+            "is_clash": summary["clashes"] > 0,
+            "summary": summary
         }
 
-        mqtt_connection.publish(
-            topic=topic,
-            payload=json.dumps(payload),
-            qos=mqtt.QoS.AT_LEAST_ONCE)
-
-        time.sleep(1)
+        # Journaled first, so it isn't lost while the connection is down
+        telemetry_drainer.append(topic, json.dumps(payload))
 
     print("Stopped publish thread.")
 
-def change_local_state(new_state):
-    with locked_data.lock:
+# Publish for the telemetry drainer, returning a future resolved once the broker acknowledges the message
+def publish_telemetry(topic, payload):
+    future, _ = mqtt_connection.publish(
+        topic=topic,
+        payload=payload,
+        qos=mqtt.QoS.AT_LEAST_ONCE)
+
+    return future
+
+def change_local_state(stick, new_state):
+    with stick.locked_data.lock:
         for p in new_state:
-            locked_data.shadow_state[p] = new_state[p]
+            stick.shadow_state[p] = new_state[p]
 
-def change_shadow_state():
-    print("Updating reported shadow value...")
+def change_shadow_state(stick):
+    print("Updating reported shadow value of %s..." % stick.name)
     reported = {}
-    with locked_data.lock:
-        reported = locked_data.shadow_state
+    with stick.locked_data.lock:
+        reported = stick.shadow_state
 
     request = iotshadow.UpdateShadowRequest(
-        thing_name=THING_NAME,
+        thing_name=stick.name,
         state=iotshadow.ShadowState(
             reported=reported,
         )
@@ -879,152 +1084,230 @@ def change_shadow_state():
     future.add_done_callback(on_publish_update_shadow)
     print("Change requested")
 
+def subscribe_to_shadow(stick):
+    # Subscribe to topics: delta, update_success, update_rejected, get_success, get_rejected
+    print("Subscribing to Delta events of %s... " % stick.name, end="")
+    delta_subscribed_future, _ = shadow_client.subscribe_to_shadow_delta_updated_events(
+        request=iotshadow.ShadowDeltaUpdatedSubscriptionRequest(thing_name=stick.name),
+        qos=mqtt.QoS.AT_LEAST_ONCE,
+        callback=partial(on_shadow_delta_updated, stick))
+
+    # Wait for subscription to succeed
+    delta_subscribed_future.result()
+    print("Subscribed.")
+
+    print("Subscribing to Update responses... ", end="")
+    update_accepted_subscribed_future, _ = shadow_client.subscribe_to_update_shadow_accepted(
+        request=iotshadow.UpdateShadowSubscriptionRequest(thing_name=stick.name),
+        qos=mqtt.QoS.AT_LEAST_ONCE,
+        callback=on_update_shadow_accepted)
+
+    update_rejected_subscribed_future, _ = shadow_client.subscribe_to_update_shadow_rejected(
+        request=iotshadow.UpdateShadowSubscriptionRequest(thing_name=stick.name),
+        qos=mqtt.QoS.AT_LEAST_ONCE,
+        callback=on_update_shadow_rejected)
+
+    # Wait for subscriptions to succeed
+    update_accepted_subscribed_future.result()
+    update_rejected_subscribed_future.result()
+    print("Subscribed.")
+
+    print("Subscribing to Get responses... ", end="")
+    get_accepted_subscribed_future, _ = shadow_client.subscribe_to_get_shadow_accepted(
+        request=iotshadow.GetShadowSubscriptionRequest(thing_name=stick.name),
+        qos=mqtt.QoS.AT_LEAST_ONCE,
+        callback=partial(on_get_shadow_accepted, stick))
+
+    get_rejected_subscribed_future, _ = shadow_client.subscribe_to_get_shadow_rejected(
+        request=iotshadow.GetShadowSubscriptionRequest(thing_name=stick.name),
+        qos=mqtt.QoS.AT_LEAST_ONCE,
+        callback=partial(on_get_shadow_rejected, stick))
+
+    # Wait for subscriptions to succeed
+    get_accepted_subscribed_future.result()
+    get_rejected_subscribed_future.result()
+    print("Subscribed.")
+
+    # Issue request for shadow's current state.
+    print("Requesting current shadow state... ", end="")
+    publish_get_future = shadow_client.publish_get_shadow(
+        request=iotshadow.GetShadowRequest(thing_name=stick.name),
+        qos=mqtt.QoS.AT_LEAST_ONCE)
+
+    # Ensure that publish succeeds
+    publish_get_future.result()
+    print("Received.")
+
+# Ids of the modes and patterns come from the catalogs the web app uses, anything else
+# can be registered by a plugin. Ids are only here as a fallback if the catalogs are missing.
+mode_registry = Registry("mode", load_catalog("modes.json", "LightingProjectModes"), "lightstick.modes")
+mode_registry.register("basic", BasicMode, 1)
+mode_registry.register("image", ImageMode, 2)
+mode_registry.register("audio", MusicMode, 3)
+mode_registry.register("microphone", AudioMode, 4)
+mode_registry.register("lightsaber", LightsaberMode, 5)
+mode_registry.load_plugins(MODE_PLUGINS)
+
+pattern_registry = Registry("pattern", load_catalog("patterns.json", "LightingProjectPatterns"), "lightstick.patterns")
+pattern_registry.register("solid", SolidPattern, 1)
+pattern_registry.register("dot", DotPattern, 2)
+pattern_registry.register("blink", BlinkPattern, 3)
+pattern_registry.register("breathe", BreathePattern, 4)
+pattern_registry.register("rainbow", RainbowPattern, 5)
+pattern_registry.register("wave", WavePattern, 6)
+pattern_registry.load_plugins(PATTERN_PLUGINS)
+
+def create_mode(mode_id, stick):
+    return mode_registry.get(mode_id, NullMode)(stick)
+
+# Sticks with the same key are rendered by one shared mode instance
+def render_key(stick):
+    state = stick.shadow_state
+    mode_id = stick.mode_id
+
+    if mode_id == 1: # Pattern state only depends on the pattern, colors and strip length
+        return (mode_id, state["pattern"], tuple(state["colors"]), stick.num_pixels)
+    elif mode_id == 4: # There is only one microphone, levels are scaled automatically and then by each stick's sensitivity
+        return (mode_id, state.get("microphone_max"), stick.num_pixels)
+    elif mode_id in mode_registry: # Per-stick files and sensors, or a plugin we know nothing about
+        return (mode_id, stick.name)
+    else:
+        return (0, stick.num_pixels)
 
+render_groups = {}
 
-buf = ""
+# Render stage: render every group of identical sticks once and hand the frames over to the other stages
+def render():
+    groups = {}
 
-def loop():
-    global mode_id, mode, buf
+    for stick in sticks.values():
+        key = render_key(stick)
 
-    is_on = locked_data.shadow_state["is_on"]
-    new_mode_id = locked_data.shadow_state["mode"] if is_on else 0
+        # Reset the mode to load in newly downloaded files
+        if stick.reload.is_set():
+            stick.reload.clear()
 
-    # If mode has actually changed
-    if new_mode_id != mode_id:
-        if mode != None:
-            mode.exit()
+            if key in render_groups:
+                render_groups.pop(key).exit()
 
-        if new_mode_id == 1:
-            mode = BasicMode()
-        elif new_mode_id == 2:
-            mode = ImageMode()
-        elif new_mode_id == 3:
-            mode = MusicMode()
-        elif new_mode_id == 4:
-            mode = AudioMode()
-        elif new_mode_id == 5:
-            mode = LightsaberMode()
-        else:
-            mode = NullMode()
+        groups.setdefault(key, []).append(stick)
 
-        mode_id = new_mode_id
+    # Exit modes that no stick is using any more
+    exited = [key for key in render_groups if key not in groups]
 
-    c_r, c_g, c_b = mode.run()
+    for key in exited:
+        render_groups.pop(key).exit()
 
-    # mode.values = tuple(map(lambda v: float(v), l.split(",")))
+    # Invalidate the pattern cycles of colors that are no longer shown
+    if exited:
+        colors = {key[2] for key in groups if key[0] == 1}
+        frame_cache.retain(lambda key: not key[1] or key[1] in colors)
 
-    # Wireless output
-    readable, writable, exceptional = select.select(sockets, sockets, sockets)
+    now = time.perf_counter()
 
-    for s in readable:
-        if s is server_socket: # New client is attempting connection to server
-            print("New client detected.")
-            client_socket, address = server_socket.accept()
-            client_socket.setblocking(False)
-            sockets.append(client_socket)
+    for key, members in groups.items():
+        group = render_groups.get(key)
 
-        else: # Client has sent data
-            try:
-                data = s.recv(64)
+        if group is None:
+            group = RenderGroup(key, members[0].mode_id, members)
+            render_groups[key] = group
+        else:
+            group.sticks = members
 
-            except ConnectionResetError:
-                print("Connection reset by peer.")
+        group.render(now)
 
-                if s in sockets:
-                    print("Closing client... ", end="")
-                    s.close()
-                    sockets.remove(s)
-                    print("Closed.")
+# Called by the node server with every batch of IMU samples a client sends
+def ingest_sensor_data(client, samples):
+    stick = sticks[client.name]
 
-                    break
+    stick.sensor_value.value = np.linalg.norm(samples["accel"][-1])
 
-            else:
-                if data:
-                    if mode_id == 5:
-                        buf += data.decode()
-                        
-                else:
-                    print("Received 0 bytes. Connection to client is closed.")
+    for listener in stick.sensor_listeners:
+        listener(samples)
 
-                    if s in sockets:
-                        print("Closing client... ", end="")
-                        s.close()
-                        sockets.remove(s)
-                        print("Closed.")
+display_seq = None
+last_stats = time.time()
 
-                    break
+# Display stage: virtual output of the default stick and stats, runs on the main thread since Tk lives there
+def display():
+    global display_seq, last_stats
 
-    for s in writable:
-        try:
-            s.sendall(c_r)
-            s.sendall(c_g)
-            s.sendall(c_b)
+    seq = default_stick.frame_slot.read(display_frame.back, since=display_seq)
 
-        except socket.error: # Connection closed
-            print("Error occured while writing to client.")
+    if seq != display_seq:
+        display_frame.swap()
+        display_seq = seq
 
-            if s in sockets:
-                print("Closing client... ", end="")
-                sockets.remove(s)
-                s.close()
-                print("Closed.")
+        # Virtual output
+        if lightstick != None:
+            lightstick.update(*display_frame.channels)
 
-    for s in exceptional:
-        print("An exception occured.")
+    if time.time() - last_stats >= STATS_INTERVAL:
+        for stage in stages:
+            print("Frame stats (%s):" % stage.name, json.dumps(stage.scheduler.stats()))
 
-        if s in sockets:
-            print("Closing client... ", end="")
-            sockets.remove(s)
-            s.close()
-            print("Closed.")
+        print("Render groups: %d for %d sticks" % (len(render_groups), len(sticks)))
 
-    # Get latest value from incoming byte stream
-    if mode_id == 5:
-        val = None
+        for group in list(render_groups.values()):
+            stats = group.mode.stats()
 
-        while True:
-            i_delimiter = buf.find("|")
+            if stats is not None:
+                print("Mode stats (%s):" % group.name, json.dumps(stats))
 
-            if i_delimiter == -1:
-#                 print("break")
-                break
+        print("Node stats:", json.dumps(node_server.stats()))
+        print("Frame cache:", json.dumps(frame_cache.stats()))
 
+        if telemetry_drainer is not None:
+            print("Telemetry journal:", json.dumps(telemetry_drainer.stats()))
 
-            val = buf[:i_delimiter]
-            buf = buf[i_delimiter+1:]
-            
+        last_stats = time.time()
 
-        if val != None:
-            mode.value = float(val)
-#             f.write(str(float(val)))
-        else:
-            mode.value = 0
-        
-#         f.write("|")
+# STICKS lists the things driven by this edge as "thing_name[:num_pixels]" separated by
+# commas, each keeping its files in a directory named after it. Without it, the edge
+# drives the single THING_NAME stick with NUM_PIXELS pixels as before.
+def load_sticks():
+    entries = os.environ.get("STICKS")
 
-    # Virtual output
-    if lightstick != None:
-        lightstick.update(c_r, c_g, c_b)
+    if not entries:
+        return [Stick(THING_NAME, NUM_PIXELS, state=locked_data)]
 
-    # Limit to 30 frames per second
-    # time.sleep(0.034)
-    time.sleep(0.011)
+    result = []
+
+    for entry in entries.split(","):
+        name, _, num_pixels = entry.strip().partition(":")
+        state = locked_data if not result else None
+
+        result.append(Stick(name, int(num_pixels) if num_pixels else NUM_PIXELS, directory=name, state=state))
+
+    return result
+
+sticks = {stick.name: stick for stick in load_sticks()}
+default_stick = next(iter(sticks.values()))
 
+display_frame = FrameBuffer(default_stick.num_pixels)
 
+render_stage = Stage("render", render, TARGET_FPS, on_error=exit)
+display_stage = Stage("display", display, DISPLAY_FPS, on_error=exit)
+stages = [render_stage, display_stage]
+
+node_server = NodeServer(12345, {name: stick.frame_slot for name, stick in sticks.items()}, default_stick.name,
+    on_samples=ingest_sensor_data, on_error=exit)
 
 if __name__ == "__main__":
-    # Create TCP/IP socket
+    from awscrt import io, mqtt
+    from awsiot import iotshadow
+    from awsiot import mqtt_connection_builder
+    import boto3
+
+    from virtual import VirtualLightstick
+
+    # Start TCP server for the nodes
     print("Intializing TCP server... ", end="")
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind(("", 12345))
-    server_socket.listen(1)
+    node_server.start()
     print("Initialized.")
 #     f = open("values.txt","a")
 
-    sockets = [server_socket]
-
-    lightstick = VirtualLightstick(NUM_PIXELS)
+    lightstick = VirtualLightstick(default_stick.num_pixels)
 
     s3 = boto3.client("s3")
 
@@ -1036,6 +1319,9 @@ if __name__ == "__main__":
     host_resolver = io.DefaultHostResolver(event_loop_group)
     client_bootstrap = io.ClientBootstrap(event_loop_group, host_resolver)
 
+    # Telemetry journaled while offline is sent once connected
+    telemetry_drainer = Drainer(Journal(TELEMETRY_JOURNAL, int(TELEMETRY_JOURNAL_MB * 1024 * 1024)), publish_telemetry, rate=TELEMETRY_DRAIN_RATE)
+
     # Initiate MQTT connection
     mqtt_connection = mqtt_connection_builder.mtls_from_path(
         endpoint=os.environ.get("THING_ENDPOINT"),
@@ -1045,7 +1331,9 @@ if __name__ == "__main__":
         ca_filepath=os.environ.get("CA_FILE"),
         client_id=CLIENT_ID,
         clean_session=False,
-        keep_alive_secs=6)
+        keep_alive_secs=6,
+        on_connection_interrupted=telemetry_drainer.on_connection_interrupted,
+        on_connection_resumed=telemetry_drainer.on_connection_resumed)
 
     print("Connecting to {} with client ID '{}'... ".format(
         os.environ.get("THING_ENDPOINT"), CLIENT_ID), end="")
@@ -1058,62 +1346,15 @@ if __name__ == "__main__":
     connected_future.result()
     print("Connected.")
 
+    telemetry_drainer.connected.set()
+    telemetry_drainer.start()
+
     try:
-        # Subscribe to topics: delta, update_success, update_rejected, get_success, get_rejected
-        print("Subscribing to Delta events... ", end="")
-        delta_subscribed_future, _ = shadow_client.subscribe_to_shadow_delta_updated_events(
-            request=iotshadow.ShadowDeltaUpdatedSubscriptionRequest(thing_name=THING_NAME),
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_shadow_delta_updated)
-
-        # Wait for subscription to succeed
-        delta_subscribed_future.result()
-        print("Subscribed.")
-
-        print("Subscribing to Update responses... ", end="")
-        update_accepted_subscribed_future, _ = shadow_client.subscribe_to_update_shadow_accepted(
-            request=iotshadow.UpdateShadowSubscriptionRequest(thing_name=THING_NAME),
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_update_shadow_accepted)
-
-        update_rejected_subscribed_future, _ = shadow_client.subscribe_to_update_shadow_rejected(
-            request=iotshadow.UpdateShadowSubscriptionRequest(thing_name=THING_NAME),
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_update_shadow_rejected)
-
-        # Wait for subscriptions to succeed
-        update_accepted_subscribed_future.result()
-        update_rejected_subscribed_future.result()
-        print("Subscribed.")
-
-        print("Subscribing to Get responses... ", end="")
-        get_accepted_subscribed_future, _ = shadow_client.subscribe_to_get_shadow_accepted(
-            request=iotshadow.GetShadowSubscriptionRequest(thing_name=THING_NAME),
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_get_shadow_accepted)
-
-        get_rejected_subscribed_future, _ = shadow_client.subscribe_to_get_shadow_rejected(
-            request=iotshadow.GetShadowSubscriptionRequest(thing_name=THING_NAME),
-            qos=mqtt.QoS.AT_LEAST_ONCE,
-            callback=on_get_shadow_rejected)
-
-        # Wait for subscriptions to succeed
-        get_accepted_subscribed_future.result()
-        get_rejected_subscribed_future.result()
-        print("Subscribed.")
-
-        # Issue request for shadow's current state.
-        print("Requesting current shadow state... ", end="")
-        publish_get_future = shadow_client.publish_get_shadow(
-            request=iotshadow.GetShadowRequest(thing_name=THING_NAME),
-            qos=mqtt.QoS.AT_LEAST_ONCE)
-
-        # Ensure that publish succeeds
-        publish_get_future.result()
-        print("Received.")
-
-        while (True):
-            loop()
+        for stick in sticks.values():
+            subscribe_to_shadow(stick)
+
+        render_stage.start()
+        display_stage.run()
 
     except KeyboardInterrupt:
 #         f.close()
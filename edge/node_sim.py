@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+import protocol
+
+# Simulated lightstick node for exercising the edge without hardware.
+#
+# Each simulated node connects to the edge, negotiates the framed protocol,
+# decodes every frame it is sent and then spends --display-ms "showing" it
+# before asking for the next one, like the firmware does after strip.show().
+# Run a few slow ones next to the edge to check it drops frames for them
+# rather than queueing them up:
+#
+#   python node_sim.py --name lightstick --clients 4 --display-ms 50
+#
+# --protocol 1 simulates a node without flow control, which is sent every
+# frame no matter how far behind it is.
+
+CREDIT_WINDOW = 2
+
+class SimulatedNode:
+    def __init__(self, args, index):
+        self.args = args
+        self.index = index
+        self.decoder = protocol.FrameDecoder(args.num_pixels)
+        self.sample = np.zeros(1, dtype=protocol.SAMPLE)
+        self.sample["accel"] = (0, 0, 9.81) # At rest
+
+        self.frames = 0
+        self.bytes_received = 0
+        self.max_gap = 0.0 # Longest wait for a frame, in seconds
+
+    async def run(self):
+        reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+        writer.write(b"HELLO %s %d %d\n" % (self.args.name.encode(), self.args.protocol, protocol.ALL_ENCODINGS))
+
+        flow_control = self.args.protocol >= protocol.FLOW_CONTROL_VERSION
+        deadline = time.perf_counter() + self.args.duration
+        last = None
+
+        try:
+            while time.perf_counter() < deadline:
+                header = await reader.readexactly(protocol.HEADER.size)
+                length = protocol.unpack_header(header)[-1]
+                payload = await reader.readexactly(length)
+
+                self.bytes_received += len(header) + len(payload)
+
+                if not self.decoder.feed(header + payload):
+                    # The edge accepted our handshake, open the credit window
+                    if flow_control and self.decoder.accepted is not None and self.frames == 0:
+                        writer.write(protocol.pack_credit(CREDIT_WINDOW))
+
+                    continue
+
+                now = time.perf_counter()
+                if last is not None:
+                    self.max_gap = max(self.max_gap, now - last)
+                last = now
+
+                self.frames += 1
+
+                # Show the frame, then ask for the next one
+                await asyncio.sleep(self.args.display_ms / 1000)
+
+                if flow_control:
+                    writer.write(protocol.pack_credit(1))
+
+                    if self.args.sensor:
+                        self.sample["timestamp"] = int(now * 1000) & 0xFFFFFFFF
+                        writer.write(protocol.pack_sensor(self.sample))
+
+                elif self.args.sensor:
+                    writer.write(b"%.2f|" % 9.81)
+
+                await writer.drain()
+
+        finally:
+            writer.close()
+
+    def report(self):
+        print("node %d: %d frames (%.1f fps), %.1f bytes/frame, longest gap %.1f ms" % (
+            self.index,
+            self.frames,
+            self.frames / self.args.duration,
+            self.bytes_received / max(self.frames, 1),
+            self.max_gap * 1000,
+        ))
+
+async def main(args):
+    nodes = [SimulatedNode(args, i) for i in range(args.clients)]
+
+    await asyncio.gather(*(node.run() for node in nodes))
+
+    for node in nodes:
+        node.report()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate lightstick nodes")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--name", default="lightstick", help="Thing name the nodes introduce themselves as")
+    parser.add_argument("--num-pixels", type=int, default=144)
+    parser.add_argument("--clients", type=int, default=1)
+    parser.add_argument("--protocol", type=int, default=protocol.PROTOCOL_VERSION)
+    parser.add_argument("--display-ms", type=float, default=5, help="Time spent showing each frame")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to run for")
+    parser.add_argument("--sensor", action="store_true", help="Send sensor readings after every frame")
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,81 @@
+import threading
+
+import numpy as np
+
+from scheduler import FrameScheduler
+
+# Latest-value handoff between the render stage and its consumers.
+#
+# The producer copies each finished frame into the slot and bumps a sequence
+# number; consumers copy out the newest frame whenever the sequence has moved.
+# Frames a consumer was too slow to pick up are simply overwritten, so a slow
+# consumer never holds back the renderer. Listeners are called on the
+# producer's thread after every publish and must not block.
+class FrameSlot:
+    def __init__(self, num_pixels):
+        self._lock = threading.Lock()
+        self._frame = np.zeros((num_pixels, 3), dtype=np.uint8, order="F")
+        self._seq = 0
+        self._listeners = []
+
+    @property
+    def num_pixels(self):
+        return len(self._frame)
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def publish(self, frame):
+        with self._lock:
+            np.copyto(self._frame, frame)
+            self._seq += 1
+
+        for listener in self._listeners:
+            listener()
+
+    # Copy the newest frame into out if it is newer than since, returns its sequence number
+    def read(self, out, since=None):
+        with self._lock:
+            if self._seq != since:
+                np.copyto(out, self._frame)
+
+            return self._seq
+
+# One stage of the edge runtime, running step() at its own frame rate
+class Stage:
+    def __init__(self, name, step, fps, on_error=None):
+        self.name = name
+        self.scheduler = FrameScheduler(fps)
+
+        self._step = step
+        self._on_error = on_error
+        self._stopping = threading.Event()
+        self._thread = None
+
+    # Run on a new thread
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self._thread.start()
+
+    # Run on the calling thread until stopped
+    def run(self):
+        try:
+            while not self._stopping.is_set():
+                self._step()
+                self.scheduler.wait()
+
+        except Exception as e:
+            if self._on_error is None:
+                raise
+
+            self._on_error(e)
+
+    def stop(self):
+        self._stopping.set()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
@@ -0,0 +1,170 @@
+import threading
+import time
+
+import numpy as np
+
+# Persistence-of-vision row timing for ImageMode.
+#
+# A swung stick paints one image row per slice of its arc, so rows have to
+# follow the swing rather than the render loop. SwingTracker keeps the swing
+# rate from the gyro readings the node sends up, and RowClock runs a thread
+# emitting one row every row_angle of swing: the row interval shrinks as the
+# stick swings faster, and no rows are emitted while it is held still. Rows
+# are paced against absolute deadlines like FrameScheduler, sleeping until
+# just before each one and spinning the rest of the way, and how late every
+# row went out is kept to measure the jitter. Nodes without a gyro (legacy
+# ones) get rows at a fixed rate instead.
+
+# Seconds before a row deadline to stop sleeping and spin, covering the OS sleep overshoot
+SPIN = 0.0005
+
+# Longest sleep between checks, so a stick starting to swing or a stop request is noticed quickly
+MAX_WAIT = 0.01
+
+# Seconds without samples after which the swing rate is considered unknown and rows stop
+STALE = 0.25
+
+# Swing rate below which the stick counts as held still, in rad/s
+MIN_RATE = 0.05
+
+# Row lateness samples kept for the jitter stats
+JITTER_WINDOW = 1024
+
+# Swing rate of a stick from its IMU samples
+class SwingTracker:
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self._rate = 0.0 # rad/s around any axis, the direction of the swing does not matter
+        self._time = None # When the latest samples arrived
+        self.has_gyro = False # Whether the node sent any gyro readings at all
+
+    # Sensor listener, called on the node server thread with every batch of samples
+    def on_samples(self, samples):
+        if not len(samples):
+            return
+
+        gyro = samples["gyro"][-1]
+
+        if not self.has_gyro and not gyro.any():
+            return
+
+        self.has_gyro = True
+        self._rate = float(np.linalg.norm(gyro))
+        self._time = self._clock()
+
+    # Latest swing rate, 0 if the node has gone quiet
+    def rate(self, now=None):
+        if self._time is None:
+            return 0.0
+
+        if (self._clock() if now is None else now) - self._time > STALE:
+            return 0.0
+
+        return self._rate
+
+# Calls emit() once per row_angle radians of swing, from its own thread.
+#
+# The row rate follows the tracker's swing rate, capped at max_rate rows per
+# second, or stays at fallback_rate while the tracker has no gyro readings.
+class RowClock:
+    def __init__(self, emit, tracker, row_angle, fallback_rate, max_rate, clock=time.perf_counter, sleep=time.sleep):
+        self._emit = emit
+        self._tracker = tracker
+        self._row_angle = row_angle
+        self._fallback_rate = fallback_rate
+        self._max_rate = max_rate
+        self._clock = clock
+        self._sleep = sleep
+
+        self.rows = 0
+        self.late_rows = 0 # Rows more than a whole row interval late, after which the schedule restarts
+        self.row_rate = 0.0 # Rows per second at the last row
+
+        self._lateness = np.zeros(JITTER_WINDOW)
+        self._stopping = threading.Event()
+        self._thread = None
+
+    # Rows per second for the current swing, 0 while the stick is held still
+    def rate(self, now):
+        if not self._tracker.has_gyro:
+            return self._fallback_rate
+
+        swing = self._tracker.rate(now)
+
+        if swing < MIN_RATE:
+            return 0.0
+
+        return min(swing / self._row_angle, self._max_rate)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="pov-rows", daemon=True)
+        self._thread.start()
+
+    # Run on the calling thread until stopped
+    def run(self):
+        deadline = self._clock()
+
+        while not self._stopping.is_set():
+            rate = self.rate(deadline)
+
+            # Not swinging, hold the current row and check again shortly
+            if rate <= 0:
+                self._wait(deadline + MAX_WAIT)
+                deadline = self._clock()
+                continue
+
+            interval = 1 / rate
+            deadline += interval
+
+            if not self._wait(deadline):
+                break
+
+            now = self._clock()
+            late = now - deadline
+
+            # Too far behind to catch up, start over from now rather than emitting rows back to back
+            if late > interval:
+                self.late_rows += 1
+                deadline = now
+
+            self._lateness[self.rows % JITTER_WINDOW] = late
+            self.rows += 1
+            self.row_rate = rate
+
+            self._emit()
+
+    def stop(self):
+        self._stopping.set()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    # Sleep until shortly before deadline and spin the rest of the way, False if stopped meanwhile
+    def _wait(self, deadline):
+        while not self._stopping.is_set():
+            remaining = deadline - self._clock()
+
+            if remaining <= 0:
+                return True
+
+            if remaining > SPIN:
+                self._sleep(min(remaining - SPIN, MAX_WAIT))
+
+        return False
+
+    def stats(self):
+        lateness = self._lateness[:min(self.rows, JITTER_WINDOW)]
+
+        if not len(lateness):
+            lateness = np.zeros(1)
+
+        return {
+            "rows": self.rows,
+            "late_rows": self.late_rows,
+            "row_rate": round(self.row_rate, 1),
+            "jitter_us": {
+                "mean": round(float(np.abs(lateness).mean()) * 1e6, 1),
+                "p99": round(float(np.percentile(np.abs(lateness), 99)) * 1e6, 1),
+                "max": round(float(np.abs(lateness).max()) * 1e6, 1),
+            },
+        }
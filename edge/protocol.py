@@ -0,0 +1,426 @@
+import struct
+import time
+
+import numpy as np
+
+# Framed binary protocol between the edge and the nodes.
+#
+# A node opts in by appending its protocol version and a bitmask of the
+# encodings it can decode to its handshake, "HELLO <thing name> <version>
+# <encodings>\n". The edge answers with an ACCEPT packet carrying the version
+# and encodings it will use, and from then on sends FRAME packets. Nodes that
+# do not negotiate keep receiving raw r|g|b channel dumps.
+#
+# From version 2 the edge only sends a frame when the node has granted it a
+# credit, so a node that falls behind never has more than the frames it asked
+# for in flight; newer frames replace the pending one on the edge instead of
+# queueing up. The node grants credits with CREDIT packets (the number of
+# credits in count, no payload) and the uplink is framed as well, sensor data
+# travelling in SENSOR packets of count IMU samples:
+#
+#   timestamp  4  uint32, milliseconds on the node's clock
+#   accel     12  3 * float32, m/s^2
+#   gyro      12  3 * float32, rad/s
+#
+# Older nodes send the acceleration magnitude as ASCII, "<magnitude>|".
+#
+# Every packet starts with a 14 byte little-endian header:
+#
+#   magic    2  b"LP"
+#   version  1
+#   type     1  PACKET_* type
+#   encoding 1  ENCODING_* used for the payload of a frame
+#   flags    1  FLAG_KEYFRAME when the packet covers the whole strip
+#   seq      2  frame sequence number, wraps around
+#   start    2  first pixel covered by the frame
+#   count    2  number of pixels covered by the frame
+#   length   2  payload length in bytes
+#
+# Frame payloads describe pixels start..start+count, which are the only
+# pixels that changed since the previous frame unless it is a keyframe:
+#
+#   ENCODING_RAW      count * (r, g, b)
+#   ENCODING_RLE      runs of (length 1-255, r, g, b)
+#   ENCODING_PALETTE  palette size P (1-255), P * (r, g, b), then count palette indices
+
+PROTOCOL_VERSION = 2
+
+# First version with credit based flow control and a framed uplink
+FLOW_CONTROL_VERSION = 2
+
+MAGIC = b"LP"
+HEADER = struct.Struct("<2sBBBBHHHH")
+
+PACKET_FRAME = 1
+PACKET_ACCEPT = 2
+PACKET_CREDIT = 3 # Node to edge
+PACKET_SENSOR = 4 # Node to edge
+
+ENCODING_RAW = 0
+ENCODING_RLE = 1
+ENCODING_PALETTE = 2
+
+ENCODING_NAMES = {
+    ENCODING_RAW: "raw",
+    ENCODING_RLE: "rle",
+    ENCODING_PALETTE: "palette",
+}
+
+# Bitmask of every encoding this side supports
+ALL_ENCODINGS = sum(1 << encoding for encoding in ENCODING_NAMES)
+
+FLAG_KEYFRAME = 0x01
+
+MAX_RUN = 255
+MAX_PALETTE = 255
+
+# Send a keyframe at least this often, in frames, even if nothing changed
+KEYFRAME_INTERVAL = 90
+
+SAMPLE = np.dtype([("timestamp", "<u4"), ("accel", "<f4", 3), ("gyro", "<f4", 3)])
+
+# Most samples in one SENSOR packet, bounding the uplink packet size
+MAX_SAMPLES = 64
+MAX_UPLINK_PAYLOAD = MAX_SAMPLES * SAMPLE.itemsize
+
+# Longest ASCII reading accepted from an older node
+MAX_LEGACY_READING = 32
+
+class ProtocolError(Exception):
+    pass
+
+# Pick the version and encodings to use with a node, None if we have nothing in common
+def negotiate(version, encodings):
+    version = min(version, PROTOCOL_VERSION)
+    encodings &= ALL_ENCODINGS
+
+    # Raw is always understood, so a node can't negotiate itself out of every encoding
+    encodings |= 1 << ENCODING_RAW
+
+    if version < 1:
+        return None
+
+    return version, encodings
+
+def pack_header(packet_type, encoding=ENCODING_RAW, flags=0, seq=0, start=0, count=0, length=0, version=PROTOCOL_VERSION):
+    return HEADER.pack(MAGIC, version, packet_type, encoding, flags, seq, start, count, length)
+
+def unpack_header(data, offset=0):
+    header = HEADER.unpack_from(data, offset)
+
+    if header[0] != MAGIC:
+        raise ProtocolError("Bad magic %r" % header[0])
+
+    return header
+
+def pack_accept(version, encodings):
+    payload = bytes((version, encodings))
+
+    return pack_header(PACKET_ACCEPT, length=len(payload), version=version) + payload
+
+def pack_credit(credits):
+    return pack_header(PACKET_CREDIT, count=credits)
+
+def pack_sensor(samples):
+    payload = np.ascontiguousarray(samples, dtype=SAMPLE).tobytes()
+
+    return pack_header(PACKET_SENSOR, count=len(samples), length=len(payload)) + payload
+
+def unpack_samples(payload, count):
+    if len(payload) != count * SAMPLE.itemsize:
+        raise ProtocolError("%d bytes of sensor data for %d samples" % (len(payload), count))
+
+    return np.frombuffer(payload, dtype=SAMPLE, count=count)
+
+# Pack pixels as 24-bit integers so runs and palettes can be found with one comparison per pixel
+def _pixel_keys(pixels):
+    pixels = pixels.astype(np.uint32)
+
+    return (pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2]
+
+def encode_raw(pixels):
+    return np.ascontiguousarray(pixels, dtype=np.uint8).tobytes()
+
+def encode_rle(pixels):
+    keys = _pixel_keys(pixels)
+    starts = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(keys)))
+
+    # Split runs longer than a byte can hold
+    if lengths.max() > MAX_RUN:
+        splits = (lengths + MAX_RUN - 1) // MAX_RUN
+        piece = np.arange(splits.sum()) - np.repeat(np.cumsum(splits) - splits, splits) # Index of each piece within its run
+        starts = np.repeat(starts, splits) + piece * MAX_RUN
+        lengths = np.diff(np.append(starts, len(keys)))
+
+    runs = np.empty((len(starts), 4), dtype=np.uint8)
+    runs[:, 0] = lengths
+    runs[:, 1:] = pixels[starts]
+
+    return runs.tobytes()
+
+def encode_palette(pixels):
+    keys = _pixel_keys(pixels)
+    palette_keys, first, indices = np.unique(keys, return_index=True, return_inverse=True)
+
+    if len(palette_keys) > MAX_PALETTE:
+        return None
+
+    palette = np.ascontiguousarray(pixels[first], dtype=np.uint8)
+
+    return bytes((len(palette_keys),)) + palette.tobytes() + indices.astype(np.uint8).tobytes()
+
+ENCODERS = {
+    ENCODING_RAW: encode_raw,
+    ENCODING_RLE: encode_rle,
+    ENCODING_PALETTE: encode_palette,
+}
+
+# Stateful encoder for one connection, turning rendered frames into FRAME packets
+class FrameEncoder:
+    def __init__(self, num_pixels, encodings=ALL_ENCODINGS, version=PROTOCOL_VERSION, keyframe_interval=KEYFRAME_INTERVAL):
+        self._version = version
+        self._encodings = [e for e in ENCODERS if encodings & (1 << e)]
+        self._keyframe_interval = keyframe_interval
+
+        self._last = np.zeros((num_pixels, 3), dtype=np.uint8) # What the node is showing
+        self._since_keyframe = None
+        self._seq = 0
+
+        self.bytes_sent = 0
+        self.frames_encoded = 0
+        self.frames_unchanged = 0
+
+    # Returns the packet for frame, or None if the node is already showing it
+    def encode(self, frame):
+        is_keyframe = self._since_keyframe is None or self._since_keyframe + 1 >= self._keyframe_interval
+
+        if is_keyframe:
+            start, end = 0, len(frame)
+
+        else:
+            changed = np.flatnonzero(np.any(frame != self._last, axis=1))
+
+            if len(changed) == 0:
+                self._since_keyframe += 1
+                self.frames_unchanged += 1
+
+                return None
+
+            start, end = changed[0], changed[-1] + 1
+
+        pixels = frame[start:end]
+
+        # Use whichever of the negotiated encodings is smallest for this frame
+        encoding, payload = None, None
+        for e in self._encodings:
+            data = ENCODERS[e](pixels)
+
+            if data is not None and (payload is None or len(data) < len(payload)):
+                encoding, payload = e, data
+
+        header = pack_header(PACKET_FRAME, encoding, FLAG_KEYFRAME if is_keyframe else 0,
+            self._seq, start, end - start, len(payload), self._version)
+
+        self._last[start:end] = pixels
+        self._since_keyframe = 0 if is_keyframe else self._since_keyframe + 1
+        self._seq = (self._seq + 1) & 0xFFFF
+
+        packet = header + payload
+        self.bytes_sent += len(packet)
+        self.frames_encoded += 1
+
+        return packet
+
+# Incremental parser for the framed uplink of one connection.
+#
+# Data is copied into a preallocated buffer as it arrives and every complete
+# packet is handed to on_packet(packet_type, count, payload) straight away,
+# the payload being a memoryview into that buffer that is only valid until
+# on_packet returns. Consumed bytes are only moved when the buffer runs out of
+# room, so parsing stays linear in the amount of data received.
+class PacketReader:
+    def __init__(self, on_packet, max_payload=MAX_UPLINK_PAYLOAD):
+        self._on_packet = on_packet
+        self._max_payload = max_payload
+
+        self._buf = bytearray(HEADER.size + max_payload)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def feed(self, data):
+        data = memoryview(data)
+
+        while data:
+            if self._start > 0 and len(self._buf) - self._end < len(data):
+                pending = self._end - self._start
+                self._buf[:pending] = self._buf[self._start:self._end]
+                self._start, self._end = 0, pending
+
+            n = min(len(self._buf) - self._end, len(data))
+            self._view[self._end:self._end + n] = data[:n]
+            self._end += n
+            data = data[n:]
+
+            self._parse()
+
+    def _parse(self):
+        while self._end - self._start >= HEADER.size:
+            _, _, packet_type, _, _, _, _, count, length = unpack_header(self._buf, self._start)
+
+            if length > self._max_payload:
+                raise ProtocolError("Packet of %d bytes is too large" % length)
+
+            payload_start = self._start + HEADER.size
+
+            if self._end - payload_start < length:
+                break
+
+            self._start = payload_start + length
+            self._on_packet(packet_type, count, self._view[payload_start:self._start])
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+# Incremental parser for the ASCII uplink of older nodes, "<magnitude>|..."
+#
+# Each reading becomes a sample with the magnitude as its x acceleration, the
+# edge's receive time as its timestamp and no rotation, and all the readings
+# in a chunk of data are handed to on_samples(samples) together. samples is
+# a view into a preallocated array that is only valid until on_samples returns.
+class LegacySampleParser:
+    def __init__(self, on_samples, max_samples=MAX_SAMPLES, clock=time.monotonic):
+        self._on_samples = on_samples
+        self._clock = clock
+
+        self._samples = np.zeros(max_samples, dtype=SAMPLE)
+        self._partial = bytearray() # Reading split across chunks
+
+    def feed(self, data):
+        timestamp = int(self._clock() * 1000) & 0xFFFFFFFF
+        count = 0
+        start = 0
+
+        while True:
+            end = data.find(b"|", start)
+
+            if end == -1:
+                break
+
+            reading = data[start:end]
+            start = end + 1
+
+            if self._partial:
+                reading = self._partial + reading
+                self._partial.clear()
+
+            try:
+                magnitude = float(reading)
+
+            except ValueError:
+                continue
+
+            self._samples[count] = (timestamp, (magnitude, 0, 0), (0, 0, 0))
+            count += 1
+
+            if count == len(self._samples):
+                self._on_samples(self._samples)
+                count = 0
+
+        # Keep the start of a reading that continues in the next chunk, drop garbage
+        if len(self._partial) + len(data) - start <= MAX_LEGACY_READING:
+            self._partial += data[start:]
+        else:
+            self._partial.clear()
+
+        if count:
+            self._on_samples(self._samples[:count])
+
+# Uplink parser for nodes that negotiated the framed uplink.
+#
+# Such a node keeps sending ASCII readings until it has read ACCEPT, so data
+# goes to legacy until the first byte of the packet magic shows up, which no
+# reading contains, and to packets from there on.
+class UplinkParser:
+    def __init__(self, legacy, packets):
+        self.legacy = legacy
+        self.packets = packets
+        self.current = legacy
+
+    def feed(self, data):
+        if self.current is self.legacy:
+            start = data.find(MAGIC[:1])
+
+            if start == -1:
+                self.legacy.feed(data)
+                return
+
+            self.legacy.feed(data[:start])
+            self.current = self.packets
+            data = data[start:]
+
+        self.current.feed(data)
+
+# Reference decoder, the same state machine the node firmware runs.
+# Feed it the byte stream in chunks of any size; it keeps the decoded strip in frame.
+class FrameDecoder:
+    def __init__(self, num_pixels):
+        self.frame = np.zeros((num_pixels, 3), dtype=np.uint8)
+        self.accepted = None # (version, encodings) once the edge has answered the handshake
+        self.seq = None
+        self.frames = 0
+
+        self._buf = bytearray()
+
+    # Consume data, returns the number of frames completed by it
+    def feed(self, data):
+        self._buf += data
+        frames = 0
+        offset = 0
+
+        while len(self._buf) - offset >= HEADER.size:
+            magic, version, packet_type, encoding, flags, seq, start, count, length = unpack_header(self._buf, offset)
+
+            if len(self._buf) - offset - HEADER.size < length:
+                break
+
+            payload = memoryview(self._buf)[offset + HEADER.size:offset + HEADER.size + length]
+
+            if packet_type == PACKET_ACCEPT:
+                self.accepted = (payload[0], payload[1])
+
+            elif packet_type == PACKET_FRAME:
+                self._decode_frame(encoding, start, count, payload)
+                self.seq = seq
+                self.frames += 1
+                frames += 1
+
+            payload.release()
+            offset += HEADER.size + length
+
+        del self._buf[:offset]
+
+        return frames
+
+    def _decode_frame(self, encoding, start, count, payload):
+        if start + count > len(self.frame):
+            raise ProtocolError("Frame covers pixels %d-%d of %d" % (start, start + count, len(self.frame)))
+
+        target = self.frame[start:start + count]
+
+        if encoding == ENCODING_RAW:
+            target[:] = np.frombuffer(payload, dtype=np.uint8).reshape(count, 3)
+
+        elif encoding == ENCODING_RLE:
+            runs = np.frombuffer(payload, dtype=np.uint8).reshape(-1, 4)
+            target[:] = np.repeat(runs[:, 1:], runs[:, 0], axis=0)[:count]
+
+        elif encoding == ENCODING_PALETTE:
+            size = payload[0]
+            palette = np.frombuffer(payload[1:1 + size * 3], dtype=np.uint8).reshape(size, 3)
+            indices = np.frombuffer(payload[1 + size * 3:], dtype=np.uint8)
+            target[:] = palette[indices]
+
+        else:
+            raise ProtocolError("Unknown encoding %d" % encoding)
@@ -0,0 +1,111 @@
+import importlib
+import json
+import os
+
+try:
+    from importlib.metadata import entry_points
+except ImportError: # Python < 3.8
+    entry_points = None
+
+# Where the mode and pattern catalogs loaded into DynamoDB live
+CATALOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cloud")
+
+# Read a DynamoDB batch-write catalog such as cloud/modes.json into {name: id}
+def load_catalog(filename, table, directory=CATALOG_DIR):
+    try:
+        with open(os.path.join(directory, filename)) as f:
+            items = json.load(f)[table]
+
+    except (OSError, ValueError, KeyError) as e:
+        print("Could not read catalog %s: %s" % (filename, e))
+        return {}
+
+    catalog = {}
+
+    for item in items:
+        item = item["PutRequest"]["Item"]
+        catalog[item["name"]["S"]] = int(item["id"]["N"])
+
+    return catalog
+
+# Maps the ids the cloud uses for modes or patterns to their implementations.
+#
+# An implementation is registered under its catalog name, and the id comes
+# from the catalog so the edge always agrees with the web app. Targets are
+# either the implementation itself or a "module:attribute" string that is
+# only imported the first time the id is used, and cached from then on.
+# Third-party implementations are picked up from installed packages
+# declaring entry points in group, or from a "name=module:attribute,..."
+# list, without touching lighting.py.
+class Registry:
+    def __init__(self, kind, catalog, group):
+        self.kind = kind
+        self.group = group
+
+        self._catalog = catalog
+        self._targets = {}
+        self._names = {}
+        self._loaded = {}
+
+    def __contains__(self, id):
+        return id in self._targets
+
+    def names(self):
+        return dict(self._names)
+
+    # fallback_id is used if the catalog does not know name
+    def register(self, name, target, fallback_id=None):
+        id = self._catalog.get(name, fallback_id)
+
+        if id is None:
+            raise ValueError("No %s called %s in the catalog" % (self.kind, name))
+
+        self._targets[id] = target
+        self._names[id] = name
+        self._loaded.pop(id, None)
+
+        return id
+
+    # Implementation for id, importing it on first use. default if there is none or it fails to load.
+    def get(self, id, default=None):
+        if id in self._loaded:
+            return self._loaded[id] or default
+
+        target = self._targets.get(id)
+
+        if target is None:
+            return default
+
+        if isinstance(target, str):
+            module, _, attribute = target.partition(":")
+
+            try:
+                target = getattr(importlib.import_module(module), attribute)
+
+            except (ImportError, AttributeError) as e:
+                print("Failed to load %s %s from %s: %r" % (self.kind, self._names[id], target, e))
+                target = None
+
+        self._loaded[id] = target
+
+        return target or default
+
+    def load_plugins(self, spec=""):
+        plugins = []
+
+        if entry_points is not None:
+            eps = entry_points()
+            eps = eps.select(group=self.group) if hasattr(eps, "select") else eps.get(self.group, [])
+            plugins += [(ep.name, ep.value) for ep in eps]
+
+        for plugin in filter(None, (p.strip() for p in spec.split(","))):
+            name, _, target = plugin.partition("=")
+            plugins.append((name.strip(), target.strip()))
+
+        for name, target in plugins:
+            try:
+                id = self.register(name, target)
+                print("Registered %s plugin %s (%d) from %s" % (self.kind, name, id, target))
+
+            except ValueError as e:
+                print("Skipping %s plugin %s: %s" % (self.kind, name, e))
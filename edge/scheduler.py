@@ -0,0 +1,97 @@
+import time
+
+# Fixed-timestep frame scheduler for the main loop.
+#
+# Frames are paced against absolute deadlines (anchor + n * period) instead of
+# sleeping a fixed amount after every frame, so render cost and sleep overshoot
+# never accumulate into drift. A frame that finishes after its deadline is
+# counted as late and the next one starts immediately; any whole frame slots
+# that passed while we were busy are counted as dropped and skipped rather
+# than rendered back to back.
+class FrameScheduler:
+    def __init__(self, fps, clock=time.perf_counter, sleep=time.sleep):
+        self._clock = clock
+        self._sleep = sleep
+
+        self.frames = 0
+        self.late_frames = 0
+        self.dropped_frames = 0
+        self.frame_time = 0.0 # Time spent on the last frame, excluding sleep
+
+        self._window_start = None
+        self._window_frames = 0
+
+        self.fps = fps
+
+    @property
+    def fps(self):
+        return self._fps
+
+    # Changing the target rate re-anchors the schedule on the next frame
+    @fps.setter
+    def fps(self, fps):
+        self._fps = fps
+        self._period = 1.0 / fps
+        self._deadline = None
+        self._frame_start = None
+
+    @property
+    def period(self):
+        return self._period
+
+    # Call once at the end of every frame
+    def wait(self):
+        now = self._clock()
+
+        self.frames += 1
+        self._window_frames += 1
+
+        # First frame after (re)starting anchors the schedule
+        if self._deadline is None:
+            self._deadline = now
+            self._frame_start = now
+
+            if self._window_start is None:
+                self._window_start = now
+
+            return
+
+        self.frame_time = now - self._frame_start
+        self._deadline += self._period
+
+        if now <= self._deadline:
+            self._sleep(self._deadline - now)
+            self._frame_start = self._deadline
+
+        else:
+            self.late_frames += 1
+
+            missed = int((now - self._deadline) / self._period)
+            if missed > 0:
+                self.dropped_frames += missed
+                self._deadline += missed * self._period
+
+            self._frame_start = now
+
+    # Measured frame rate since the last call
+    def measured_fps(self):
+        now = self._clock()
+
+        if self._window_start is None or now <= self._window_start:
+            return 0.0
+
+        fps = self._window_frames / (now - self._window_start)
+        self._window_start = now
+        self._window_frames = 0
+
+        return fps
+
+    def stats(self):
+        return {
+            "target_fps": self._fps,
+            "measured_fps": round(self.measured_fps(), 1),
+            "frames": self.frames,
+            "late_frames": self.late_frames,
+            "dropped_frames": self.dropped_frames,
+            "frame_time_ms": round(self.frame_time * 1000, 2),
+        }
@@ -0,0 +1,347 @@
+import asyncio
+from functools import partial
+import socket
+import threading
+
+import numpy as np
+
+import protocol
+
+# A node connected to the server, with separate tasks for its read and write paths
+class NodeClient:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info("peername")
+
+        self.name = None # Thing name of the lightstick, known after the handshake
+        self.feed = None
+        self.encoder = None # Set if the node negotiated the framed protocol
+        self.credits = None # Frames the node has asked for, None if it doesn't use flow control
+
+        self.new_frame = asyncio.Event()
+        self.has_credit = asyncio.Event()
+        self.parser = None # Uplink parser, depends on the protocol the node speaks
+
+        self.frames_sent = 0
+        self.frames_skipped = 0 # Replaced by a newer frame while the previous write drained
+        self.frames_dropped = 0 # Replaced by a newer frame while the node had no credits
+        self.bytes_sent = 0
+
+    def grant(self, credits):
+        self.credits = min(self.credits + credits, NodeServer.MAX_CREDITS)
+
+        if self.credits > 0:
+            self.has_credit.set()
+
+# Latest frame of one lightstick, shared by every client driving that stick
+class Feed:
+    def __init__(self, frame_slot):
+        self.slot = frame_slot
+        self.buffer = np.zeros((frame_slot.num_pixels, 3), dtype=np.uint8, order="F")
+        self.seq = None
+        self.clients = set()
+
+        self._raw = None
+        self._raw_seq = None
+
+    # Raw r|g|b channel dump of the latest frame for nodes that did not negotiate the protocol
+    @property
+    def raw(self):
+        if self._raw_seq != self.seq:
+            self._raw = self.buffer.tobytes(order="F")
+            self._raw_seq = self.seq
+
+        return self._raw
+
+# TCP server for the lightstick nodes, running an asyncio event loop on its own thread.
+#
+# A node introduces itself with "HELLO <thing name> [<version> <encodings>]\n"
+# and is then fed frames from that stick's FrameSlot whenever the render stage
+# publishes one, using the framed protocol if it negotiated one (see protocol.py)
+# or raw channel dumps otherwise. Older nodes that start streaming sensor data
+# straight away are attached to the default stick. Each client has a writer
+# coroutine that always sends the newest frame once the previous write has
+# drained, so a slow client skips frames instead of building up a backlog, and
+# a reader coroutine that parses the sensor samples the node sends as they
+# arrive and hands every one of them to on_samples(client, samples), samples
+# being an array of protocol.SAMPLE that is only valid during the call.
+# Neither path waits on the other, nor on any other client.
+#
+# Nodes speaking protocol v2 or later also have to grant credits before they
+# are sent a frame. Until they do, their writer holds on to the newest frame
+# only and counts every frame it replaces as dropped. Their uplink is read
+# as ASCII readings until their first packet, as they keep streaming readings
+# until they have read ACCEPT.
+class NodeServer:
+    HELLO = b"HELLO"
+    HELLO_TIMEOUT = 2
+
+    # Keep at most a couple of frames queued in the kernel/transport per client
+    WRITE_BUFFER_FRAMES = 2
+
+    # Most credits a node can hold, bounding the frames in flight to it
+    MAX_CREDITS = 8
+
+    def __init__(self, port, frame_slots, default, on_samples=None, on_error=None, host=None):
+        self.host = host # Every interface by default
+        self.port = port # The one actually bound once started, if 0 was asked for
+        self._default = default
+        self._on_samples = on_samples
+        self._on_error = on_error
+
+        self._feeds = {}
+        for name, frame_slot in frame_slots.items():
+            feed = Feed(frame_slot)
+            frame_slot.add_listener(partial(self._notify, feed))
+            self._feeds[name] = feed
+
+        self._clients = set()
+        self._handlers = set()
+        self._loop = None
+        self._stopping = None
+        self._ready = threading.Event()
+        self._thread = None
+
+    @property
+    def clients(self):
+        return list(self._clients)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="io", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        if self._loop is not None and self._stopping is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._stopping.set)
+
+            except RuntimeError: # Already stopped
+                pass
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def stats(self):
+        clients = self.clients
+
+        return {
+            "clients": len(clients),
+            "frames_sent": sum(c.frames_sent for c in clients),
+            "frames_skipped": sum(c.frames_skipped for c in clients),
+            "frames_dropped": sum(c.frames_dropped for c in clients),
+            "frames_unchanged": sum(c.encoder.frames_unchanged for c in clients if c.encoder is not None),
+            "bytes_sent": sum(c.bytes_sent for c in clients),
+        }
+
+    def _run(self):
+        try:
+            asyncio.run(self._main())
+
+        except Exception as e:
+            self._ready.set()
+
+            if self._on_error is None:
+                raise
+
+            self._on_error(e)
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+
+        server = await asyncio.start_server(self._handle_client, host=self.host, port=self.port, reuse_address=True, backlog=128)
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+
+        async with server:
+            await self._stopping.wait()
+
+            # Let every connection close cleanly before the loop shuts down
+            for client in self.clients:
+                client.writer.close()
+
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    # Called from the render thread after every published frame
+    def _notify(self, feed):
+        loop = self._loop
+
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self._on_new_frame, feed)
+
+            except RuntimeError: # Event loop already closed
+                pass
+
+    def _on_new_frame(self, feed):
+        seq = feed.slot.read(feed.buffer, since=feed.seq)
+
+        if seq == feed.seq:
+            return
+
+        feed.seq = seq
+
+        for client in feed.clients:
+            if client.new_frame.is_set():
+                if client.credits == 0:
+                    client.frames_dropped += 1
+                else:
+                    client.frames_skipped += 1
+
+            client.new_frame.set()
+
+    async def _handle_client(self, reader, writer):
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        client = NodeClient(reader, writer)
+        self._clients.add(client)
+        self._handlers.add(asyncio.current_task())
+        print("New client detected:", client.address)
+
+        try:
+            data = await self._handshake(client)
+
+            if client.feed is None:
+                return
+
+            writer.transport.set_write_buffer_limits(high=client.feed.buffer.size * NodeServer.WRITE_BUFFER_FRAMES)
+            client.feed.clients.add(client)
+
+            if data:
+                client.parser.feed(data)
+
+            read_task = asyncio.create_task(self._read(client))
+            write_task = asyncio.create_task(self._write(client))
+
+            # Whichever path fails or closes first ends the connection
+            done, pending = await asyncio.wait((read_task, write_task), return_when=asyncio.FIRST_COMPLETED)
+
+            for task in pending:
+                task.cancel()
+
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    print("Error on client %s: %s" % (client.address, task.exception()))
+
+        except (ConnectionError, ValueError, protocol.ProtocolError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            print("Error on client %s: %r" % (client.address, e))
+
+        finally:
+            if client.feed is not None:
+                client.feed.clients.discard(client)
+
+            self._clients.discard(client)
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+            print("Closed client %s: %d frames sent, %d skipped, %d dropped." % (
+                client.address, client.frames_sent, client.frames_skipped, client.frames_dropped))
+
+    # Attach the client to a stick, returns any sensor data that was read in the process
+    async def _handshake(self, client):
+        try:
+            data = await asyncio.wait_for(client.reader.readexactly(len(NodeServer.HELLO)), NodeServer.HELLO_TIMEOUT)
+
+        except asyncio.TimeoutError: # Node that only displays frames
+            data = b""
+
+        accepted = None
+
+        if data == NodeServer.HELLO:
+            line = await asyncio.wait_for(client.reader.readline(), NodeServer.HELLO_TIMEOUT)
+            fields = line.decode().split()
+            data = b""
+
+            name = fields[0] if fields else None
+
+            if len(fields) >= 3:
+                accepted = protocol.negotiate(int(fields[1]), int(fields[2]))
+
+        else:
+            name = self._default
+
+        if name not in self._feeds:
+            print("Unknown lightstick %s, closing client." % name)
+            return data
+
+        client.name = name
+        client.feed = self._feeds[name]
+
+        if accepted is not None:
+            version, encodings = accepted
+            client.encoder = protocol.FrameEncoder(client.feed.slot.num_pixels, encodings, version)
+            client.writer.write(protocol.pack_accept(version, encodings))
+
+            if version >= protocol.FLOW_CONTROL_VERSION:
+                client.credits = 0
+                client.parser = protocol.UplinkParser(
+                    protocol.LegacySampleParser(partial(self._on_client_samples, client)),
+                    protocol.PacketReader(partial(self._on_packet, client)))
+
+            print("Client %s is driving %s using protocol v%d." % (client.address, name, version))
+        else:
+            print("Client %s is driving %s." % (client.address, name))
+
+        if client.parser is None:
+            client.parser = protocol.LegacySampleParser(partial(self._on_client_samples, client))
+
+        return data
+
+    async def _read(self, client):
+        while True:
+            data = await client.reader.read(4096)
+
+            if not data:
+                # Closed by the node rather than by stop()
+                if not self._stopping.is_set():
+                    print("Received 0 bytes. Connection to client is closed.")
+
+                return
+
+            client.parser.feed(data)
+
+    def _on_packet(self, client, packet_type, count, payload):
+        if packet_type == protocol.PACKET_CREDIT:
+            client.grant(count)
+
+        elif packet_type == protocol.PACKET_SENSOR:
+            self._on_client_samples(client, protocol.unpack_samples(payload, count))
+
+    def _on_client_samples(self, client, samples):
+        if self._on_samples is not None:
+            self._on_samples(client, samples)
+
+    async def _write(self, client):
+        while True:
+            await client.new_frame.wait()
+
+            # Wait for the node to ask for a frame, newer ones replace this one meanwhile
+            if client.credits == 0:
+                await client.has_credit.wait()
+
+            client.new_frame.clear()
+
+            if client.encoder is not None:
+                packet = client.encoder.encode(client.feed.buffer)
+
+                # The node is already showing this frame
+                if packet is None:
+                    continue
+
+            else:
+                packet = client.feed.raw
+
+            if client.credits is not None:
+                client.credits -= 1
+
+                if client.credits == 0:
+                    client.has_credit.clear()
+
+            client.writer.write(packet)
+            await client.writer.drain()
+
+            client.frames_sent += 1
+            client.bytes_sent += len(packet)
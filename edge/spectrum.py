@@ -0,0 +1,123 @@
+import math
+import time
+
+import numpy as np
+
+import audio
+
+# Multi-band spectrum display for AudioMode and MusicMode.
+#
+# A Hann-windowed real FFT of the latest samples is summed into log-spaced
+# bands (the same ones audio.analyze() precomputes for tracks), and each
+# band lights a bar in its own segment of the strip. Band levels go through
+# automatic gain control, in decibels below a reference that jumps up with
+# loud passages and slowly falls back in quiet ones, so no one has to tune
+# the scale for the room, and through attack/release smoothing so bars rise
+# quickly and fall gently. gain_db shifts the bars up or down on top of the
+# AGC, for the sensitivity set from the web app. The FFT shrinks when it takes longer than the
+# per-frame CPU budget, and grows back when there is room again.
+
+# Seconds of CPU per frame the analysis may take
+BUDGET = 0.002
+
+# Smallest FFT the budget may shrink it to, in samples
+MIN_FFT_SIZE = 512
+
+# Decibels shown below the AGC reference
+RANGE_DB = 48
+
+# Decibels per second the AGC reference falls back after loud passages
+AGC_DECAY = 6
+
+# The AGC reference never drops below this, so silence stays dark
+FLOOR_DB = -60
+
+# Smoothing time constants of rising and falling bars, in seconds
+ATTACK = 0.01
+RELEASE = 0.2
+
+class Spectrum:
+    def __init__(self, rate, num_pixels, bands=audio.BANDS, fft_size=2048, budget=BUDGET, clock=time.perf_counter):
+        self.rate = rate
+        self.bands = bands
+        self.budget = budget
+        self.levels = np.zeros(bands, dtype=np.float32) # 0 to 1 per band, as last displayed
+        self.gain_db = 0.0 # Added to every band after the AGC, positive for taller bars
+
+        self._max_fft_size = fft_size
+        self._clock = clock
+        self._cost = 0.0 # Smoothed seconds per analysis
+        self._reference = FLOOR_DB
+
+        # Band of every pixel, and how far along its segment it is
+        position = np.arange(num_pixels) * bands / num_pixels
+        self._segment = position.astype(int)
+        self._position = (position - self._segment).astype(np.float32)
+
+        self._set_fft_size(fft_size)
+
+    @property
+    def fft_size(self):
+        return self._fft_size
+
+    def _set_fft_size(self, fft_size):
+        self._fft_size = fft_size
+        self._window = np.hanning(fft_size).astype(np.float32)
+        self._scale = 2 / self._window.sum() / 32768
+        self._edges = audio.band_edges(self.rate, fft_size, self.bands)
+
+    # RMS amplitude per band of (frames, channels) samples on the 16-bit scale, of full scale
+    def band_amplitudes(self, samples):
+        mono = np.zeros(self._fft_size, dtype=np.float32)
+        samples = samples[-self._fft_size:]
+
+        if len(samples):
+            mono[-len(samples):] = samples.mean(axis=1)
+
+        power = np.abs(np.fft.rfft(mono * self._window) * self._scale) ** 2
+
+        return np.sqrt(np.add.reduceat(power, self._edges)[:self.bands])
+
+    # Levels for the latest samples, dt seconds after the previous call, keeping within the CPU budget
+    def analyze(self, samples, dt):
+        start = self._clock()
+        levels = self.update(self.band_amplitudes(samples), dt)
+        self._cost += (self._clock() - start - self._cost) * 0.1
+
+        # Assume the cost scales with the FFT size until measured, with room to spare either way so it doesn't flip back and forth
+        if self._cost > self.budget and self._fft_size > MIN_FFT_SIZE:
+            self._set_fft_size(self._fft_size // 2)
+            self._cost /= 2
+
+        elif self._cost < self.budget / 4 and self._fft_size < self._max_fft_size:
+            self._set_fft_size(self._fft_size * 2)
+            self._cost *= 2
+
+        return levels
+
+    # Levels for band amplitudes measured dt seconds after the previous ones
+    def update(self, amplitudes, dt):
+        db = 20 * np.log10(np.maximum(amplitudes, 1e-9))
+
+        self._reference = max(self._reference - AGC_DECAY * dt, float(db.max()), FLOOR_DB)
+        target = np.clip((db - self._reference + RANGE_DB + self.gain_db) / RANGE_DB, 0, 1)
+
+        rise = 1 - math.exp(-dt / ATTACK)
+        fall = 1 - math.exp(-dt / RELEASE)
+        self.levels += (target - self.levels) * np.where(target > self.levels, rise, fall)
+
+        return self.levels
+
+    # Light each band's segment of frame up to its level, in the colors of the pixels
+    def render(self, frame, colors):
+        lit = self._position < self.levels[self._segment]
+        np.multiply(colors, lit[:, None], out=frame, casting="unsafe")
+
+        return frame
+
+    def stats(self):
+        return {
+            "fft_size": self._fft_size,
+            "analysis_us": round(self._cost * 1e6, 1),
+            "agc_reference_db": round(self._reference, 1),
+        }
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import numpy as np
+
+# Windowed sensor telemetry for the cloud.
+#
+# Every IMU sample a stick sends is folded into the current window, and
+# once per window the publisher takes a compact summary of it: minimum,
+# maximum and mean acceleration magnitude, how many clashes were detected,
+# and optionally the window downsampled to a short series of peaks. One
+# message, and one write by the IoT rule, covers a whole window, and peaks
+# between messages are no longer lost to sampling the latest value.
+
+# Decimal places kept in the published values
+PRECISION = 2
+
+class TelemetryWindow:
+    def __init__(self, series=0, clock=time.monotonic):
+        self.series = series # Points in the downsampled series, 0 for none
+
+        self._clock = clock
+        self._lock = threading.Lock() # Samples arrive on the node server thread, summaries are taken on the publisher's
+        self._reset()
+
+    def _reset(self):
+        self._start = self._clock()
+        self._count = 0
+        self._sum = 0.0
+        self._min = np.inf
+        self._max = -np.inf
+        self._clashes = 0
+        self._magnitudes = [] # Per batch, only kept for the series
+
+    # Sensor listener, called on the node server thread with every batch of samples
+    def on_samples(self, samples):
+        if not len(samples):
+            return
+
+        magnitudes = np.linalg.norm(samples["accel"], axis=1)
+
+        with self._lock:
+            self._count += len(magnitudes)
+            self._sum += float(magnitudes.sum())
+            self._min = min(self._min, float(magnitudes.min()))
+            self._max = max(self._max, float(magnitudes.max()))
+
+            if self.series:
+                self._magnitudes.append(magnitudes)
+
+    def add_clashes(self, count):
+        with self._lock:
+            self._clashes += count
+
+    # Summary of the window since the previous call, which starts a new one. None if no samples arrived.
+    def summary(self):
+        with self._lock:
+            count, total, low, high, clashes, magnitudes = self._count, self._sum, self._min, self._max, self._clashes, self._magnitudes
+            start = self._start
+            self._reset()
+
+        if not count:
+            return None
+
+        summary = {
+            "seconds": round(self._start - start, PRECISION),
+            "samples": count,
+            "min": round(low, PRECISION),
+            "max": round(high, PRECISION),
+            "mean": round(total / count, PRECISION),
+            "clashes": clashes,
+        }
+
+        if self.series:
+            summary["series"] = downsample(np.concatenate(magnitudes), self.series)
+
+        return summary
+
+# Peak of each of up to points equal slices of values, so short spikes survive
+def downsample(values, points):
+    points = min(points, len(values))
+    edges = np.linspace(0, len(values), points + 1).astype(int)[:-1]
+
+    return [round(float(peak), PRECISION) for peak in np.maximum.reduceat(values, edges)]
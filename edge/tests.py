@@ -1,5 +1,28 @@
+import asyncio
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
+from unittest.mock import patch
+import numpy as np
 import lighting
+import audio
+from framebuffer import FrameBuffer
+from framecache import FrameCache
+import gestures
+import images
+import journal
+import kernels
+from pipeline import FrameSlot
+import pov
+from registry import Registry
+import protocol
+from scheduler import FrameScheduler
+from server import NodeServer
+import spectrum
+import telemetry
 
 class TestColor(unittest.TestCase):
 
@@ -129,10 +152,196 @@ class TestBasicMode(unittest.TestCase):
         c_r, c_g, c_b = self.mode.run()
         self.assertEqual(c_r, not_coloured)
 
+class TestPatternTime(unittest.TestCase):
+
+    def setUp(self):
+        stick = lighting.Stick("time", 8)
+        stick.shadow_state["colors"] = ["FF0000"]
+        self.pattern = lighting.DotPattern(stick)
+        self.frame = np.zeros((8, 3), dtype=np.uint8)
+
+    def dot_at(self, t):
+        self.pattern.render(self.frame, t)
+        return int(np.flatnonzero(self.frame[:, 0])[0])
+
+    def test_nominal_rate(self):
+        positions = [self.dot_at(100 + i / lighting.PATTERN_FPS) for i in range(10)]
+        self.assertEqual(positions, [0, 1, 2, 3, 4, 5, 6, 7, 6, 5])
+
+    def test_skips_frames_when_late(self):
+        self.dot_at(100)
+        self.assertEqual(self.dot_at(100 + 3 / lighting.PATTERN_FPS), 3)
+
+    def test_timer_jitter(self):
+        self.dot_at(100)
+        self.assertEqual(self.dot_at(100 + 0.9 / lighting.PATTERN_FPS), 1)
+        self.assertEqual(self.dot_at(100 + 2.2 / lighting.PATTERN_FPS), 2)
+
+class TestFrameCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = FrameCache(3 * 8 * 3) # Room for three single frame tables
+
+    def table(self):
+        return np.zeros((1, 8, 3), dtype=np.uint8)
+
+    def test_hit(self):
+        table = self.cache.get("a", self.table, 24)
+
+        self.assertIs(self.cache.get("a", self.table, 24), table)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        for key in "abc":
+            self.cache.get(key, self.table, 24)
+
+        self.cache.get("a", self.table, 24)
+        self.cache.get("d", self.table, 24)
+
+        self.assertNotIn("b", self.cache)
+        self.assertIn("a", self.cache)
+        self.assertEqual(self.cache.size, self.cache.budget)
+
+    def test_over_budget(self):
+        self.assertIsNone(self.cache.get("a", self.table, self.cache.budget + 1))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_pattern_follows_colors(self):
+        lighting.locked_data.shadow_state["pattern"] = 3
+        lighting.locked_data.shadow_state["colors"] = ["FF0000"]
+        mode = lighting.BasicMode()
+
+        c_r, c_g, c_b = mode.run()
+        self.assertEqual(c_r[0], 255)
+
+        lighting.locked_data.shadow_state["colors"] = ["00FF00"]
+
+        c_r, c_g, c_b = mode.run()
+        self.assertEqual((c_r[0], c_g[0]), (0, 255))
+
+class TestKernels(unittest.TestCase):
+
+    def test_bounce(self):
+        self.assertEqual([kernels.bounce(i, 3) for i in range(6)], [0, 1, 2, 1, 0, 1])
+
+    def test_multiply_mask(self):
+        compositor = kernels.Compositor(4, [
+            kernels.Layer(lambda layer, step: kernels.fill(layer, (200, 100, 0))),
+            kernels.Layer(lambda layer, step: kernels.fill(layer, 255 * step / 4), "multiply"),
+        ])
+        frame = np.zeros((4, 3), dtype=np.uint8)
+
+        compositor.render(frame, 2)
+
+        self.assertEqual(frame[0].tolist(), [100, 50, 0])
+
+    def test_add_saturates(self):
+        compositor = kernels.Compositor(4, [
+            kernels.Layer(lambda layer, step: kernels.fill(layer, 200)),
+            kernels.Layer(lambda layer, step: kernels.dot(layer, 1, 100), "add"),
+        ])
+        frame = np.zeros((4, 3), dtype=np.uint8)
+
+        compositor.render(frame)
+
+        self.assertEqual(frame[:, 0].tolist(), [200, 255, 200, 200])
+
+    def test_rainbow_ramp(self):
+        ramp = kernels.hsv_ramp(7)
+
+        self.assertEqual(ramp[0].tolist(), [255, 0, 0])
+        self.assertEqual(ramp[2].tolist(), [0, 255, 0])
+        self.assertEqual(ramp[4].tolist(), [0, 0, 255])
+
+    def test_unknown_blend_mode(self):
+        with self.assertRaises(ValueError):
+            kernels.Layer(kernels.fill, "overlay")
+
+class TestRenderKey(unittest.TestCase):
+
+    def setUp(self):
+        self.sticks = [lighting.Stick("stick%d" % i, 8) for i in range(2)]
+
+        for stick in self.sticks:
+            stick.shadow_state.update(is_on=True, mode=1, pattern=5, colors=["FF0000"])
+
+    def test_identical_sticks_share(self):
+        keys = [lighting.render_key(stick) for stick in self.sticks]
+        self.assertEqual(keys[0], keys[1])
+
+    def test_different_config(self):
+        self.sticks[1].shadow_state["colors"] = ["00FF00"]
+
+        keys = [lighting.render_key(stick) for stick in self.sticks]
+        self.assertNotEqual(keys[0], keys[1])
+
+    def test_per_stick_modes(self):
+        for stick in self.sticks:
+            stick.shadow_state["mode"] = 2
+
+        keys = [lighting.render_key(stick) for stick in self.sticks]
+        self.assertNotEqual(keys[0], keys[1])
+
+    def test_audio_sensitivity(self):
+        for stick in self.sticks:
+            stick.shadow_state["mode"] = 4
+
+        keys = [lighting.render_key(stick) for stick in self.sticks]
+        self.assertEqual(keys[0], keys[1])
+
+        self.sticks[1].shadow_state["microphone_max"] = 16383
+
+        keys = [lighting.render_key(stick) for stick in self.sticks]
+        self.assertNotEqual(keys[0], keys[1])
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry("pattern", {"solid": 1, "sparkle": 9}, "lightstick.test")
+
+    def test_catalog_ids(self):
+        self.assertEqual(lighting.pattern_registry.get(2), lighting.DotPattern)
+        self.assertEqual(lighting.mode_registry.get(1), lighting.BasicMode)
+        self.assertIsNone(lighting.pattern_registry.get(99))
+
+    def test_plugin_loaded_lazily(self):
+        self.registry.load_plugins("sparkle=kernels:Compositor, unknown=kernels:Layer")
+
+        self.assertIn(9, self.registry)
+        self.assertEqual(self.registry._loaded, {})
+        self.assertIs(self.registry.get(9), kernels.Compositor)
+        self.assertEqual(self.registry.names(), {9: "sparkle"})
+
+    def test_broken_plugin(self):
+        self.registry.register("sparkle", "kernels:NoSuchPattern")
+
+        self.assertIs(self.registry.get(9, lighting.NullPattern), lighting.NullPattern)
+
 class TestImageMode(unittest.TestCase):
 
     def setUp(self):
-        self.mode = lighting.ImageMode()
+        from PIL import Image
+
+        self.dir = tempfile.TemporaryDirectory()
+        stick = lighting.Stick("image", lighting.NUM_PIXELS, self.dir.name)
+
+        # Red, green and blue thirds
+        pixels = np.zeros((4, lighting.NUM_PIXELS, 3), dtype=np.uint8)
+        third = lighting.NUM_PIXELS // 3
+
+        for channel in range(3):
+            pixels[:, channel * third:(channel + 1) * third, channel] = 255
+
+        Image.fromarray(pixels).save(stick.path("image"), "PNG")
+
+        with patch.object(lighting, "IMAGE_CACHE_DIR", os.path.join(self.dir.name, "cache")):
+            self.mode = lighting.ImageMode(stick)
+
+        self.mode._stream.ready.wait(5)
+
+    def tearDown(self):
+        self.mode.exit()
+        self.dir.cleanup()
 
     def test_image_size(self):
         c_r, c_g, c_b = self.mode.run()
@@ -149,5 +358,1304 @@ class TestImageMode(unittest.TestCase):
         self.assertEqual(c_g[48:96], colored)
         self.assertEqual(c_b[96:], colored)
 
+class TestWavSource(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, "audio")
+
+        # One second of a rising stereo ramp
+        self.samples = np.linspace(-32768, 32767, 8000 * 2).astype(np.int16).reshape(-1, 2)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, sample_width):
+        import wave
+
+        wide = self.samples.astype(np.int32) << 16
+        data = wide.view(np.uint8).reshape(-1, 4)[:, 4 - sample_width:]
+
+        if sample_width == 1:
+            data = ((self.samples >> 8) + 128).astype(np.uint8)
+
+        with wave.open(self.filename, "wb") as wf:
+            wf.setnchannels(2)
+            wf.setsampwidth(sample_width)
+            wf.setframerate(8000)
+            wf.writeframes(data.tobytes())
+
+        return audio.WavSource(self.filename)
+
+    def test_memory_mapped(self):
+        wav = self.write(2)
+
+        self.assertIsInstance(wav._samples, np.memmap)
+        self.assertTrue((wav.window(4000, 512) == self.samples[4000:4512]).all())
+        self.assertEqual(wav.window(8000, 512).shape, (0, 2))
+
+        wav.close()
+
+    def test_sample_widths(self):
+        for sample_width in (1, 2, 3, 4):
+            wav = self.write(sample_width)
+            window = wav.window(1000, 10)
+            expected = self.samples[1000:1010].astype(np.int32)
+
+            if sample_width == 1:
+                expected = expected >> 8 << 8
+
+            self.assertTrue((window == expected).all(), sample_width)
+            wav.close()
+
+    def test_features(self):
+        wav = self.write(2)
+        features = audio.analyze(self.filename)
+
+        self.assertEqual(len(features), audio.FEATURE_FPS)
+
+        # RMS of the FFT window starting at each frame
+        for seconds in (0, 0.25, 0.73):
+            start = int(seconds * 8000)
+            mono = self.samples[start:start + audio.FFT_SIZE].mean(axis=1)
+            self.assertAlmostEqual(audio.feature_at(features, seconds)["rms"], np.sqrt((mono ** 2).mean()) / 32768, places=5)
+
+        self.assertIsNone(audio.feature_at(features, 1.0))
+        self.assertTrue((audio.load_features(self.filename) == features).all())
+
+        # A new download makes the features stale
+        os.utime(self.filename, (time.time() + 10, time.time() + 10))
+        self.assertIsNone(audio.load_features(self.filename))
+
+        wav.close()
+
+    def test_bands_and_onsets(self):
+        # A quiet 200 Hz tone, then a loud 3 kHz one from half a second in
+        t = np.arange(8000) / 8000
+        tone = np.where(t < 0.5, 0.05 * np.sin(2 * np.pi * 200 * t), 0.8 * np.sin(2 * np.pi * 3000 * t))
+        self.samples = np.repeat((tone * 32767).astype(np.int16)[:, None], 2, axis=1)
+        self.write(2).close()
+
+        features = audio.analyze(self.filename)
+        edges = audio.band_edges(8000) * 8000 / audio.FFT_SIZE
+        band = lambda hz: np.searchsorted(edges, hz) - 1
+
+        self.assertEqual(features["bands"][20].argmax(), band(200))
+        self.assertEqual(features["bands"][80].argmax(), band(3000))
+        self.assertGreater(features["rms"][80], 10 * features["rms"][20])
+
+        # The louder tone starts a note once it reaches the analysis window, and nothing does before
+        first = (4000 - audio.FFT_SIZE) / 80
+        self.assertGreater(np.argmax(features["onset"]), first)
+        self.assertLessEqual(np.argmax(features["onset"]), 50)
+        self.assertFalse(features["onset"][:int(first)].any())
+
+class TestMicrophone(unittest.TestCase):
+
+    def test_ring_buffer_wraps(self):
+        ring = audio.RingBuffer(8, 2)
+        samples = np.arange(24, dtype=np.int16).reshape(-1, 2)
+
+        self.assertEqual(len(ring.latest(4)), 0)
+
+        ring.write(samples[:5])
+        self.assertTrue((ring.latest(4) == samples[1:5]).all())
+
+        ring.write(samples[5:]) # Past the end of the buffer
+        self.assertTrue((ring.latest(8) == samples[4:]).all())
+        self.assertTrue((ring.latest(100) == samples[4:]).all())
+        self.assertEqual(ring.written, 12)
+
+    def test_audio_mode_spectrum(self):
+        microphone = audio.Microphone()
+        t = np.arange(audio.MIC_RATE) / audio.MIC_RATE
+        tone = (8000 * np.sin(2 * np.pi * 1000 * t)).astype(np.int16)
+        microphone.buffer.write(np.repeat(tone[:, None], 2, axis=1))
+
+        with patch.object(lighting, "get_microphone", return_value=microphone):
+            mode = lighting.AudioMode()
+
+        for i in range(10):
+            c_r, c_g, c_b = mode.run(i / 90)
+
+        # Only the segment of the band with the tone in it lights up
+        lit = np.flatnonzero(np.frombuffer(c_r, dtype=np.uint8) | np.frombuffer(c_g, dtype=np.uint8))
+        segment = mode._spectrum._segment
+
+        self.assertTrue(len(lit))
+        self.assertEqual(set(segment[lit]), {mode._spectrum.levels.argmax()})
+        mode.exit()
+
+class TestSpectrum(unittest.TestCase):
+
+    def setUp(self):
+        self.analyzer = spectrum.Spectrum(8000, 80, bands=8, fft_size=1024)
+
+    def tone(self, amplitude, hz=1000):
+        t = np.arange(1024) / 8000
+        return (amplitude * np.sin(2 * np.pi * hz * t)).astype(np.int16)[:, None]
+
+    def test_agc_levels_quiet_and_loud(self):
+        for amplitude in (300, 30000):
+            analyzer = spectrum.Spectrum(8000, 80, bands=8, fft_size=1024)
+
+            for _ in range(30):
+                levels = analyzer.analyze(self.tone(amplitude), 1 / 90)
+
+            self.assertAlmostEqual(levels.max(), 1, places=2)
+
+    def test_silence_stays_dark(self):
+        for _ in range(30):
+            levels = self.analyzer.analyze(np.zeros((1024, 1), dtype=np.int16), 1 / 90)
+
+        self.assertFalse(levels.any())
+
+    def test_bars_fall_slowly(self):
+        for _ in range(30):
+            self.analyzer.analyze(self.tone(10000), 1 / 90)
+
+        levels = self.analyzer.analyze(np.zeros((1024, 1), dtype=np.int16), 1 / 90).copy()
+
+        self.assertGreater(levels.max(), 0.9)
+
+    def test_gain_shifts_bars(self):
+        levels = {}
+
+        for gain_db in (0, -12):
+            analyzer = spectrum.Spectrum(8000, 80, bands=8, fft_size=1024)
+            analyzer.gain_db = gain_db
+
+            for _ in range(30):
+                levels[gain_db] = analyzer.analyze(self.tone(10000), 1 / 90).copy()
+
+        self.assertAlmostEqual(levels[0].max(), 1, places=2)
+        self.assertAlmostEqual(levels[-12].max(), 1 - 12 / spectrum.RANGE_DB, places=2)
+
+    def test_microphone_gain(self):
+        self.assertEqual(lighting.microphone_gain(32767), 0)
+        self.assertAlmostEqual(lighting.microphone_gain(16383.5), 6.02, places=2)
+        self.assertAlmostEqual(lighting.microphone_gain(65534), -6.02, places=2)
+        self.assertEqual(lighting.microphone_gain(None), 0)
+
+    def test_render_segments(self):
+        self.analyzer.levels[:] = 0
+        self.analyzer.levels[2] = 0.5
+        frame = np.zeros((80, 3), dtype=np.uint8)
+
+        self.analyzer.render(frame, np.full((80, 3), 200, dtype=np.uint8))
+
+        self.assertEqual(list(np.flatnonzero(frame[:, 0])), list(range(20, 25)))
+
+    def test_fft_shrinks_over_budget(self):
+        now = [0.0]
+
+        def clock():
+            now[0] += 0.003 # Every analysis takes 3 ms
+            return now[0]
+
+        analyzer = spectrum.Spectrum(8000, 80, fft_size=2048, budget=0.002, clock=clock)
+
+        for _ in range(100):
+            analyzer.analyze(self.tone(1000), 1 / 90)
+
+        self.assertEqual(analyzer.fft_size, spectrum.MIN_FFT_SIZE)
+
+class TestPrepareAudio(unittest.TestCase):
+
+    def setUp(self):
+        import wave
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, "audio")
+        self.cache = os.path.join(self.dir.name, "cache")
+
+        with wave.open(self.filename, "wb") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(8000)
+            wf.writeframes(np.arange(8000, dtype=np.int16).tobytes())
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_ready_wav(self):
+        ready = audio.prepare(self.filename, self.cache)
+
+        self.assertEqual(ready, audio.ready_path(self.filename))
+        self.assertEqual(len(audio.load_features(ready)), audio.FEATURE_FPS)
+
+        wav = audio.WavSource(ready)
+        self.assertEqual(wav.frames, 8000)
+        wav.close()
+
+    def test_identical_upload_reused(self):
+        audio.prepare(self.filename, self.cache)
+
+        # Uploaded again under another name
+        copy = os.path.join(self.dir.name, "copy")
+        with open(self.filename, "rb") as src, open(copy, "wb") as dst:
+            dst.write(src.read())
+
+        with patch.object(audio, "analyze") as analyze, patch.object(audio, "transcode") as transcode:
+            ready = audio.prepare(copy, self.cache)
+
+        analyze.assert_not_called()
+        transcode.assert_not_called()
+        self.assertIsNotNone(audio.load_features(ready))
+        self.assertEqual(len(os.listdir(self.cache)), 2) # The WAV and its features
+
+    def test_transcodes_other_formats(self):
+        with open(self.filename, "wb") as f:
+            f.write(b"ID3 not a wav")
+
+        # No ffmpeg here, stand in for it
+        with patch.object(audio, "transcode", side_effect=lambda filename, path: self.write_wav(path)) as transcode:
+            ready = audio.prepare(self.filename, self.cache)
+
+        transcode.assert_called_once()
+        self.assertTrue(audio.is_wav(ready))
+        self.assertFalse(audio.is_wav(self.filename)) # The download is left alone
+
+    def test_concurrent_prepare(self):
+        results = []
+        analyze = audio.analyze
+
+        # The first analysis is slow enough for the second prepare to start meanwhile
+        def slow_analyze(filename):
+            time.sleep(0.1)
+            return analyze(filename)
+
+        with patch.object(audio, "analyze", side_effect=slow_analyze) as analyzed:
+            threads = [threading.Thread(target=lambda: results.append(audio.prepare(self.filename, self.cache))) for _ in range(2)]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(analyzed.call_count, 1)
+        self.assertEqual(results, [audio.ready_path(self.filename)] * 2)
+        self.assertEqual(len(audio.load_features(results[0])), audio.FEATURE_FPS)
+
+        # No temporary files left behind
+        self.assertEqual([f for f in os.listdir(self.dir.name) + os.listdir(self.cache) if f.endswith(".tmp")], [])
+
+    def test_failed_upload_replaces_previous(self):
+        ready = audio.prepare(self.filename, self.cache)
+
+        # A new upload that can't be transcoded
+        with open(self.filename, "wb") as f:
+            f.write(b"ID3 not a wav")
+
+        with patch.object(audio, "transcode", side_effect=RuntimeError("ffmpeg failed")):
+            with self.assertRaises(RuntimeError):
+                audio.prepare(self.filename, self.cache)
+
+        # MusicMode stays silent rather than playing the previous track
+        self.assertFalse(os.path.exists(ready))
+        self.assertFalse(os.path.exists(audio.features_path(ready)))
+
+    def write_wav(self, path):
+        import wave
+
+        with wave.open(path, "wb") as wf:
+            wf.setnchannels(2)
+            wf.setsampwidth(2)
+            wf.setframerate(8000)
+            wf.writeframes(bytes(4 * 800))
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        from PIL import Image
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, "image.png")
+        self.cache = os.path.join(self.dir.name, "cache")
+
+        pixels = np.random.randint(0, 256, (6, 4, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(self.filename)
+        self.pixels = pixels
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    # Rows decoded into the cache for num_pixels
+    def decode(self, num_pixels):
+        path = images.cache_path(self.filename, num_pixels, self.cache)
+        chunks = list(images.decode_chunks(self.filename, num_pixels, path))
+
+        self.assertTrue(all(duration is None for _, duration in chunks))
+
+        return np.concatenate([rows for rows, _ in chunks]), path
+
+    def test_narrow_image_padded(self):
+        rows, _ = self.decode(8)
+
+        self.assertEqual(rows.shape, (6, 8, 3))
+        self.assertTrue((rows[:, :4] == self.pixels).all())
+        self.assertFalse(rows[:, 4:].any())
+
+    def test_wide_image_scaled_in_chunks(self):
+        from PIL import Image
+
+        # Tall enough for several chunks, in a mode that needs converting
+        pixels = np.random.randint(0, 256, (images.CHUNK_ROWS * 6 + 10, 20, 3), dtype=np.uint8)
+        Image.fromarray(pixels).convert("P").save(self.filename)
+
+        with Image.open(self.filename) as im:
+            whole = np.asarray(images.fit_image(im, 8))
+
+        rows, _ = self.decode(8)
+
+        self.assertEqual(rows.shape, whole.shape)
+        self.assertLessEqual(np.abs(rows.astype(int) - whole).max(), 1)
+
+    def test_cached_rows_mapped(self):
+        rows, path = self.decode(8)
+        cached, durations = images.load_cached(path)
+
+        self.assertIsInstance(cached, np.memmap)
+        self.assertIsNone(durations)
+        self.assertTrue((cached == rows).all())
+        self.assertEqual(os.listdir(self.cache), [os.path.basename(path)])
+
+    def test_wide_image_resized(self):
+        rows, path = self.decode(2)
+
+        self.assertEqual(rows.shape, (3, 2, 3))
+        self.assertEqual(images.load_cached(path)[0].shape, (3, 2, 3))
+
+    def test_not_cached_until_decoded(self):
+        self.assertIsNone(images.load_cached(images.cache_path(self.filename, 8, self.cache)))
+
+class TestImageStream(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, "image")
+        self.cache = os.path.join(self.dir.name, "cache")
+        self.stream = None
+
+    def tearDown(self):
+        if self.stream is not None:
+            self.stream.close()
+
+        self.dir.cleanup()
+
+    def open(self, prefetch=images.PREFETCH):
+        self.stream = images.ImageStream(self.filename, 8, self.cache, prefetch)
+        self.stream.ready.wait(5)
+
+        return self.stream
+
+    def chunks(self, count):
+        chunks = []
+
+        while len(chunks) < count:
+            chunk = self.stream.next()
+
+            if chunk is None:
+                time.sleep(0.001)
+            else:
+                chunks.append(chunk)
+
+        return chunks
+
+    def test_tall_image_chunked(self):
+        from PIL import Image
+
+        height = images.CHUNK_ROWS * 3 + 5
+        pixels = np.random.randint(0, 256, (height, 8, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(self.filename, "PNG")
+
+        self.open(prefetch=2)
+        time.sleep(0.05)
+
+        # Decoding waits for the render thread rather than running ahead
+        self.assertEqual(self.stream._queue.qsize(), 2)
+
+        # Two passes, decoded then read back from the cache
+        for _ in range(2):
+            chunks = self.chunks(4)
+
+            self.assertEqual([len(rows) for rows, _ in chunks], [images.CHUNK_ROWS] * 3 + [5])
+            self.assertEqual({duration for _, duration in chunks}, {None})
+            self.assertTrue((np.concatenate([rows for rows, _ in chunks]) == pixels).all())
+
+    def test_animation_frames(self):
+        from PIL import Image
+
+        colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+        frames = [Image.new("RGB", (8, 4), color) for color in colors]
+        frames[0].save(self.filename, "GIF", save_all=True, append_images=frames[1:], duration=[100, 200, 300], loop=0)
+
+        self.open()
+
+        for _ in range(2):
+            chunks = self.chunks(3)
+
+            self.assertEqual([duration for _, duration in chunks], [0.1, 0.2, 0.3])
+
+            for (rows, _), color in zip(chunks, colors):
+                self.assertEqual(rows.shape, (4, 8, 3))
+                self.assertTrue((rows == color).all())
+
+    def test_animation_timing(self):
+        from PIL import Image
+
+        frames = [Image.new("RGB", (8, 2), color) for color in [(255, 0, 0), (0, 0, 255)]]
+        frames[0].save(self.filename, "PNG", save_all=True, append_images=frames[1:], duration=[250, 125], loop=0)
+
+        stick = lighting.Stick("animation", 8, self.dir.name)
+        os.rename(self.filename, stick.path("image"))
+
+        with patch.object(lighting, "IMAGE_CACHE_DIR", self.cache):
+            mode = lighting.ImageMode(stick)
+
+        try:
+            mode._stream.ready.wait(5)
+            time.sleep(0.05) # Let the next frames queue up
+
+            reds = [mode.run(t / 32)[0][0] for t in range(24)]
+
+        finally:
+            mode.exit()
+
+        # Red for 250 ms, blue for 125 ms, at 32 frames per second
+        self.assertEqual(reds, ([255] * 8 + [0] * 4) * 2)
+
+class TestFrameScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.scheduler = FrameScheduler(10, clock=lambda: self.now, sleep=self.sleep)
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def test_sleeps_remaining_budget(self):
+        self.scheduler.wait() # Anchor schedule
+
+        for i in range(5):
+            self.now += 0.03 # Render cost
+            self.scheduler.wait()
+
+        self.assertAlmostEqual(self.now, 0.5)
+        self.assertEqual(self.scheduler.late_frames, 0)
+        self.assertEqual(self.scheduler.dropped_frames, 0)
+
+    def test_late_frame_does_not_drift(self):
+        self.scheduler.wait()
+
+        self.now += 0.15 # Late by half a frame
+        self.scheduler.wait()
+        self.assertAlmostEqual(self.now, 0.15) # No sleep when late
+
+        self.now += 0.01
+        self.scheduler.wait()
+        self.assertAlmostEqual(self.now, 0.2) # Back on the original schedule
+
+        self.assertEqual(self.scheduler.late_frames, 1)
+        self.assertEqual(self.scheduler.dropped_frames, 0)
+
+    def test_dropped_frames(self):
+        self.scheduler.wait()
+
+        self.now += 0.35 # Missed the slots ending at 0.2 and 0.3
+        self.scheduler.wait()
+
+        self.now += 0.01
+        self.scheduler.wait()
+        self.assertAlmostEqual(self.now, 0.4)
+
+        self.assertEqual(self.scheduler.late_frames, 1)
+        self.assertEqual(self.scheduler.dropped_frames, 2)
+
+class TestRowClock(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.emitted = []
+        self.tracker = pov.SwingTracker(clock=self.clock)
+        self.rows = pov.RowClock(self.emit, self.tracker, row_angle=0.01, fallback_rate=90, max_rate=1000,
+            clock=self.clock, sleep=self.sleep)
+
+    # Every reading takes a little time, so spinning on the clock moves it forward
+    def clock(self):
+        self.now += 1e-6
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+        if self.now > 1:
+            self.rows.stop()
+
+    def emit(self):
+        self.emitted.append(self.now)
+
+        if len(self.emitted) == 10:
+            self.rows.stop()
+
+    def swing(self, rate):
+        samples = np.zeros(1, dtype=protocol.SAMPLE)
+        samples["gyro"] = (0, 0, rate)
+        self.tracker.on_samples(samples)
+
+    def intervals(self):
+        return np.diff(self.emitted)
+
+    def test_fixed_rate_without_gyro(self):
+        samples = np.zeros(1, dtype=protocol.SAMPLE)
+        samples["accel"] = (9.8, 0, 0) # As parsed from a legacy node
+        self.tracker.on_samples(samples)
+        self.rows.run()
+
+        self.assertFalse(self.tracker.has_gyro)
+        self.assertTrue(np.allclose(self.intervals(), 1 / 90, atol=1e-5))
+
+    def test_rate_follows_swing(self):
+        self.swing(-2.0) # 200 rows per second, either way round
+        self.rows.run()
+
+        self.assertTrue(np.allclose(self.intervals(), 0.005, atol=1e-5))
+        self.assertEqual(self.rows.row_rate, 200)
+        self.assertLess(self.rows.stats()["jitter_us"]["max"], 10)
+
+    def test_rate_capped(self):
+        self.swing(50.0)
+        self.rows.run()
+
+        self.assertTrue(np.allclose(self.intervals(), 0.001, atol=1e-5))
+
+    def test_held_still(self):
+        self.swing(2.0)
+        self.swing(0.0)
+        self.rows.run()
+
+        self.assertEqual(self.emitted, [])
+
+    def test_stale_swing(self):
+        self.swing(2.0)
+        self.now += pov.STALE + 0.01
+        self.rows.run()
+
+        self.assertEqual(self.emitted, [])
+
+    def test_late_row_restarts_schedule(self):
+        self.swing(2.0)
+
+        def emit():
+            self.emit()
+
+            if len(self.emitted) == 3:
+                self.now += 0.012 # Stalled for over two rows
+                self.swing(2.0)
+
+        self.rows._emit = emit
+        self.rows.run()
+
+        self.assertEqual(self.rows.late_rows, 1)
+        self.assertAlmostEqual(self.intervals()[2], 0.012, delta=1e-4)
+        self.assertTrue(np.allclose(self.intervals()[3:], 0.005, atol=1e-5))
+
+class TestFrameSlot(unittest.TestCase):
+
+    def test_latest_frame_wins(self):
+        slot = FrameSlot(4)
+        frame = FrameBuffer(4)
+
+        for value in (1, 2, 3):
+            frame.back[:] = value
+            frame.swap()
+            slot.publish(frame.front)
+
+        out = FrameBuffer(4)
+        seq = slot.read(out.back)
+        c_r, c_g, c_b = out.swap()
+
+        self.assertEqual(seq, 3)
+        self.assertEqual(c_r, bytearray([3] * 4))
+
+    def test_read_unchanged(self):
+        slot = FrameSlot(4)
+        out = FrameBuffer(4)
+
+        seq = slot.read(out.back)
+        out.back[:] = 7
+
+        self.assertEqual(slot.read(out.back, since=seq), seq)
+        self.assertEqual(out.back[0, 0], 7) # Not overwritten
+
+class TestProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = protocol.FrameEncoder(8)
+        self.decoder = protocol.FrameDecoder(8)
+        self.frame = FrameBuffer(8)
+
+    def send(self):
+        packet = self.encoder.encode(self.frame.front)
+
+        if packet is not None:
+            self.decoder.feed(packet)
+
+        return packet
+
+    def test_roundtrip(self):
+        for value in (10, 20):
+            self.frame.back[:] = value
+            self.frame.back[3] = (1, 2, 3)
+            self.frame.swap()
+            self.send()
+
+            self.assertTrue((self.decoder.frame == self.frame.front).all())
+
+    def test_unchanged_frame_not_sent(self):
+        self.send()
+        self.assertIsNone(self.send())
+        self.assertEqual(self.encoder.frames_unchanged, 1)
+
+    def test_delta_covers_changed_range(self):
+        self.send() # Keyframe
+
+        self.frame.back[2:5] = 255
+        self.frame.swap()
+        packet = self.send()
+
+        header = protocol.HEADER.unpack_from(packet)
+        self.assertEqual(header[6:8], (2, 3)) # start, count
+        self.assertTrue((self.decoder.frame == self.frame.front).all())
+
+    def test_credit_packet(self):
+        header = protocol.unpack_header(protocol.pack_credit(2))
+
+        self.assertEqual(header[2], protocol.PACKET_CREDIT)
+        self.assertEqual(header[7:], (2, 0)) # count, length
+
+    def test_chunked_stream(self):
+        self.frame.back[:4] = (255, 0, 0)
+        self.frame.swap()
+        packet = protocol.pack_accept(1, protocol.ALL_ENCODINGS) + self.encoder.encode(self.frame.front)
+
+        frames = sum(self.decoder.feed(packet[i:i + 3]) for i in range(0, len(packet), 3))
+
+        self.assertEqual(frames, 1)
+        self.assertEqual(self.decoder.accepted, (1, protocol.ALL_ENCODINGS))
+        self.assertTrue((self.decoder.frame == self.frame.front).all())
+
+class TestSensorParsers(unittest.TestCase):
+
+    def setUp(self):
+        self.samples = []
+
+    def on_packet(self, packet_type, count, payload):
+        self.assertEqual(packet_type, protocol.PACKET_SENSOR)
+        self.samples.extend(protocol.unpack_samples(payload, count)["timestamp"])
+
+    def test_packet_reader_every_sample(self):
+        reader = protocol.PacketReader(self.on_packet)
+
+        samples = np.zeros(3, dtype=protocol.SAMPLE)
+        samples["timestamp"] = (1, 2, 3)
+        data = protocol.pack_sensor(samples[:2]) + protocol.pack_sensor(samples[2:])
+
+        for i in range(len(data)):
+            reader.feed(data[i:i + 1])
+
+        self.assertEqual(self.samples, [1, 2, 3])
+
+    def test_packet_reader_rejects_oversized(self):
+        reader = protocol.PacketReader(self.on_packet)
+
+        with self.assertRaises(protocol.ProtocolError):
+            reader.feed(protocol.pack_header(protocol.PACKET_SENSOR, length=protocol.MAX_UPLINK_PAYLOAD + 1))
+
+    def test_legacy_reading_split_across_chunks(self):
+        parser = protocol.LegacySampleParser(lambda samples: self.samples.extend(samples["accel"][:, 0]))
+
+        parser.feed(b"9.5|1")
+        parser.feed(b"2.25|")
+
+        self.assertEqual(self.samples, [9.5, 12.25])
+
+class TestNodeServer(unittest.IsolatedAsyncioTestCase):
+
+    NUM_PIXELS = 8
+
+    def setUp(self):
+        self.slot = FrameSlot(self.NUM_PIXELS)
+        self.samples = []
+        self.server = NodeServer(0, {"stick": self.slot}, "stick", on_samples=self.on_samples, host="127.0.0.1")
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    # Called on the server thread, samples are only valid during the call
+    def on_samples(self, client, samples):
+        self.samples.append((client, samples.copy()))
+
+    async def connect(self, hello=b"HELLO stick\n", sock=None):
+        if sock is None:
+            reader, writer = await asyncio.open_connection("127.0.0.1", self.server.port)
+        else:
+            sock.connect(("127.0.0.1", self.server.port))
+            sock.setblocking(False)
+            reader, writer = await asyncio.open_connection(sock=sock)
+
+        self.addAsyncCleanup(self.disconnect, writer)
+        writer.write(hello)
+        await writer.drain()
+
+        return reader, writer
+
+    async def disconnect(self, writer):
+        writer.close()
+
+        try:
+            await writer.wait_closed()
+
+        except ConnectionError:
+            pass
+
+    # Wait until the server has attached count clients to a stick
+    async def attached(self, count=1):
+        for _ in range(200):
+            if sum(client.feed is not None for client in self.server.clients) >= count:
+                return
+
+            await asyncio.sleep(0.01)
+
+        self.fail("Clients not attached")
+
+    async def until(self, condition, timeout=5):
+        for _ in range(int(timeout / 0.01)):
+            if condition():
+                return
+
+            await asyncio.sleep(0.01)
+
+        self.fail("Timed out")
+
+    def frame(self, value):
+        frame = np.zeros((self.NUM_PIXELS, 3), dtype=np.uint8, order="F")
+        frame[:, 0] = value
+        frame[:, 2] = 255 - value
+
+        return frame
+
+    async def test_raw_frames(self):
+        reader, _ = await self.connect()
+        await self.attached()
+
+        for value in (10, 20):
+            frame = self.frame(value)
+            self.slot.publish(frame)
+
+            data = await asyncio.wait_for(reader.readexactly(self.NUM_PIXELS * 3), 5)
+            self.assertEqual(data, frame.tobytes(order="F"))
+
+    async def test_slow_client_skips_frames(self):
+        num_pixels = 5000
+        slot = FrameSlot(num_pixels)
+        server = NodeServer(0, {"stick": slot}, "stick", host="127.0.0.1")
+        server.start()
+        self.addCleanup(server.stop)
+
+        # A node that never reads, with as little buffering as the kernel allows
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(("127.0.0.1", server.port))
+        self.addCleanup(sock.close)
+        sock.sendall(b"HELLO stick\n")
+
+        frame = np.zeros((num_pixels, 3), dtype=np.uint8, order="F")
+
+        for i in range(500):
+            frame[:] = i % 256
+            slot.publish(frame)
+            await asyncio.sleep(0.001)
+
+            if server.stats()["frames_skipped"] > 10:
+                break
+
+        self.assertGreater(server.stats()["frames_skipped"], 10)
+
+    async def test_legacy_samples(self):
+        # Older nodes stream readings straight away without a HELLO
+        reader, writer = await self.connect(b"9.5|12.25|")
+        await self.until(lambda: sum(len(samples) for _, samples in self.samples) >= 2)
+
+        names = {client.name for client, _ in self.samples}
+        magnitudes = np.concatenate([samples["accel"][:, 0] for _, samples in self.samples])
+
+        self.assertEqual(names, {"stick"})
+        np.testing.assert_allclose(magnitudes, [9.5, 12.25])
+
+        # And get frames as raw dumps like any other node
+        frame = self.frame(30)
+        self.slot.publish(frame)
+
+        data = await asyncio.wait_for(reader.readexactly(self.NUM_PIXELS * 3), 5)
+        self.assertEqual(data, frame.tobytes(order="F"))
+
+    async def test_display_only_node(self):
+        # Nodes that never send anything are attached to the default stick after HELLO_TIMEOUT
+        with patch.object(NodeServer, "HELLO_TIMEOUT", 0.1):
+            reader, _ = await self.connect(b"")
+            await self.attached()
+
+        self.assertEqual(self.server.clients[0].name, "stick")
+
+        frame = self.frame(40)
+        self.slot.publish(frame)
+
+        data = await asyncio.wait_for(reader.readexactly(self.NUM_PIXELS * 3), 5)
+        self.assertEqual(data, frame.tobytes(order="F"))
+
+    async def read_packet(self, reader, timeout=5):
+        header = protocol.unpack_header(await asyncio.wait_for(reader.readexactly(protocol.HEADER.size), timeout))
+        payload = await asyncio.wait_for(reader.readexactly(header[-1]), timeout)
+
+        return header[2], payload
+
+    # Connect with flow control, raw frames only, and wait for the edge to accept
+    async def connect_v2(self):
+        reader, writer = await self.connect(b"HELLO stick %d %d\n" % (protocol.FLOW_CONTROL_VERSION, 1 << protocol.ENCODING_RAW))
+
+        packet_type, _ = await self.read_packet(reader)
+        self.assertEqual(packet_type, protocol.PACKET_ACCEPT)
+        await self.attached()
+
+        return reader, writer
+
+    # Frames received until none arrive for a while
+    async def received_frames(self, reader):
+        frames = 0
+
+        while True:
+            try:
+                packet_type, _ = await self.read_packet(reader, timeout=0.2)
+
+            except asyncio.TimeoutError:
+                return frames
+
+            self.assertEqual(packet_type, protocol.PACKET_FRAME)
+            frames += 1
+
+    async def test_no_credits_no_frames(self):
+        reader, _ = await self.connect_v2()
+
+        for value in range(5):
+            await asyncio.sleep(0.02) # Frames published between two turns of the server's loop count once
+            self.slot.publish(self.frame(value * 10 + 10))
+
+        # The newest frame is held for when credits come, the ones it replaced are dropped
+        await self.until(lambda: self.server.stats()["frames_dropped"] == 4)
+
+        self.assertEqual(await self.received_frames(reader), 0)
+        self.assertEqual(self.server.stats()["frames_sent"], 0)
+
+    async def test_frames_limited_to_credits(self):
+        reader, writer = await self.connect_v2()
+        self.slot.publish(self.frame(10))
+
+        writer.write(protocol.pack_credit(2))
+        await writer.drain()
+
+        # Far more frames than credits, spaced out so none of them is skipped for being superseded
+        for value in range(5):
+            await asyncio.sleep(0.02)
+            self.slot.publish(self.frame(value * 10 + 20))
+
+        self.assertEqual(await self.received_frames(reader), 2)
+        self.assertEqual(self.server.stats()["frames_sent"], 2)
+        self.assertGreater(self.server.stats()["frames_dropped"], 0)
+
+        # More credits, and the newest frame goes out straight away
+        writer.write(protocol.pack_credit(1))
+        await writer.drain()
+
+        self.assertEqual(await self.received_frames(reader), 1)
+
+    async def test_sensor_uplink_by_version(self):
+        samples = np.zeros(3, dtype=protocol.SAMPLE)
+        samples["timestamp"] = [1000, 1010, 1020]
+        samples["accel"] = [[0, 0, 9.81], [1, 2, 3], [-4, 5, 6.5]]
+        samples["gyro"] = [[0, 0, 0], [0.5, -0.25, 1], [2, 0, -3]]
+
+        # v2 node sending binary sensor packets, v1 node on the same server sending ASCII readings
+        _, binary = await self.connect_v2()
+        _, ascii = await self.connect(b"HELLO stick 1 1\n9.5|")
+
+        binary.write(protocol.pack_sensor(samples[:2]) + protocol.pack_sensor(samples[2:]))
+        await binary.drain()
+
+        await self.until(lambda: sum(len(batch) for _, batch in self.samples) >= 4)
+
+        decoded = np.concatenate([batch for client, batch in self.samples if client.credits is not None])
+        legacy = np.concatenate([batch for client, batch in self.samples if client.credits is None])
+
+        np.testing.assert_array_equal(decoded, samples)
+        np.testing.assert_allclose(legacy["accel"], [[9.5, 0, 0]])
+        np.testing.assert_array_equal(legacy["gyro"], np.zeros((1, 3)))
+
+    async def test_readings_before_accept(self):
+        samples = np.zeros(1, dtype=protocol.SAMPLE)
+        samples["accel"] = [[1, 2, 3]]
+
+        # The node streams readings until it has read ACCEPT, then switches to packets
+        reader, writer = await self.connect(b"HELLO stick %d %d\n9.81|" % (protocol.FLOW_CONTROL_VERSION, 1 << protocol.ENCODING_RAW))
+
+        packet_type, _ = await self.read_packet(reader)
+        self.assertEqual(packet_type, protocol.PACKET_ACCEPT)
+
+        writer.write(b"12.5|" + protocol.pack_sensor(samples) + protocol.pack_credit(1))
+        await writer.drain()
+
+        await self.until(lambda: sum(len(batch) for _, batch in self.samples) >= 3)
+
+        received = np.concatenate([batch for _, batch in self.samples])
+        np.testing.assert_allclose(received["accel"], [[9.81, 0, 0], [12.5, 0, 0], [1, 2, 3]], rtol=1e-6)
+
+        # Still connected, and its credit counted
+        self.slot.publish(self.frame(50))
+
+        packet_type, _ = await self.read_packet(reader)
+        self.assertEqual(packet_type, protocol.PACKET_FRAME)
+
+    async def test_unknown_stick_closed(self):
+        reader, _ = await self.connect(b"HELLO other\n")
+
+        self.assertEqual(await asyncio.wait_for(reader.read(), 5), b"")
+
+    async def test_stop_closes_clients(self):
+        readers = []
+
+        for _ in range(3):
+            reader, _ = await self.connect()
+            readers.append(reader)
+
+        await self.attached(3)
+
+        with patch("builtins.print") as printed:
+            await asyncio.get_running_loop().run_in_executor(None, self.server.stop)
+
+        for reader in readers:
+            self.assertEqual(await asyncio.wait_for(reader.read(), 5), b"")
+
+        self.assertEqual(self.server.clients, [])
+
+        # Closing on purpose isn't a lost connection
+        messages = [" ".join(str(arg) for arg in call.args) for call in printed.call_args_list]
+        self.assertFalse([message for message in messages if "Received 0 bytes" in message or "Error" in message])
+
+class TestLightsaberMode(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+        # Don't start publishing sensor data to the cloud
+        with patch.object(lighting, "publish_sensors_data"):
+            self.mode = lighting.LightsaberMode()
+            self.mode.run()
+
+    def tearDown(self):
+        self.mode.exit()
+
+    def test_sounds_preloaded(self):
+        self.assertEqual(len(self.mode._sounds), 7)
+        self.assertAlmostEqual(self.mode._start_length, 1408, delta=1)
+
+    def test_no_decoding_while_running(self):
+        import pygame
+
+        self.mode._phase = 1
+
+        with patch.object(pygame.mixer, "Sound", side_effect=AssertionError("decoded in run()")), \
+                patch("builtins.open", side_effect=AssertionError("opened in run()")):
+            for kind in (gestures.CLASH, gestures.SWING, gestures.SWING, None):
+                if kind is not None:
+                    self.mode._gestures._events.put(gestures.Gesture(kind, 20, 0, 0.0))
+
+                c_r, _, _ = self.mode.run()
+
+        self.assertEqual(len(c_r), lighting.NUM_PIXELS)
+
+    def test_start_sound_fills_strip(self):
+        self.mode._started -= self.mode._start_length / 2000 # Half way through
+
+        self.mode.run()
+        self.assertAlmostEqual(self.mode._pixels, lighting.NUM_PIXELS / 2, delta=2)
+
+        self.mode._started -= self.mode._start_length / 1000
+        self.mode.run()
+        self.assertEqual(self.mode._phase, 1)
+
+class TestGestureDetector(unittest.TestCase):
+
+    # Samples every 10 ms from timestamp start, at rest (gravity only) unless given
+    def samples(self, count, start=0, accel=None, gyro=None):
+        samples = np.zeros(count, dtype=protocol.SAMPLE)
+        samples["timestamp"] = start + np.arange(count) * 10
+        samples["accel"][:, 2] = 9.81 if accel is None else accel
+        samples["gyro"][:, 2] = 0 if gyro is None else gyro
+
+        return samples
+
+    def test_clash_once(self):
+        detector = gestures.GestureDetector()
+        accel = np.full(100, 9.81)
+        accel[50:53] = (40, 35, 25) # A hit, ringing for a few samples
+        accel[60] = 35 # Still inside the refractory window
+
+        events = detector.process(self.samples(100, accel=accel, gyro=0.1), 0, lambda: 0)
+
+        self.assertEqual([event.kind for event in events], [gestures.CLASH])
+        self.assertEqual(events[0].timestamp, 510)
+        self.assertGreater(events[0].strength, gestures.CLASH_ACCEL)
+
+    def test_slow_push_not_clash(self):
+        detector = gestures.GestureDetector()
+        accel = 9.81 + np.concatenate((np.linspace(0, 15, 50), np.linspace(15, 0, 50)))
+
+        events = detector.process(self.samples(100, accel=accel, gyro=0.1), 0, lambda: 0)
+
+        self.assertNotIn(gestures.CLASH, [event.kind for event in events])
+
+    def test_swing(self):
+        detector = gestures.GestureDetector()
+        gyro = np.full(200, 0.1)
+        gyro[50:80] = 8
+        gyro[150:180] = 8
+
+        events = detector.process(self.samples(200, gyro=gyro), 0, lambda: 0)
+
+        self.assertEqual([event.kind for event in events], [gestures.SWING, gestures.SWING])
+
+    def test_legacy_swing(self):
+        detector = gestures.GestureDetector()
+        accel = np.full(100, 9.81)
+        accel[50:60] = 15
+
+        # Legacy nodes send the magnitude alone and stamp the whole batch alike
+        samples = np.zeros(100, dtype=protocol.SAMPLE)
+        samples["accel"][:, 0] = accel
+
+        events = detector.process(samples, 0, lambda: 0)
+
+        self.assertFalse(detector.has_gyro)
+        self.assertEqual([event.kind for event in events], [gestures.SWING])
+
+    def test_latency(self):
+        detector = gestures.GestureDetector()
+        accel = np.full(100, 9.81)
+        accel[50] = 40
+
+        # Batch arrived at 10 s, detected at 10.005 s, the peak sample was taken 480 ms before the last one
+        events = detector.process(self.samples(100, accel=accel, gyro=0.1), 10, lambda: 10.005)
+
+        self.assertAlmostEqual(events[0].latency, 0.485)
+
+    def test_engine(self):
+        engine = gestures.GestureEngine()
+        accel = np.full(100, 9.81)
+        accel[50] = 40
+
+        for start in range(0, 100, 10):
+            engine.on_samples(self.samples(10, start * 10, accel[start:start + 10], 0.1))
+
+        engine.stop()
+
+        self.assertEqual([event.kind for event in engine.events()], [gestures.CLASH])
+        self.assertEqual(engine.stats()["samples"], 100)
+        self.assertEqual(engine.stats()["clashes"], 1)
+
+class TestTelemetryWindow(unittest.TestCase):
+
+    def samples(self, magnitudes):
+        samples = np.zeros(len(magnitudes), dtype=protocol.SAMPLE)
+        samples["accel"][:, 2] = magnitudes
+
+        return samples
+
+    def test_summary(self):
+        now = [0.0]
+        window = telemetry.TelemetryWindow(clock=lambda: now[0])
+
+        window.on_samples(self.samples([9.8, 10, 30]))
+        window.on_samples(self.samples([9.6]))
+        window.add_clashes(1)
+        now[0] = 1.0
+
+        summary = window.summary()
+
+        self.assertEqual(summary["seconds"], 1.0)
+        self.assertEqual(summary["samples"], 4)
+        self.assertEqual(summary["min"], 9.6)
+        self.assertEqual(summary["max"], 30)
+        self.assertEqual(summary["mean"], 14.85)
+        self.assertEqual(summary["clashes"], 1)
+        self.assertNotIn("series", summary)
+
+        # The next window starts empty
+        self.assertIsNone(window.summary())
+
+    def test_series_keeps_peaks(self):
+        window = telemetry.TelemetryWindow(series=4)
+        magnitudes = np.full(100, 9.8)
+        magnitudes[37] = 40
+
+        for start in range(0, 100, 10):
+            window.on_samples(self.samples(magnitudes[start:start + 10]))
+
+        self.assertEqual(window.summary()["series"], [9.8, 40, 9.8, 9.8])
+
+    def test_series_short_window(self):
+        window = telemetry.TelemetryWindow(series=8)
+        window.on_samples(self.samples([1, 2]))
+
+        self.assertEqual(window.summary()["series"], [1, 2])
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "telemetry.db")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_store_and_forward(self):
+        j = journal.Journal(self.path)
+
+        for i in range(5):
+            j.append("topic", str(i))
+
+        messages = j.peek(3)
+        self.assertEqual([payload for _, _, payload in messages], ["0", "1", "2"])
+
+        j.remove(messages[1][0])
+        self.assertEqual(j.depth, 3)
+        j.close()
+
+        # Still there after a restart
+        j = journal.Journal(self.path)
+        self.assertEqual(j.depth, 3)
+        self.assertEqual([payload for _, _, payload in j.peek(10)], ["2", "3", "4"])
+        j.close()
+
+    def test_rotation(self):
+        max_bytes = 64 * 1024
+        j = journal.Journal(self.path, max_bytes=max_bytes)
+
+        for i in range(100):
+            j.append("topic", "%03d" % i + "x" * 1000)
+
+        payloads = [payload[:3] for _, _, payload in j.peek(100)]
+
+        self.assertLessEqual(j.size, max_bytes)
+        self.assertGreater(j.dropped, 0)
+        self.assertEqual(j.depth + j.dropped, 100)
+        self.assertEqual(payloads, ["%03d" % i for i in range(j.dropped, 100)])
+        j.close()
+
+class TestDrainer(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.journal = journal.Journal(os.path.join(self.dir.name, "telemetry.db"))
+        self.published = []
+        self.times = []
+        self.fail_at = None
+
+    def tearDown(self):
+        self.journal.close()
+        self.dir.cleanup()
+
+    def publish(self, topic, payload):
+        from concurrent.futures import Future
+
+        future = Future()
+
+        if payload == self.fail_at:
+            future.set_exception(RuntimeError("no ack"))
+        else:
+            self.published.append(payload)
+            self.times.append(time.perf_counter())
+            future.set_result(None)
+
+        return future
+
+    def test_drain_in_batches(self):
+        drainer = journal.Drainer(self.journal, self.publish, batch=4, rate=1000)
+
+        for i in range(6):
+            drainer.append("topic", str(i))
+
+        self.assertEqual(drainer.drain(), (4, True))
+        self.assertEqual(drainer.drain(), (2, True))
+        self.assertEqual(self.published, [str(i) for i in range(6)])
+        self.assertEqual(drainer.stats()["depth"], 0)
+
+    def test_unacknowledged_kept(self):
+        drainer = journal.Drainer(self.journal, self.publish, batch=4, rate=1000)
+
+        for i in range(4):
+            drainer.append("topic", str(i))
+
+        self.fail_at = "2"
+        self.assertEqual(drainer.drain(), (2, False))
+        self.assertEqual(self.journal.depth, 2)
+
+        # Sent again once it goes through
+        self.fail_at = None
+        self.assertEqual(drainer.drain(), (2, True))
+        self.assertEqual(self.published, ["0", "1", "3", "2", "3"])
+
+    def test_rate_limit(self):
+        drainer = journal.Drainer(self.journal, self.publish, batch=5, rate=100)
+
+        for i in range(20):
+            drainer.append("topic", str(i))
+
+        start = time.perf_counter()
+        drainer.connected.set()
+        drainer.start()
+
+        while self.journal.depth and time.perf_counter() - start < 5:
+            time.sleep(0.01)
+
+        elapsed = time.perf_counter() - start
+        drainer.stop()
+
+        self.assertEqual(len(self.published), 20)
+        self.assertGreaterEqual(elapsed, 0.18) # 20 messages at 100 per second
+
+        # Spaced out, not sent a batch at a time
+        gaps = np.diff(self.times)
+        self.assertGreaterEqual(gaps.min(), 0.005)
+        self.assertGreaterEqual(self.times[-1] - self.times[0], 0.18)
+
+    def test_waits_for_connection(self):
+        drainer = journal.Drainer(self.journal, self.publish, rate=1000)
+        drainer.start()
+        drainer.append("topic", "0")
+        time.sleep(0.05)
+
+        self.assertEqual(self.published, [])
+
+        drainer.on_connection_resumed(None, 0, True)
+        start = time.perf_counter()
+
+        while self.journal.depth and time.perf_counter() - start < 5:
+            time.sleep(0.01)
+
+        drainer.stop()
+        self.assertEqual(self.published, ["0"])
+
 if __name__ == '__main__':
     unittest.main()
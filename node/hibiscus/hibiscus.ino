@@ -1,6 +1,7 @@
 #include <Arduino.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <WiFi.h>
 
 #include <Adafruit_DotStar.h>
@@ -12,14 +13,47 @@
 
 #define WIFI_TIMEOUT_MS 20000
 
+// Framed frame protocol, see edge/protocol.py
+#define PROTOCOL_VERSION 2
+#define FLOW_CONTROL_VERSION 2
+
+#define PACKET_HEADER_SIZE 14
+#define PACKET_FRAME 1
+#define PACKET_ACCEPT 2
+#define PACKET_CREDIT 3
+#define PACKET_SENSOR 4
+
+// Frames the edge may have in flight to us at once
+#define CREDIT_WINDOW 2
+
+// IMU sample: uint32 timestamp in ms, accel x/y/z in m/s^2, gyro x/y/z in rad/s
+#define SAMPLE_SIZE (4 + 6 * 4)
+
+#define ENCODING_RAW 0
+#define ENCODING_RLE 1
+#define ENCODING_PALETTE 2
+#define ENCODINGS ((1 << ENCODING_RAW) | (1 << ENCODING_RLE) | (1 << ENCODING_PALETTE))
+
+// Largest payload of any encoding: RLE with one run per pixel, or a full palette
+#define RLE_MAX_PAYLOAD (NUM_PIXELS * 4)
+#define PALETTE_MAX_PAYLOAD (1 + 255 * 3 + NUM_PIXELS)
+#define MAX_PAYLOAD (RLE_MAX_PAYLOAD > PALETTE_MAX_PAYLOAD ? RLE_MAX_PAYLOAD : PALETTE_MAX_PAYLOAD)
+
 IPAddress server(address[0], address[1], address[2], address[3]);
 WiFiClient client;
 
 Adafruit_DotStar strip(NUM_PIXELS, 23, 18, DOTSTAR_BGR);
 Adafruit_MPU6050 mpu;
 Adafruit_Sensor* accel;
+Adafruit_Sensor* gyro;
 
 sensors_event_t event;
+sensors_event_t gyroEvent;
+
+uint8_t header[PACKET_HEADER_SIZE];
+uint8_t payload[MAX_PAYLOAD];
+bool hasHeader = false;
+uint8_t acceptedVersion = 0; // Protocol version the edge answered with, 0 until it did
 
 void connectToWiFi() {
   Serial.print("Connecting to WiFi");
@@ -46,11 +80,155 @@ void connectToWiFi() {
 void connectToServer() {
   if (client.connect(server, 12345)) {
     Serial.println("Connected to server.");
+
+    // Tell the edge which lightstick this node is, and which protocol it speaks
+    client.print("HELLO ");
+    client.print(THING_NAME);
+    client.print(" ");
+    client.print(PROTOCOL_VERSION);
+    client.print(" ");
+    client.print(ENCODINGS);
+    client.print("\n");
+
+    hasHeader = false;
+    acceptedVersion = 0;
   } else {
     Serial.println("Failed to connect to server.");
   }
 }
 
+uint16_t readUint16(const uint8_t* data) {
+  return data[0] | (data[1] << 8);
+}
+
+void writeUint16(uint8_t* data, uint16_t value) {
+  data[0] = value & 0xFF;
+  data[1] = value >> 8;
+}
+
+void sendPacket(uint8_t type, uint16_t count, const uint8_t* data, uint16_t length) {
+  uint8_t packet[PACKET_HEADER_SIZE] = {'L', 'P', acceptedVersion, type};
+
+  writeUint16(packet + 10, count);
+  writeUint16(packet + 12, length);
+
+  client.write(packet, PACKET_HEADER_SIZE);
+
+  if (length > 0) {
+    client.write(data, length);
+  }
+}
+
+// Send one IMU sample, as little-endian values like the ESP32 stores them
+void sendSample() {
+  uint8_t sample[SAMPLE_SIZE];
+  uint32_t timestamp = millis();
+  float values[6] = {
+    event.acceleration.x, event.acceleration.y, event.acceleration.z,
+    gyroEvent.gyro.x, gyroEvent.gyro.y, gyroEvent.gyro.z,
+  };
+
+  memcpy(sample, &timestamp, 4);
+  memcpy(sample + 4, values, sizeof(values));
+
+  sendPacket(PACKET_SENSOR, 1, sample, SAMPLE_SIZE);
+}
+
+// Ask the edge for more frames
+void grantCredits(uint16_t credits) {
+  if (acceptedVersion >= FLOW_CONTROL_VERSION) {
+    sendPacket(PACKET_CREDIT, credits, NULL, 0);
+  }
+}
+
+void decodeFrame(uint8_t encoding, uint16_t start, uint16_t count, uint16_t length) {
+  if (start + count > NUM_PIXELS) {
+    return;
+  }
+
+  uint16_t end = start + count;
+
+  if (encoding == ENCODING_RAW) {
+    if (length < count * 3) {
+      return;
+    }
+
+    for (uint16_t i = 0; i < count; i++) {
+      strip.setPixelColor(start + i, payload[i * 3], payload[i * 3 + 1], payload[i * 3 + 2]);
+    }
+  } else if (encoding == ENCODING_RLE) {
+    uint16_t pixel = start;
+
+    // Runs of (length, r, g, b)
+    for (uint16_t p = 0; p + 3 < length && pixel < end; p += 4) {
+      for (uint8_t i = 0; i < payload[p] && pixel < end; i++) {
+        strip.setPixelColor(pixel++, payload[p + 1], payload[p + 2], payload[p + 3]);
+      }
+    }
+  } else if (encoding == ENCODING_PALETTE) {
+    uint8_t size = payload[0];
+    const uint8_t* palette = payload + 1;
+    const uint8_t* indices = palette + size * 3;
+
+    if (length < 1 + size * 3 + count) {
+      return;
+    }
+
+    for (uint16_t i = 0; i < count; i++) {
+      uint8_t index = indices[i] < size ? indices[i] : 0;
+      strip.setPixelColor(start + i, palette[index * 3], palette[index * 3 + 1], palette[index * 3 + 2]);
+    }
+  } else {
+    return;
+  }
+
+  strip.show();
+}
+
+// Decode every complete packet available from the edge
+void readPackets() {
+  while (true) {
+    if (!hasHeader) {
+      if (client.available() < PACKET_HEADER_SIZE) {
+        return;
+      }
+
+      client.read(header, PACKET_HEADER_SIZE);
+
+      // Lost track of packet boundaries, start over with a fresh connection
+      if (header[0] != 'L' || header[1] != 'P' || readUint16(header + 12) > MAX_PAYLOAD) {
+        Serial.println("Invalid packet from server.");
+        client.stop();
+        return;
+      }
+
+      hasHeader = true;
+    }
+
+    uint16_t length = readUint16(header + 12);
+
+    if (client.available() < length) {
+      return;
+    }
+
+    client.read(payload, length);
+    hasHeader = false;
+
+    if (header[3] == PACKET_FRAME) {
+      decodeFrame(header[4], readUint16(header + 8), readUint16(header + 10), length);
+
+      // Shown (or skipped), ready for the next one
+      grantCredits(1);
+    } else if (header[3] == PACKET_ACCEPT && length >= 2) {
+      acceptedVersion = payload[0];
+      Serial.print("Server accepted protocol v");
+      Serial.println(acceptedVersion);
+
+      grantCredits(CREDIT_WINDOW);
+    }
+  }
+}
+
 void setup() {
   Serial.begin(9600);
   
@@ -61,6 +239,7 @@ void setup() {
   }
 
   accel = mpu.getAccelerometerSensor();
+  gyro = mpu.getGyroSensor();
 
   strip.setBrightness(128);
   strip.clear();
@@ -69,28 +248,18 @@ void setup() {
 
 void loop() {
   if (WiFi.status() == WL_CONNECTED && client.connected()) {
-    if (client.available() >= NUM_PIXELS * 3) {
-      uint8_t r[NUM_PIXELS] = {0};
-      uint8_t g[NUM_PIXELS] = {0};
-      uint8_t b[NUM_PIXELS] = {0};
-
-      // Read RGB into channels
-      client.read(r, NUM_PIXELS);
-      client.read(g, NUM_PIXELS);
-      client.read(b, NUM_PIXELS);
-
-      // Set RGB value for each DotStar pixel
-      for (int i = 0; i < NUM_PIXELS; i++) {
-        strip.setPixelColor(i, (uint8_t) r[i], (uint8_t) g[i], (uint8_t) b[i]);
-      }
-      
-      strip.show();
-    }
+    readPackets();
 
     accel->getEvent(&event);
-    double mag = sqrt(pow(event.acceleration.x, 2) + pow(event.acceleration.y, 2) + pow(event.acceleration.z, 2));
-    client.print(mag);
-    client.print("|");
+
+    if (acceptedVersion >= FLOW_CONTROL_VERSION) {
+      gyro->getEvent(&gyroEvent);
+      sendSample();
+    } else {
+      double mag = sqrt(pow(event.acceleration.x, 2) + pow(event.acceleration.y, 2) + pow(event.acceleration.z, 2));
+      client.print(mag);
+      client.print("|");
+    }
 
     // Limit loop rate to 30 frames per second
 //    delay(34);